@@ -0,0 +1,272 @@
+import csv
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from normalize import FLAG_BITS, FLAG_NAMES, flags_mask, parse_contact
+
+logger = logging.getLogger(__name__)
+
+# Bump when the per-relay contribution, the relay key or the counter layout changes
+STATE_VERSION = 2
+
+def relay_id(row):
+    """Identity of a node row: scraper.relay_key within the row's address, i.e.
+    fingerprint|IP|ORPort, else IP|ORPort|Name. A relay listed on several
+    addresses (IPv4 and IPv6 rows sharing a fingerprint) has one key per row"""
+    address = (row.get('IP', ''), row.get('OnionPort', ''))
+    if row.get('Fingerprint'):
+        return '|'.join((row['Fingerprint'],) + address)
+    return '|'.join(address + (row.get('Name', ''),))
+
+def bump(counts, key, delta):
+    """Add delta to counts[key], dropping the key when it reaches 0"""
+    value = counts.get(key, 0) + delta
+    if value:
+        counts[key] = value
+    else:
+        counts.pop(key, None)
+
+class NodeAggregates:
+    """Flag, version, port, operator, country and ASN breakdowns, maintained incrementally.
+
+    aggregates_state.json keeps the counters and what each relay
+    contributed to them; an update only subtracts the old and adds the new
+    contribution of relays that were added, removed or changed since the
+    last scrape. The rankings are then written to aggregates.json, which
+    /api/aggregates serves as-is; requests never touch the node table.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.aggregates_file = os.path.join(data_dir, 'aggregates.json')
+        self.state_file = os.path.join(data_dir, 'aggregates_state.json')
+        # Entries kept in the port and operator rankings
+        self.top = int(os.getenv('AGGREGATES_TOP', '50'))
+        self.cached = None
+        self.cached_mtime = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        """Serialise state updates across the scheduler and API worker processes"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(f'{self.state_file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def operator(row):
+        """Operator group: contact email, else contact URL, else the raw contact"""
+        if 'ContactEmail' in row:
+            contact, email, url = row.get('Contact'), row.get('ContactEmail'), row.get('ContactUrl')
+        else:
+            # CSV written before the typed columns existed
+            contact, email, url, _ = parse_contact(row.get('Contact', ''))
+        return (email or url or contact or '').strip().lower()[:200]
+
+    def contribution(self, row):
+        """The fields of a row the aggregates count: [ip, is_exit, version, flags mask,
+        ORPort, DirPort, operator, country, ASN, AS name]"""
+        try:
+            mask = int(row['FlagsMask'])
+        except (KeyError, ValueError):
+            mask = flags_mask(row.get('Flags', ''))
+        return [
+            row['IP'],
+            int(row.get('IsExit') == 'ExitNode'),
+            row.get('Version') or 'unknown',
+            mask,
+            row.get('OnionPort') or 'unknown',
+            row.get('DirPort') or 'unknown',
+            self.operator(row),
+            # GeoIP columns are empty when no database is configured
+            row.get('Country') or '',
+            row.get('ASN') or '',
+            row.get('ASName') or ''
+        ]
+
+    @staticmethod
+    def empty_counters():
+        return {
+            'relays': 0, 'exits': 0,
+            'flags': {},          # flag -> {'relays', 'exits'}
+            'versions': {},       # version -> {'relays', 'exits', 'guards'}
+            'flag_versions': {},  # flag -> {version: relays}
+            'or_ports': {}, 'dir_ports': {},
+            # name -> {'relays', 'exits', 'ips': {ip: relays}}
+            'operators': {}, 'countries': {}, 'asns': {},
+            'as_names': {}        # asn -> {AS name: relays}
+        }
+
+    @staticmethod
+    def apply(counters, contribution, sign):
+        """Add (sign=1) or remove (sign=-1) one relay's contribution"""
+        ip, is_exit, version, mask, or_port, dir_port, operator, country, asn, as_name = contribution
+        counters['relays'] += sign
+        counters['exits'] += sign * is_exit
+        entry = counters['versions'].setdefault(version, {})
+        bump(entry, 'relays', sign)
+        bump(entry, 'exits', sign * is_exit)
+        for letter, bit in FLAG_BITS.items():
+            if mask & bit:
+                name = FLAG_NAMES[letter]
+                flag = counters['flags'].setdefault(name, {})
+                bump(flag, 'relays', sign)
+                bump(flag, 'exits', sign * is_exit)
+                if not flag:
+                    del counters['flags'][name]
+                by_version = counters['flag_versions'].setdefault(name, {})
+                bump(by_version, version, sign)
+                if not by_version:
+                    del counters['flag_versions'][name]
+                if letter == 'G':
+                    bump(entry, 'guards', sign)
+        if not entry:
+            del counters['versions'][version]
+        bump(counters['or_ports'], or_port, sign)
+        bump(counters['dir_ports'], dir_port, sign)
+        for groups, key in ((counters['operators'], operator), (counters['countries'], country), (counters['asns'], asn)):
+            if not key:
+                continue
+            group = groups.setdefault(key, {'relays': 0, 'exits': 0, 'ips': {}})
+            group['relays'] += sign
+            group['exits'] += sign * is_exit
+            bump(group['ips'], ip, sign)
+            if not group['relays']:
+                del groups[key]
+        if asn and as_name:
+            names = counters['as_names'].setdefault(asn, {})
+            bump(names, as_name, sign)
+            if not names:
+                del counters['as_names'][asn]
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get('version') != STATE_VERSION:
+            state = {'version': STATE_VERSION, 'relays': {}, 'counters': self.empty_counters()}
+        return state
+
+    @staticmethod
+    def read_rows(csv_file):
+        with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+
+    def render(self, counters):
+        """The aggregates document for /api/aggregates from the counters"""
+        def ranked(counts):
+            ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:self.top]
+            return [{'value': value, 'relays': count} for value, count in ordered]
+
+        def top_groups(groups, key, label, extra=lambda name: {}):
+            ranked = sorted(groups.items(), key=lambda item: (-item[1][key], item[0]))[:self.top]
+            return [
+                {label: name, 'relays': group['relays'], 'exits': group['exits'], 'ips': len(group['ips']), **extra(name)}
+                for name, group in ranked if group[key]
+            ]
+
+        def breakdown(groups, label, extra=lambda name: {}):
+            return {
+                'count': len(groups),
+                'by_relays': top_groups(groups, 'relays', label, extra),
+                'by_exits': top_groups(groups, 'exits', label, extra)
+            }
+
+        def as_name(asn):
+            names = counters['as_names'].get(asn)
+            return {'as_name': max(names.items(), key=lambda item: (item[1], item[0]))[0] if names else ''}
+
+        versions = counters['versions']
+        return {
+            'updated_at': datetime.now().isoformat(),
+            'relays': counters['relays'],
+            'exits': counters['exits'],
+            'flags': {
+                name: {'relays': counts.get('relays', 0), 'exits': counts.get('exits', 0)}
+                for name, counts in sorted(counters['flags'].items())
+            },
+            # Rankings are lists so their order survives JSON serialisation
+            'versions': [
+                {'version': version, 'relays': counts.get('relays', 0), 'guards': counts.get('guards', 0), 'exits': counts.get('exits', 0)}
+                for version, counts in sorted(versions.items(), key=lambda item: (-item[1].get('relays', 0), item[0]))
+            ],
+            'flag_versions': {name: dict(counts) for name, counts in sorted(counters['flag_versions'].items())},
+            'or_ports': ranked(counters['or_ports']),
+            'dir_ports': ranked(counters['dir_ports']),
+            'operators': breakdown(counters['operators'], 'operator'),
+            'countries': breakdown(counters['countries'], 'country'),
+            'asns': breakdown(counters['asns'], 'asn', as_name)
+        }
+
+    def _save_json(self, path, data):
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+
+    def update(self, csv_file, rows=None):
+        """Apply the relays added, removed or changed since the last update to the
+        counters and save the aggregates atomically. rows are the scraper's
+        current node rows; without them the node CSV is read"""
+        if rows is None:
+            rows = self.read_rows(csv_file)
+        with self.file_lock():
+            state = self.load_state()
+            previous, counters = state['relays'], state['counters']
+            current = {}
+            duplicates = Counter()
+            changed = 0
+            for row in rows:
+                if not row.get('IP'):
+                    continue
+                key = relay_id(row)
+                if key in current:
+                    # Duplicate rows still count once each
+                    duplicates[key] += 1
+                    key = f'{key}#{duplicates[key]}'
+                contribution = self.contribution(row)
+                current[key] = contribution
+                old = previous.pop(key, None)
+                if old != contribution:
+                    if old is not None:
+                        self.apply(counters, old, -1)
+                    self.apply(counters, contribution, 1)
+                    changed += 1
+            # Relays left in the previous state are gone
+            for old in previous.values():
+                self.apply(counters, old, -1)
+            changed += len(previous)
+
+            aggregates = self.render(counters)
+            self._save_json(self.state_file, {'version': STATE_VERSION, 'relays': current, 'counters': counters})
+            self._save_json(self.aggregates_file, aggregates)
+        logger.info(f"Aggregates updated: {changed} relays changed, {aggregates['relays']} relays, "
+                    f"{aggregates['operators']['count']} operators")
+        return aggregates
+
+    def summary(self):
+        """Current aggregates (reloaded only when another process rebuilt them)"""
+        try:
+            mtime = os.path.getmtime(self.aggregates_file)
+        except OSError:
+            return {}
+        with self.lock:
+            if mtime != self.cached_mtime:
+                try:
+                    with open(self.aggregates_file, 'r') as f:
+                        self.cached = json.load(f)
+                except (OSError, ValueError):
+                    return self.cached or {}
+                self.cached_mtime = mtime
+            return self.cached
@@ -0,0 +1,156 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from metrics import metrics
+from report import render
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('alerts_total', 'Alerts raised by kind')
+metrics.describe('alert_emails_total', 'Alert emails by status (one email can carry several alerts)')
+
+# Alert kinds, in the order a digest lists them
+KINDS = ['anomaly', 'failure', 'rate_limit', 'churn']
+KIND_LABELS = {'anomaly': 'Anomaly - publishing held', 'failure': 'Job failure', 'rate_limit': 'Rate limited', 'churn': 'Large churn'}
+
+class AlertManager:
+    """Per-event email alerts, delivered from a background queue.
+
+    Alerts raised within ALERT_BATCH_SECONDS of the first one are sent as a
+    single digest email, so a burst (e.g. several jobs failing together)
+    becomes one message. Delivery goes through the notifier's shared SMTP
+    session, so consecutive emails reuse one authenticated connection, and
+    the worker closes that connection once it has been idle.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.data_dir = data_dir
+        self.enabled = (os.getenv('ALERTS_ENABLED', 'false').lower() == 'true'
+                        and os.getenv('EMAIL_ENABLED', 'false').lower() == 'true')
+        self.to_email = os.getenv('ALERT_TO', '') or os.getenv('EMAIL_TO', '')
+        self.batch_seconds = float(os.getenv('ALERT_BATCH_SECONDS', '60'))
+        self.max_batch = int(os.getenv('ALERT_MAX_BATCH', '50'))
+        # Nodes added + removed in one scrape that count as large churn
+        self.churn_threshold = int(os.getenv('ALERT_CHURN_THRESHOLD', '500'))
+        self.queue = queue.Queue(maxsize=1000)
+        self.worker = None
+        self.notifier = None
+        self.lock = threading.Lock()
+
+    def check(self, job, entry):
+        """Raise the alerts a job history entry calls for"""
+        if not self.enabled:
+            return
+        message = entry.get('message', '') or ''
+        if 'ANOMALY:' in message:
+            self.alert('anomaly', f'{job} data held back - publishing on hold', message, job)
+        elif 'RATE_LIMITED' in message:
+            self.alert('rate_limit', f'{job} rate limited by the upstream site', message, job)
+        elif entry.get('status') == 'error' or 'failed' in message.lower():
+            # Scheduled scrapes that fail are recorded as 'skipped' with a "... failed: ..." message
+            self.alert('failure', f'{job} failed', message or 'Unknown error', job)
+        added, removed = entry.get('nodes_added') or 0, entry.get('nodes_removed') or 0
+        # The first scrape "adds" every node; that is not churn
+        baseline = not removed and added >= (entry.get('nodes_total') or 0)
+        churn = added + removed
+        if job == 'scrape' and churn >= self.churn_threshold and not baseline:
+            self.alert(
+                'churn',
+                f'{churn} nodes changed in one scrape',
+                f"{added} added, {removed} removed "
+                f"({entry.get('nodes_total', 0)} nodes now listed)",
+                job
+            )
+
+    def alert(self, kind, subject, message, job=''):
+        """Queue an alert for delivery (never blocks the caller)"""
+        if not self.enabled:
+            return
+        metrics.inc('alerts_total', {'kind': kind})
+        try:
+            self.queue.put_nowait({
+                'kind': kind,
+                'label': KIND_LABELS.get(kind, kind),
+                'job': job,
+                'subject': subject,
+                'message': message,
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            })
+        except queue.Full:
+            logger.error(f"Alert queue full - dropping alert: {subject}")
+            return
+        self._start()
+
+    def flush(self, timeout=30):
+        """Deliver everything queued so far without waiting for the batch window"""
+        if self.worker is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='alert-delivery', daemon=True)
+                self.worker.start()
+
+    def _notifier(self):
+        if self.notifier is None:
+            from email_notifier import EmailNotifier
+            self.notifier = EmailNotifier(self.data_dir)
+        return self.notifier
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=10)
+            except queue.Empty:
+                if self.notifier is not None:
+                    self.notifier.session().close_if_idle()
+                continue
+
+            # Collect the burst that follows the first alert
+            batch, flushed = [], []
+            deadline = time.monotonic() + self.batch_seconds
+            while True:
+                if isinstance(item, threading.Event):
+                    flushed.append(item)
+                    # Take whatever else is already queued, then send now
+                    deadline = 0
+                else:
+                    batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self.deliver(batch)
+            for event in flushed:
+                event.set()
+
+    def deliver(self, batch):
+        """Send one email for a batch of alerts"""
+        batch.sort(key=lambda alert: KINDS.index(alert['kind']) if alert['kind'] in KINDS else len(KINDS))
+        if len(batch) == 1:
+            subject = f"[ALERT] Tor Node Monitor - {batch[0]['subject']}"
+        else:
+            counts = {}
+            for alert in batch:
+                counts[alert['label']] = counts.get(alert['label'], 0) + 1
+            subject = f"[ALERT] Tor Node Monitor - {len(batch)} alerts ({', '.join(f'{count} {label}' for label, count in counts.items())})"
+        try:
+            text, html = render('alert', alerts=batch, generated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            self._notifier().send_message(subject, text, html, to_email=self.to_email)
+            metrics.inc('alert_emails_total', {'status': 'sent'})
+            logger.info(f"Alert email sent to {self.to_email or self.notifier.to_email}: {len(batch)} alert(s)")
+        except Exception as e:
+            metrics.inc('alert_emails_total', {'status': 'error'})
+            logger.error(f"Failed to send alert email ({len(batch)} alert(s)): {e}")
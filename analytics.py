@@ -0,0 +1,211 @@
+import csv
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# (label, upper bound in seconds) - Uptime is reported in seconds
+UPTIME_BUCKETS = [
+    ('<1d', 86400),
+    ('1-7d', 7 * 86400),
+    ('7-30d', 30 * 86400),
+    ('30-90d', 90 * 86400),
+    ('>=90d', None)
+]
+
+class ChurnAnalytics:
+    """Relay churn computed incrementally, one scrape at a time.
+
+    analytics_state.json keeps what the next update needs: the previous
+    scrape's node set ({ip: is_exit}) and recent presence changes per IP
+    (for flap detection). analytics.json holds the precomputed results
+    (latest run, recent runs, daily rollups, 7d/30d totals, flapping IPs,
+    version and uptime distributions) and is what /api/analytics serves,
+    so nothing is ever recomputed over the full history.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.summary_file = os.path.join(data_dir, 'analytics.json')
+        self.state_file = os.path.join(data_dir, 'analytics_state.json')
+        self.max_runs = int(os.getenv('ANALYTICS_MAX_RUNS', '100'))
+        self.max_days = int(os.getenv('ANALYTICS_MAX_DAYS', '90'))
+        # An IP is flapping when it appeared/disappeared FLAP_THRESHOLD times
+        # within the last FLAP_WINDOW scrapes
+        self.flap_window = int(os.getenv('ANALYTICS_FLAP_WINDOW', '48'))
+        self.flap_threshold = int(os.getenv('ANALYTICS_FLAP_THRESHOLD', '3'))
+        self.cached_summary = None
+        self.cached_mtime = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        """Serialise updates across the scheduler and API worker processes"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(f'{self.state_file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_json(self, path, default):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _save_json(self, path, data):
+        tmp_file = f'{path}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_file, path)
+
+    def count_nodes(self, rows):
+        """One pass over node rows: {ip: is_exit}, version counts, uptime buckets"""
+        nodes = {}
+        versions = Counter()
+        uptime = Counter()
+        for row in rows:
+            ip = row.get('IP', '')
+            if not ip:
+                continue
+            is_exit = row.get('IsExit') == 'ExitNode'
+            nodes[ip] = nodes.get(ip, False) or is_exit
+            versions[row.get('Version') or 'unknown'] += 1
+            uptime[self.uptime_bucket(row.get('Uptime'))] += 1
+        return nodes, versions, uptime
+
+    def read_nodes(self, csv_file):
+        """count_nodes over the node CSV"""
+        with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+            return self.count_nodes(csv.DictReader(f))
+
+    @staticmethod
+    def uptime_bucket(value):
+        try:
+            seconds = int(value)
+        except (TypeError, ValueError):
+            return 'unknown'
+        for label, bound in UPTIME_BUCKETS:
+            if bound is None or seconds < bound:
+                return label
+
+    def update(self, csv_file, timestamp=None, rows=None):
+        """Fold the scrape just written to csv_file into the analytics. rows are
+        the scraper's current node rows; without them the node CSV is read"""
+        timestamp = timestamp or datetime.now()
+        if rows is None:
+            nodes, versions, uptime = self.read_nodes(csv_file)
+        else:
+            nodes, versions, uptime = self.count_nodes(rows)
+
+        with self.file_lock():
+            state = self._load_json(self.state_file, {})
+            summary = self._load_json(self.summary_file, {})
+            previous = state.get('nodes')
+            seq = state.get('seq', 0) + 1
+            changes = state.get('changes', {})
+
+            if previous is None:
+                # First scrape seen: nothing to compare against yet
+                added = removed = promotions = demotions = []
+            else:
+                added = [ip for ip in nodes if ip not in previous]
+                removed = [ip for ip in previous if ip not in nodes]
+                promotions = [ip for ip, is_exit in nodes.items() if is_exit and previous.get(ip) is False]
+                demotions = [ip for ip, is_exit in nodes.items() if not is_exit and previous.get(ip)]
+
+            # Presence changes inside the flap window
+            oldest = seq - self.flap_window
+            for ip in added + removed:
+                changes.setdefault(ip, []).append(seq)
+            for ip in list(changes):
+                recent = [s for s in changes[ip] if s > oldest]
+                if recent:
+                    changes[ip] = recent
+                else:
+                    del changes[ip]
+            flapping = sorted(
+                ((ip, len(seqs)) for ip, seqs in changes.items() if len(seqs) >= self.flap_threshold),
+                key=lambda item: (-item[1], item[0])
+            )
+
+            run = {
+                'timestamp': timestamp.isoformat(),
+                'baseline': previous is None,
+                'total_nodes': len(nodes),
+                'exit_nodes': sum(1 for is_exit in nodes.values() if is_exit),
+                'added': len(added),
+                'removed': len(removed),
+                'exit_promotions': len(promotions),
+                'exit_demotions': len(demotions),
+                'flapping': len(flapping)
+            }
+
+            daily = {day['date']: day for day in summary.get('daily', [])}
+            day = daily.setdefault(timestamp.date().isoformat(), {
+                'date': timestamp.date().isoformat(), 'scrapes': 0, 'added': 0, 'removed': 0,
+                'exit_promotions': 0, 'exit_demotions': 0, 'min_total': len(nodes), 'max_total': len(nodes)
+            })
+            day['scrapes'] += 1
+            for key in ('added', 'removed', 'exit_promotions', 'exit_demotions'):
+                day[key] += run[key]
+            day['min_total'] = min(day['min_total'], len(nodes))
+            day['max_total'] = max(day['max_total'], len(nodes))
+            day['last_total'] = len(nodes)
+            daily = sorted(daily.values(), key=lambda d: d['date'])[-self.max_days:]
+
+            summary = {
+                'updated_at': timestamp.isoformat(),
+                'latest': run,
+                'runs': ([run] + summary.get('runs', []))[:self.max_runs],
+                'daily': daily,
+                'rollups': {
+                    '7d': self.rollup(daily, timestamp, 7),
+                    '30d': self.rollup(daily, timestamp, 30)
+                },
+                'flapping': {
+                    'count': len(flapping),
+                    'window_scrapes': self.flap_window,
+                    'threshold': self.flap_threshold,
+                    'top': [{'ip': ip, 'changes': count} for ip, count in flapping[:50]]
+                },
+                'versions': dict(versions.most_common()),
+                'uptime_buckets': {label: uptime.get(label, 0) for label, _ in UPTIME_BUCKETS + [('unknown', None)]}
+            }
+
+            self._save_json(self.state_file, {'seq': seq, 'nodes': nodes, 'changes': changes})
+            self._save_json(self.summary_file, summary)
+
+        logger.info(f"Churn analytics updated: {run}")
+        return run
+
+    @staticmethod
+    def rollup(daily, timestamp, days):
+        """Sum the daily rollups of the last `days` days"""
+        since = (timestamp.date() - timedelta(days=days - 1)).isoformat()
+        window = [day for day in daily if day['date'] >= since]
+        totals = {'days': days, 'scrapes': 0, 'added': 0, 'removed': 0, 'exit_promotions': 0, 'exit_demotions': 0}
+        for day in window:
+            for key in ('scrapes', 'added', 'removed', 'exit_promotions', 'exit_demotions'):
+                totals[key] += day[key]
+        return totals
+
+    def summary(self):
+        """Precomputed analytics (reloaded only when another process updated them)"""
+        try:
+            mtime = os.path.getmtime(self.summary_file)
+        except OSError:
+            return {}
+        with self.lock:
+            if mtime != self.cached_mtime:
+                self.cached_summary = self._load_json(self.summary_file, {})
+                self.cached_mtime = mtime
+            return self.cached_summary
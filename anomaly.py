@@ -0,0 +1,185 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from statistics import median
+
+logger = logging.getLogger(__name__)
+
+class AnomalyDetected(Exception):
+    """A scrape deviated from the baseline; its data must not be saved or published"""
+
+class AnomalyDetector:
+    """Checks each scrape against a rolling baseline before its data is saved.
+
+    anomaly_state.json keeps the last ANOMALY_BASELINE_RUNS accepted scrapes
+    (total nodes, exit nodes, churn) and the current publishing hold. A
+    scrape whose node count, exit count or churn deviates from the baseline
+    medians by more than the configured percentage raises AnomalyDetected
+    (the scraper then leaves the CSV untouched) and puts publishing on hold
+    until a scrape passes again or the hold is released by hand.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.state_file = os.path.join(data_dir, 'anomaly_state.json')
+        self.enabled = os.getenv('ANOMALY_DETECTION', 'true').lower() == 'true'
+        self.baseline_runs = int(os.getenv('ANOMALY_BASELINE_RUNS', '24'))
+        # Accepted scrapes needed before exit and churn checks use the baseline
+        self.min_runs = int(os.getenv('ANOMALY_MIN_BASELINE_RUNS', '3'))
+        self.max_drop = float(os.getenv('ANOMALY_MAX_DROP_PERCENT', '30'))
+        self.max_growth = float(os.getenv('ANOMALY_MAX_GROWTH_PERCENT', '50'))
+        self.max_exit_drop = float(os.getenv('ANOMALY_MAX_EXIT_DROP_PERCENT', '40'))
+        self.max_churn = float(os.getenv('ANOMALY_MAX_CHURN_PERCENT', '25'))
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        """Serialise updates across the scheduler and API worker processes"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with self.lock, open(f'{self.state_file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def baseline(self, state=None):
+        """Median total/exit nodes and churn over the accepted runs, plus the run count"""
+        runs = (state if state is not None else self.load()).get('runs', [])
+        if not runs:
+            return {'runs': 0}
+        return {
+            'runs': len(runs),
+            'total_nodes': median(run['total_nodes'] for run in runs),
+            'exit_nodes': median(run['exit_nodes'] for run in runs if run.get('exit_nodes') is not None)
+                          if any(run.get('exit_nodes') is not None for run in runs) else None,
+            'churn': median(run.get('churn', 0) for run in runs)
+        }
+
+    @staticmethod
+    def _percent(value, reference):
+        return (value - reference) * 100.0 / reference
+
+    def check_nodes(self, total, added, removed, previous_total=0):
+        """Stage 1 check: node count and churn (before the node set is saved).
+
+        previous_total (the node count already in the CSV) stands in for the
+        baseline until enough scrapes have been accepted.
+        """
+        if not self.enabled:
+            return
+        state = self.load()
+        if state.get('rebaseline'):
+            # Hold released with rebaseline: this scrape starts the new baseline
+            return
+        baseline = self.baseline(state)
+        reference = baseline['total_nodes'] if baseline['runs'] >= self.min_runs else previous_total
+        if not reference:
+            return
+        violations = []
+        change = self._percent(total, reference)
+        if change <= -self.max_drop:
+            violations.append(f"total nodes {total} is {-change:.0f}% below the baseline {reference:.0f} (limit {self.max_drop:.0f}%)")
+        elif change >= self.max_growth:
+            violations.append(f"total nodes {total} is {change:.0f}% above the baseline {reference:.0f} (limit {self.max_growth:.0f}%)")
+        churn = (added + removed) * 100.0 / reference
+        if churn >= self.max_churn:
+            violations.append(f"{added} added + {removed} removed is {churn:.0f}% churn (limit {self.max_churn:.0f}%)")
+        if violations:
+            self.hold(violations, {'total_nodes': total, 'added': added, 'removed': removed, 'baseline': baseline})
+
+    def check_exits(self, exits):
+        """Stage 2 check: exit node count (before the stage 1 node set and the exit flags are saved)"""
+        if not self.enabled:
+            return
+        baseline = self.baseline()
+        if baseline['runs'] < self.min_runs or not baseline.get('exit_nodes'):
+            return
+        change = self._percent(exits, baseline['exit_nodes'])
+        if change <= -self.max_exit_drop:
+            self.hold(
+                [f"exit nodes {exits} is {-change:.0f}% below the baseline {baseline['exit_nodes']:.0f} (limit {self.max_exit_drop:.0f}%)"],
+                {'exit_nodes': exits, 'baseline': baseline}
+            )
+
+    def hold(self, violations, details):
+        """Put publishing on hold and raise AnomalyDetected"""
+        reason = '; '.join(violations)
+        with self.file_lock():
+            state = self.load()
+            hold = state.get('hold') or {'since': datetime.now().isoformat(timespec='seconds'), 'count': 0}
+            hold.update(reason=reason, details=details, last_seen=datetime.now().isoformat(timespec='seconds'))
+            hold['count'] += 1
+            state['hold'] = hold
+            self._save(state)
+        logger.warning(f"Anomaly detected - publishing on hold: {reason}")
+        raise AnomalyDetected(f"ANOMALY: {reason}. Data not saved; publishing on hold")
+
+    def accept(self, total, exits, added, removed):
+        """Record a scrape that passed the checks and lift any hold"""
+        with self.file_lock():
+            state = self.load()
+            runs = state.get('runs', [])
+            runs.append({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'total_nodes': total,
+                'exit_nodes': exits,
+                'churn': added + removed
+            })
+            state['runs'] = runs[-self.baseline_runs:]
+            state.pop('rebaseline', None)
+            if state.get('hold'):
+                logger.info(f"Scrape passed anomaly checks - publishing hold lifted ({state['hold']['reason']})")
+                state['hold'] = None
+            self._save(state)
+
+    def held(self):
+        """The current hold ({'reason', 'since', ...}) or None"""
+        if not self.enabled:
+            return None
+        return self.load().get('hold')
+
+    def release(self, rebaseline=False):
+        """Lift the hold by hand. rebaseline=True also drops the baseline, for when
+        the network really changed and the next scrapes should set a new one"""
+        with self.file_lock():
+            state = self.load()
+            hold = state.get('hold')
+            state['hold'] = None
+            if rebaseline:
+                state['runs'] = []
+                state['rebaseline'] = True
+            self._save(state)
+        logger.info(f"Publishing hold released by hand{' (baseline reset)' if rebaseline else ''}")
+        return hold
+
+    def status(self):
+        state = self.load()
+        return {
+            'enabled': self.enabled,
+            'hold': state.get('hold') if self.enabled else None,
+            'baseline': self.baseline(state),
+            'thresholds': {
+                'max_drop_percent': self.max_drop,
+                'max_growth_percent': self.max_growth,
+                'max_exit_drop_percent': self.max_exit_drop,
+                'max_churn_percent': self.max_churn,
+                'min_baseline_runs': self.min_runs
+            }
+        }
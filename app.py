@@ -1,24 +1,31 @@
 import os
+import fcntl
+import io
 import logging
-import threading
-from flask import Flask, render_template, jsonify, request
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
+import time
+from contextlib import contextmanager
+from flask import Flask, render_template, jsonify, request, g, Response, stream_with_context
+from datetime import datetime, timedelta
 import json
-from scraper import TorNodeScraper
-from github_uploader import GitHubUploader
-from opencti_importer import OpenCTIImporter
-from email_notifier import EmailNotifier
-
-# Configure logging
-logging.basicConfig(
-    level=os.getenv('LOG_LEVEL', 'INFO'),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/logs/app.log'),
-        logging.StreamHandler()
-    ]
-)
+from job_runner import JobRunner
+from node_index import NodeIndex
+from snapshot import ensure_snapshot
+from analytics import ChurnAnalytics
+from aggregates import NodeAggregates
+from seen_store import SeenStore
+from report import ReportRollup
+from alerts import AlertManager
+from anomaly import AnomalyDetector
+from fetch_schedule import FetchSchedule
+from exit_policy import ExitPolicyIndex
+from ip_list import ip_version
+from enrich import Enricher, iter_lines, format_rows
+from normalize import parse_flag_filter, version_code
+from metrics import metrics
+from logging_config import setup_logging
+
+# Configure logging (non-blocking queue handler with rotation, sampled access log)
+setup_logging(os.getenv('LOG_FILE', '/app/logs/app.log'))
 logger = logging.getLogger(__name__)
 
 # Reduce verbosity of pycti library logs
@@ -26,8 +33,41 @@ logging.getLogger('api').setLevel(logging.WARNING)
 logging.getLogger('pycti').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
+# Integration modules (scraper, GitHub, OpenCTI/pycti, email, APScheduler) are
+# imported inside the functions that use them, so the API starts serving without
+# loading features that are disabled. github_uploader also changes SSL env vars
+# on import, which should only happen when GitHub upload is enabled.
+
 app = Flask(__name__)
-scheduler = BackgroundScheduler()
+# BackgroundScheduler, created by setup_schedulers() in the scheduler process
+scheduler = None
+DATA_DIR = os.getenv('DATA_DIR', '/app/data')
+NODES_CSV = os.path.join(DATA_DIR, 'tor_nodes.csv')
+STATS_FILE = os.path.join(DATA_DIR, 'stats.json')
+EMAIL_SETTINGS_FILE = os.path.join(DATA_DIR, 'email_settings.json')
+
+job_runner = JobRunner(
+    max_workers=int(os.getenv('JOB_WORKERS', '2')),
+    state_dir=os.path.join(DATA_DIR, 'jobs')
+)
+node_index = NodeIndex(NODES_CSV)
+churn_analytics = ChurnAnalytics(DATA_DIR)
+node_aggregates = NodeAggregates(DATA_DIR)
+seen_store = SeenStore(os.path.join(DATA_DIR, 'seen.db'))
+report_rollup = ReportRollup(DATA_DIR)
+alert_manager = AlertManager(DATA_DIR)
+anomaly_detector = AnomalyDetector(DATA_DIR)
+fetch_schedule = FetchSchedule(DATA_DIR)
+exit_policy_index = ExitPolicyIndex(os.path.join(DATA_DIR, 'exit_policies.json'))
+
+stats_mtime = None
+
+# History key -> job label used in metrics
+JOB_NAMES = {
+    'scrape_history': 'scrape',
+    'github_history': 'github',
+    'opencti_history': 'opencti'
+}
 
 # Global stats storage
 stats = {
@@ -37,6 +77,8 @@ stats = {
     'node_stats': {
         'total_nodes': 0,
         'exit_nodes': 0,
+        'ipv6_nodes': 0,
+        'total_relays': 0,
         'added_nodes': 0,
         'removed_nodes': 0
     }
@@ -44,24 +86,133 @@ stats = {
 
 def load_stats():
     """Load stats from file if exists"""
-    stats_file = '/app/data/stats.json'
-    if os.path.exists(stats_file):
+    if os.path.exists(STATS_FILE):
         try:
-            with open(stats_file, 'r') as f:
+            with open(STATS_FILE, 'r') as f:
                 return json.load(f)
         except:
             pass
     return stats
 
 def save_stats():
-    """Save stats to file"""
-    stats_file = '/app/data/stats.json'
+    """Save stats to file (atomically, so other processes never see a partial file)"""
+    global stats_mtime
     try:
-        with open(stats_file, 'w') as f:
+        tmp_file = f'{STATS_FILE}.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(stats, f, indent=2, default=str)
+        os.replace(tmp_file, STATS_FILE)
+        stats_mtime = os.path.getmtime(STATS_FILE)
     except Exception as e:
         logger.error(f"Failed to save stats: {e}")
 
+def refresh_stats():
+    """Reload stats if another process (scheduler or API worker) saved a newer copy"""
+    global stats, stats_mtime
+    try:
+        mtime = os.path.getmtime(STATS_FILE)
+    except OSError:
+        return
+    if mtime != stats_mtime:
+        stats = load_stats()
+        stats_mtime = mtime
+
+@contextmanager
+def stats_lock():
+    """Serialise read-modify-write of stats.json across threads and processes"""
+    os.makedirs(os.path.dirname(STATS_FILE), exist_ok=True)
+    with open(f'{STATS_FILE}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def record_history(history_key, entry, node_stats=None):
+    """Add a history entry (and optionally new node stats) and save"""
+    with stats_lock():
+        refresh_stats()
+        stats[history_key].insert(0, entry)
+        # Keep only last 100 entries
+        stats[history_key] = stats[history_key][:100]
+        if node_stats:
+            stats['node_stats'].update(node_stats)
+        save_stats()
+        
+        # Summary email rollups are kept up to date as entries arrive; the first
+        # time, they are built from the whole history (which includes this entry)
+        try:
+            histories = {name: stats.get(key, []) for key, name in JOB_NAMES.items()}
+            if not report_rollup.seed(histories):
+                report_rollup.record(JOB_NAMES.get(history_key, history_key), entry)
+        except Exception as e:
+            logger.error(f"Failed to update report rollups: {e}")
+    
+    job = JOB_NAMES.get(history_key, history_key)
+    # Failure / rate limit / churn alerts are queued and sent in the background
+    alert_manager.check(job, entry)
+    if 'duration_seconds' in entry:
+        metrics.observe('job_duration_seconds', entry['duration_seconds'], {'job': job})
+        metrics.inc('job_runs_total', {'job': job, 'status': entry.get('status', '')})
+
+def update_analytics(timestamp, rows=None):
+    """Fold a successful scrape into the churn analytics and aggregates (never fails the scrape).
+    rows are the scraper's node rows, so neither needs to re-read the CSV"""
+    try:
+        churn_analytics.update(NODES_CSV, timestamp, rows)
+    except Exception as e:
+        logger.error(f"Failed to update churn analytics: {e}")
+    try:
+        node_aggregates.update(NODES_CSV, rows)
+    except Exception as e:
+        logger.error(f"Failed to update aggregates: {e}")
+
+def observe_scrape_stages(result):
+    """Feed per-stage scrape timings into the metrics registry"""
+    for stage, seconds in result.get('timings', {}).items():
+        metrics.observe('scrape_stage_duration_seconds', seconds, {'stage': stage})
+    metrics.inc('scrape_bytes_fetched_total', value=result.get('bytes_fetched', 0))
+    metrics.inc('scrape_rows_processed_total', value=result.get('rows_processed', 0))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count requests and record latency per endpoint (route rule, not raw path)"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'endpoint': endpoint, 'method': request.method}
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start, labels)
+        metrics.inc('http_requests_total', dict(labels, status=str(response.status_code)))
+    return response
+
+def scrape_not_before():
+    """Earliest time the upstream may be scraped again, or None if it may be scraped now.
+    
+    Data directories from before the fetch schedule existed are seeded from the
+    last scrape in the history.
+    """
+    refresh_stats()
+    if stats.get('scrape_history'):
+        fetch_schedule.seed('scrape_history', stats['scrape_history'][0].get('timestamp'))
+    if fetch_schedule.wait_seconds() <= 0:
+        return None
+    return fetch_schedule.next_slot()
+
+def schedule_scrape_retry():
+    """Run the scheduled scrape at the earliest legal slot if that comes before its next interval run"""
+    slot = scrape_not_before()
+    if slot is None or scheduler is None:
+        return
+    job = scheduler.get_job('scrape_tor')
+    if job and job.next_run_time and job.next_run_time.timestamp() <= slot.timestamp():
+        return
+    scheduler.add_job(scrape_tor_nodes, 'date', run_date=slot, id='scrape_tor_retry', replace_existing=True)
+    logger.info(f"Scrape retry scheduled at {slot.isoformat(timespec='seconds')} (earliest slot the upstream allows)")
+
 def scrape_tor_nodes():
     """Scheduled task to scrape Tor nodes"""
     # Check if scraping is enabled
@@ -69,98 +220,121 @@ def scrape_tor_nodes():
         logger.info("Scraping is disabled via SCRAPE_ENABLED environment variable")
         return
     
-    # Check if we've scraped too recently (rate limiting protection)
-    if stats.get('scrape_history'):
-        try:
-            last_scrape_time = datetime.fromisoformat(stats['scrape_history'][0]['timestamp'])
-        except:
-            # Handle old timestamp format
-            last_scrape_time = stats['scrape_history'][0]['timestamp']
-            if isinstance(last_scrape_time, str):
-                last_scrape_time = datetime.fromisoformat(last_scrape_time)
-        
-        time_since_last = datetime.now() - last_scrape_time
-        
-        # Don't scrape if less than 35 minutes since last attempt (5 min buffer)
-        if time_since_last.total_seconds() < 2100:  # 35 minutes
-            logger.info(f"Skipping scrape - only {time_since_last.total_seconds()/60:.1f} minutes since last attempt")
-            return
+    # Rate limiting protection: per-source next-allowed times are persisted by the
+    # scraper; a run that comes too early moves to the earliest legal slot instead
+    slot = scrape_not_before()
+    if slot:
+        logger.info(f"Skipping scrape - upstream allows the next fetch at {slot.isoformat(timespec='seconds')}")
+        schedule_scrape_retry()
+        return
     
-    scraper = TorNodeScraper(csv_file='/app/data/tor_nodes.csv')
+    from scraper import TorNodeScraper
+    scraper = TorNodeScraper(csv_file=NODES_CSV)
     start_time = datetime.now()
+    job_start = time.monotonic()
+    result = {'scraped': False}
     
     try:
         result = scraper.run()
         
-        stats['scrape_history'].insert(0, {
-            'timestamp': start_time.isoformat(),
-            'status': 'success' if result['scraped'] else 'skipped',
-            'message': result.get('message', ''),
-            'nodes_total': result.get('total_nodes', 0),
-            'nodes_exit': result.get('exit_nodes', 0),
-            'nodes_added': result.get('added_nodes', 0),
-            'nodes_removed': result.get('removed_nodes', 0)
-        })
-        
         # Update current stats
+        node_stats = None
         if result['scraped']:
-            stats['node_stats'].update({
+            node_stats = {
                 'total_nodes': result.get('total_nodes', 0),
                 'exit_nodes': result.get('exit_nodes', 0),
-                'added_nodes': result.get('added_nodes', 0),
+                'ipv6_nodes': result.get('ipv6_nodes', 0),
+                'total_relays': result.get('total_relays', 0),
+                'added_nodes': result.get('new_nodes', 0),
                 'removed_nodes': result.get('removed_nodes', 0)
-            })
+            }
         
-        # Keep only last 100 entries
-        stats['scrape_history'] = stats['scrape_history'][:100]
-        save_stats()
+        record_history('scrape_history', {
+            'timestamp': start_time.isoformat(),
+            'duration_seconds': round(time.monotonic() - job_start, 3),
+            'status': 'success' if result['scraped'] else 'skipped',
+            'message': result.get('message', ''),
+            'nodes_total': result.get('total_nodes', 0),
+            'nodes_exit': result.get('exit_nodes', 0),
+            'nodes_added': result.get('new_nodes', 0),
+            'nodes_removed': result.get('removed_nodes', 0),
+            'timings': result.get('timings', {}),
+            'bytes_fetched': result.get('bytes_fetched', 0),
+            'rows_processed': result.get('rows_processed', 0),
+            'sources': result.get('sources', {})
+        }, node_stats)
+        observe_scrape_stages(result)
+        if result['scraped']:
+            update_analytics(start_time, scraper.rows)
         
     except Exception as e:
         logger.error(f"Scraping failed: {e}")
-        stats['scrape_history'].insert(0, {
+        record_history('scrape_history', {
             'timestamp': start_time.isoformat(),
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'error',
             'message': str(e)
         })
-        stats['scrape_history'] = stats['scrape_history'][:100]
-        save_stats()
+    
+    if not result['scraped']:
+        # Rate limited or refused: try again as soon as the upstream allows
+        schedule_scrape_retry()
+
+def publishing_held(history_key, forced=False):
+    """Record a skipped upload and return the hold if an anomalous scrape put publishing on hold"""
+    hold = anomaly_detector.held()
+    if hold:
+        logger.warning(f"Upload skipped - publishing held since {hold['since']}: {hold['reason']}")
+        record_history(history_key, {
+            'timestamp': datetime.now(),
+            'status': 'skipped',
+            'message': f"{'[FORCED] ' if forced else ''}Publishing held: {hold['reason']}",
+            'forced': forced
+        })
+    return hold
 
 def upload_to_github():
     """Scheduled task to upload to GitHub"""
     if not os.getenv('UPLOAD_TO_GITHUB', 'false').lower() == 'true':
         return
+    if publishing_held('github_history'):
+        return
     
+    from github_uploader import GitHubUploader
     uploader = GitHubUploader()
     start_time = datetime.now()
+    job_start = time.monotonic()
     
     try:
         result = uploader.upload()
-        stats['github_history'].insert(0, {
+        record_history('github_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'success' if result['success'] else 'error',
             'message': result.get('message', '')
         })
-        stats['github_history'] = stats['github_history'][:100]
-        save_stats()
     except Exception as e:
         logger.error(f"GitHub upload failed: {e}")
-        stats['github_history'].insert(0, {
+        record_history('github_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'error',
             'message': str(e)
         })
-        stats['github_history'] = stats['github_history'][:100]
-        save_stats()
 
 def upload_to_opencti():
     """Scheduled task to upload to OpenCTI"""
     if not os.getenv('UPLOAD_TO_OPENCTI', 'false').lower() == 'true':
         logger.info("OpenCTI upload skipped - UPLOAD_TO_OPENCTI is disabled")
         return
+    if publishing_held('opencti_history'):
+        return
     
     logger.info("🔄 Initiating scheduled OpenCTI import...")
+    from opencti_importer import OpenCTIImporter
     importer = OpenCTIImporter()
     start_time = datetime.now()
+    job_start = time.monotonic()
     
     try:
         result = importer.import_nodes()
@@ -171,33 +345,36 @@ def upload_to_opencti():
         else:
             logger.error(f"❌ Scheduled OpenCTI import failed: {result.get('message', '')}")
         
-        stats['opencti_history'].insert(0, {
+        record_history('opencti_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'success' if result['success'] else 'error',
             'message': result.get('message', ''),
             'imported': result.get('imported', 0)
         })
-        stats['opencti_history'] = stats['opencti_history'][:100]
-        save_stats()
     except Exception as e:
         logger.error(f"❌ OpenCTI import failed with exception: {e}")
-        stats['opencti_history'].insert(0, {
+        record_history('opencti_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'error',
             'message': str(e)
         })
-        stats['opencti_history'] = stats['opencti_history'][:100]
-        save_stats()
 
-def force_upload_to_opencti_background():
+def force_upload_to_opencti_background(progress=None):
     """Forced OpenCTI import task (for manual triggers) - API test already done"""
     logger.info("📋 [FORCED] IMPORT JOB STARTED: Beginning background import process...")
+    hold = publishing_held('opencti_history', forced=True)
+    if hold:
+        return {'success': False, 'message': f"Publishing held: {hold['reason']}"}
+    from opencti_importer import OpenCTIImporter
     importer = OpenCTIImporter()
     start_time = datetime.now()
+    job_start = time.monotonic()
     
     try:
         # Skip the API test in importer since we already did it
-        result = importer.import_nodes()
+        result = importer.import_nodes(progress=progress)
         
         # Log the result summary
         if result['success']:
@@ -205,34 +382,161 @@ def force_upload_to_opencti_background():
         else:
             logger.error(f"❌ [FORCED] OpenCTI import failed: {result.get('message', '')}")
         
-        stats['opencti_history'].insert(0, {
+        record_history('opencti_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'success' if result['success'] else 'error',
             'message': f"[FORCED] {result.get('message', '')}",
             'imported': result.get('imported', 0),
             'forced': True
         })
-        stats['opencti_history'] = stats['opencti_history'][:100]
-        save_stats()
+        return result
     except Exception as e:
         logger.error(f"❌ [FORCED] OpenCTI import failed with exception: {e}")
-        stats['opencti_history'].insert(0, {
+        record_history('opencti_history', {
             'timestamp': start_time,
+            'duration_seconds': round(time.monotonic() - job_start, 3),
             'status': 'error',
             'message': f"[FORCED] {str(e)}",
             'forced': True
         })
-        stats['opencti_history'] = stats['opencti_history'][:100]
-        save_stats()
+        return {
+            'success': False,
+            'message': str(e)
+        }
+
+def force_scrape_background(progress=None, profile=False):
+    """Forced scrape task (for manual triggers)"""
+    from scraper import TorNodeScraper
+    scraper = TorNodeScraper(csv_file=NODES_CSV)
+    start_time = datetime.now()
+    job_start = time.monotonic()
+    
+    # The job is scheduled for the earliest legal slot (see force_scrape); if
+    # another scrape has moved that slot since, it is skipped rather than waited for
+    slot = scrape_not_before()
+    if slot:
+        message = f"[FORCED] Skipped - upstream allows the next fetch at {slot.isoformat(timespec='seconds')}"
+        record_history('scrape_history', {
+            'timestamp': start_time,
+            'status': 'skipped',
+            'message': message,
+            'forced': True
+        })
+        return {'success': False, 'message': message, 'next_allowed': slot.isoformat(timespec='seconds')}
+    
+    result = scraper.force_scrape(progress=progress, profile=profile)
+    
+    # Update current stats if successful
+    node_stats = None
+    if result['scraped']:
+        node_stats = {
+            'total_nodes': result.get('total_nodes', 0),
+            'exit_nodes': result.get('exit_nodes', 0),
+            'ipv6_nodes': result.get('ipv6_nodes', 0),
+            'total_relays': result.get('total_relays', 0),
+            'added_nodes': result.get('new_nodes', 0),
+            'removed_nodes': result.get('removed_nodes', 0)
+        }
+    
+    # Update stats
+    record_history('scrape_history', {
+        'timestamp': start_time,
+        'duration_seconds': round(time.monotonic() - job_start, 3),
+        'status': 'success' if result['scraped'] else 'error',
+        'message': f"[FORCED] {result.get('message', '')}",
+        'nodes_total': result.get('total_nodes', 0),
+        'nodes_exit': result.get('exit_nodes', 0),
+        'nodes_added': result.get('new_nodes', 0),
+        'nodes_removed': result.get('removed_nodes', 0),
+        'timings': result.get('timings', {}),
+        'bytes_fetched': result.get('bytes_fetched', 0),
+        'rows_processed': result.get('rows_processed', 0),
+        'profile_file': result.get('profile', {}).get('file'),
+        'sources': result.get('sources', {}),
+        'forced': True
+    }, node_stats)
+    observe_scrape_stages(result)
+    if result['scraped']:
+        update_analytics(start_time, scraper.rows)
+    
+    return {
+        'success': result['scraped'],
+        'message': result.get('message', ''),
+        'stats': result
+    }
+
+def force_upload_github_background(progress=None):
+    """Forced GitHub upload task (for manual triggers)"""
+    hold = publishing_held('github_history', forced=True)
+    if hold:
+        return {'success': False, 'message': f"Publishing held: {hold['reason']}"}
+    from github_uploader import GitHubUploader
+    uploader = GitHubUploader()
+    start_time = datetime.now()
+    job_start = time.monotonic()
+    
+    result = uploader.upload(progress=progress)
+    
+    # Update stats
+    record_history('github_history', {
+        'timestamp': start_time,
+        'duration_seconds': round(time.monotonic() - job_start, 3),
+        'status': 'success' if result['success'] else 'error',
+        'message': f"[FORCED] {result.get('message', '')}",
+        'forced': True
+    })
+    
+    return {
+        'success': result['success'],
+        'message': result.get('message', '')
+    }
+
+def job_response(job, created, message):
+    """Build the response for a queued manual trigger"""
+    if not created:
+        message = f"A {job['kind']} job is already {job['status']} - returning the existing job"
+    return jsonify({
+        'success': True,
+        'message': message,
+        'job_id': job['id'],
+        'job': job,
+        'deduplicated': not created
+    }), 202
 
 @app.route('/')
 def index():
     """Main dashboard"""
     return render_template('index.html')
 
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus metrics endpoint"""
+    refresh_stats()
+    
+    # Node counts and last job durations come from the shared stats, so they are
+    # correct whichever process (scheduler or API worker) ran the job
+    node_stats = stats.get('node_stats', {})
+    last_durations = []
+    for history_key, job in JOB_NAMES.items():
+        history = stats.get(history_key) or []
+        entry = next((item for item in history if 'duration_seconds' in item), None)
+        if entry:
+            last_durations.append(({'job': job}, entry['duration_seconds']))
+    
+    body = metrics.render({
+        'tor_nodes': [({}, node_stats.get('total_nodes', 0))],
+        'tor_exit_nodes': [({}, node_stats.get('exit_nodes', 0))],
+        'tor_ipv6_nodes': [({}, node_stats.get('ipv6_nodes', 0))],
+        'job_last_duration_seconds': last_durations
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/stats')
 def get_stats():
     """API endpoint for stats"""
+    refresh_stats()
+    
     # Add configuration status to stats
     email_settings = load_email_settings()
     config_status = {
@@ -255,14 +559,83 @@ def get_stats():
     
     response_data = dict(stats)
     response_data['config'] = config_status
+    response_data['anomaly_hold'] = anomaly_detector.held()
+    response_data['fetch_schedule'] = fetch_schedule.status()
     return jsonify(response_data)
 
+@app.route('/api/analytics')
+def get_analytics():
+    """API endpoint for precomputed relay churn analytics"""
+    return jsonify(churn_analytics.summary())
+
+def node_filter_error(args):
+    """Message for an invalid ?min_uptime=, ?version_lt= or ?version_gte=, or None"""
+    if args.get('min_uptime') and not args['min_uptime'].isdigit():
+        return 'min_uptime must be a whole number of seconds'
+    for param in ('version_lt', 'version_gte'):
+        if args.get(param) and version_code(args[param]) is None:
+            return f'{param} must be a Tor version such as 0.4.8.13'
+    return None
+
+def filter_nodes(df, args):
+    """Apply ?exit=, ?flags=, ?version_lt=, ?version_gte= and ?min_uptime= using the typed columns"""
+    if 'exit' in args:
+        is_exit = df['IsExit'] == 'ExitNode'
+        df = df[is_exit if args['exit'].lower() in ('1', 'true', 'yes') else ~is_exit]
+    if args.get('flags') and 'FlagsMask' in df:
+        mask = parse_flag_filter(args['flags'])
+        df = df[(df['FlagsMask'].fillna(0).astype(int) & mask) == mask]
+    for param, keep in (('version_lt', lambda codes, code: codes < code), ('version_gte', lambda codes, code: codes >= code)):
+        code = version_code(args.get(param, ''))
+        if code is not None and 'VersionCode' in df:
+            df = df[keep(df['VersionCode'], code)]
+    if args.get('min_uptime') and 'Uptime' in df:
+        df = df[df['Uptime'] >= int(args['min_uptime'])]
+    return df
+
+@app.route('/api/aggregates')
+def get_aggregates():
+    """API endpoint for precomputed flag/version/port/operator/country/ASN breakdowns"""
+    return jsonify(node_aggregates.summary())
+
 @app.route('/api/nodes')
 def get_nodes():
-    """API endpoint for node data"""
+    """API endpoint for node data (optionally filtered, see filter_nodes)"""
+    args = request.args
+    error = node_filter_error(args)
+    if error:
+        return jsonify({
+            'success': False,
+            'message': error
+        }), 400
     try:
+        rows = node_index.select(
+            exit=args['exit'].lower() in ('1', 'true', 'yes') if 'exit' in args else None,
+            flags_mask=parse_flag_filter(args['flags']) if args.get('flags') else 0,
+            version_lt=version_code(args.get('version_lt', '')),
+            version_gte=version_code(args.get('version_gte', '')),
+            min_uptime=int(args['min_uptime']) if args.get('min_uptime') else None
+        )
+        if rows is not None:
+            # Filtered straight off the mapped snapshot; only matching rows are decoded
+            seen = {ip: (first, last, count) for ip, first, last, count in seen_store.all()}
+            nodes = []
+            for row in rows:
+                first, last, count = seen.get(row['IP'], ('', '', 0))
+                row.update(first_seen=first, last_seen=last, seen_count=count)
+                nodes.append(row)
+            return jsonify({
+                'nodes': nodes,
+                'total': len(nodes)
+            })
+
+        # No snapshot available: filter the CSV with pandas
         import pandas as pd
-        df = pd.read_csv('/app/data/tor_nodes.csv')
+        df = filter_nodes(pd.read_csv(NODES_CSV), args)
+        # Add first_seen / last_seen / seen_count from the seen store
+        seen = pd.DataFrame(seen_store.all(), columns=['IP', 'first_seen', 'last_seen', 'seen_count'])
+        df = df.merge(seen, on='IP', how='left')
+        df['seen_count'] = df['seen_count'].fillna(0).astype(int)
         # Replace NaN values with empty strings for better JSON serialization
         df = df.fillna('')
         return jsonify({
@@ -272,45 +645,168 @@ def get_nodes():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def lookup_result(ip, seen=None):
+    """Build the lookup response for a single IP.
+    
+    seen is an optional {ip: seen record} prefetched for a batch lookup.
+    """
+    nodes = node_index.lookup(ip)
+    if seen is None:
+        seen = seen_store.get_many({node['IP'] for node in nodes})
+    record = next((seen[node['IP']] for node in nodes if node['IP'] in seen), {})
+    return {
+        'ip': ip,
+        'ip_version': ip_version(ip),
+        'is_tor': bool(nodes),
+        'is_exit': any(node.get('IsExit') == 'ExitNode' for node in nodes),
+        'first_seen': record.get('first_seen'),
+        'last_seen': record.get('last_seen'),
+        'seen_count': record.get('seen_count', 0),
+        'nodes': nodes
+    }
+
+@app.route('/api/lookup/<ip>')
+def lookup_ip(ip):
+    """API endpoint to check whether an IP is a known Tor node"""
+    return jsonify(lookup_result(ip))
+
+@app.route('/api/lookup', methods=['POST'])
+def lookup_ips():
+    """API endpoint to check a batch of IPs ({"ips": [...]})"""
+    ips = (request.get_json(silent=True) or {}).get('ips')
+    if not isinstance(ips, list):
+        return jsonify({
+            'success': False,
+            'message': 'Request body must be JSON with an "ips" list'
+        }), 400
+    
+    # One seen-store query for the whole batch
+    ips = [str(ip) for ip in ips]
+    node_ips = {node['IP'] for ip in ips for node in node_index.lookup(ip)}
+    seen = seen_store.get_many(node_ips)
+    return jsonify({
+        'results': [lookup_result(ip, seen) for ip in ips]
+    })
+
+def valid_port(port):
+    return str(port).isdigit() and 1 <= int(port) <= 65535
+
+def exit_policy_result(ip, port=None):
+    """Exit policy answer for one IP (and optionally one destination port)"""
+    result = {
+        'ip': ip,
+        'is_exit': any(node.get('IsExit') == 'ExitNode' for node in node_index.lookup(ip)),
+        'policy': exit_policy_index.policy(ip)
+    }
+    if port is not None:
+        result['port'] = port
+        result['allowed'] = exit_policy_index.allows(ip, port, refresh=False)
+    return result
+
+@app.route('/api/exit-policy/<ip>')
+def exit_policy(ip):
+    """API endpoint for an exit's accepted ports; ?port=N checks one port
+    (allowed is null when no policy is known for the IP)"""
+    port = request.args.get('port')
+    if port is not None and not valid_port(port):
+        return jsonify({
+            'success': False,
+            'message': 'port must be a number between 1 and 65535'
+        }), 400
+    return jsonify(exit_policy_result(ip, int(port) if port is not None else None))
+
+@app.route('/api/exit-policy', methods=['POST'])
+def exit_policies():
+    """API endpoint to check a batch of (IP, port) pairs ({"queries": [{"ip": ..., "port": ...}]})"""
+    queries = (request.get_json(silent=True) or {}).get('queries')
+    if not isinstance(queries, list) or not all(
+            isinstance(query, dict) and query.get('ip') and valid_port(query.get('port', '')) for query in queries):
+        return jsonify({
+            'success': False,
+            'message': 'Request body must be JSON with a "queries" list of {"ip", "port"} objects'
+        }), 400
+    
+    pairs = [(str(query['ip']), int(query['port'])) for query in queries]
+    allowed = exit_policy_index.allows_many(pairs)
+    return jsonify({
+        'generated_at': exit_policy_index.generated_at,
+        'results': [{'ip': ip, 'port': port, 'allowed': answer} for (ip, port), answer in zip(pairs, allowed)]
+    })
+
+def detach_upload(upload):
+    """File object for an uploaded file that stays open after the request ends.
+    
+    Flask closes request files before a streamed response is consumed, so
+    disk-backed uploads are reopened on a duplicated descriptor; small
+    in-memory uploads are copied.
+    """
+    try:
+        detached = os.fdopen(os.dup(upload.stream.fileno()), 'rb')
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return io.BytesIO(upload.stream.read())
+    detached.seek(0)
+    return detached
+
+@app.route('/api/enrich', methods=['POST'])
+def enrich():
+    """API endpoint to annotate the IPs in an uploaded log file or IP list.
+    
+    Accepts a multipart upload (field "file") or a raw request body and
+    streams back one row per Tor match. Query parameters: format=csv|jsonl,
+    history=1 (also match IPs seen in earlier scrapes), all=1 (every IP),
+    port=N (also report whether each exit's policy accepts port N).
+    """
+    def flag(name):
+        return request.args.get(name, 'false').lower() in ('1', 'true', 'yes')
+    
+    output_format = request.args.get('format', 'csv')
+    if output_format not in ('csv', 'jsonl'):
+        return jsonify({
+            'success': False,
+            'message': 'format must be csv or jsonl'
+        }), 400
+    
+    port = request.args.get('port')
+    if port is not None and not valid_port(port):
+        return jsonify({
+            'success': False,
+            'message': 'port must be a number between 1 and 65535'
+        }), 400
+    
+    upload = request.files.get('file')
+    stream = detach_upload(upload) if upload else request.stream
+    enricher = Enricher(node_index, seen_store, history=flag('history'), include_all=flag('all'),
+                        exit_policies=exit_policy_index, port=int(port) if port is not None else None)
+    
+    mimetype = 'application/x-ndjson' if output_format == 'jsonl' else 'text/csv'
+    return Response(
+        stream_with_context(format_rows(enricher.rows(iter_lines(stream)), output_format, enricher.fields)),
+        mimetype=mimetype
+    )
+
 @app.route('/api/force-scrape', methods=['POST'])
 def force_scrape():
-    """API endpoint to force scraping (for testing)"""
+    """API endpoint to force scraping (for testing) - runs as a background job.
+    
+    Pass ?profile=1 to capture a cProfile/tracemalloc profile of this scrape.
+    """
     try:
-        scraper = TorNodeScraper(csv_file='/app/data/tor_nodes.csv')
-        start_time = datetime.now()
-        
-        result = scraper.force_scrape()
-        
-        # Update stats
-        stats['scrape_history'].insert(0, {
-            'timestamp': start_time,
-            'status': 'success' if result['scraped'] else 'error',
-            'message': f"[FORCED] {result.get('message', '')}",
-            'nodes_total': result.get('total_nodes', 0),
-            'nodes_exit': result.get('exit_nodes', 0),
-            'nodes_added': result.get('new_nodes', 0),
-            'nodes_removed': result.get('removed_nodes', 0),
-            'forced': True
-        })
-        
-        # Update current stats if successful
-        if result['scraped']:
-            stats['node_stats'].update({
-                'total_nodes': result.get('total_nodes', 0),
-                'exit_nodes': result.get('exit_nodes', 0),
-                'added_nodes': result.get('new_nodes', 0),
-                'removed_nodes': result.get('removed_nodes', 0)
-            })
-        
-        # Keep only last 100 entries
-        stats['scrape_history'] = stats['scrape_history'][:100]
-        save_stats()
-        
-        return jsonify({
-            'success': result['scraped'],
-            'message': result.get('message', ''),
-            'stats': result
-        })
+        profile = request.args.get('profile', 'false').lower() in ('1', 'true', 'yes')
+        slot = scrape_not_before()
+        if slot and (slot - datetime.now()).total_seconds() > float(os.getenv('FORCE_SCRAPE_MAX_WAIT_MINUTES', '35')) * 60:
+            return jsonify({
+                'success': False,
+                'message': f"The upstream site is rate limiting us - next fetch allowed at {slot.isoformat(timespec='seconds')}",
+                'next_allowed': slot.isoformat(timespec='seconds')
+            }), 429
+        # Inside the rate limit window the job is scheduled for its end and
+        # holds no job worker until then
+        job, created = job_runner.submit('scrape', force_scrape_background,
+                                         not_before=slot + timedelta(seconds=1) if slot else None, profile=profile)
+        message = 'Scrape job started' + (' (profiling)' if profile else '')
+        if slot:
+            message = f"Scrape job scheduled for {slot.strftime('%H:%M:%S')}, when the upstream rate limit window ends" + (' (profiling)' if profile else '')
+        return job_response(job, created, message)
         
     except Exception as e:
         logger.error(f"Force scrape API failed: {e}")
@@ -319,9 +815,21 @@ def force_scrape():
             'message': str(e)
         }), 500
 
+def publishing_hold_response():
+    """409 response for a manual upload while publishing is held, else None"""
+    hold = anomaly_detector.held()
+    if not hold:
+        return None
+    return jsonify({
+        'success': False,
+        'message': f"Publishing is held since {hold['since']} after an anomalous scrape: {hold['reason']}. "
+                   "Release it with POST /api/anomaly/release once the data has been checked.",
+        'hold': hold
+    }), 409
+
 @app.route('/api/force-upload-github', methods=['POST'])
 def force_upload_github():
-    """API endpoint to force GitHub upload (for testing)"""
+    """API endpoint to force GitHub upload (for testing) - runs as a background job"""
     if not os.getenv('UPLOAD_TO_GITHUB', 'false').lower() == 'true':
         return jsonify({
             'success': False,
@@ -329,32 +837,19 @@ def force_upload_github():
         }), 400
     
     try:
-        uploader = GitHubUploader()
-        start_time = datetime.now()
-        
         # Check if CSV file exists
-        if not os.path.exists('/app/data/tor_nodes.csv'):
+        if not os.path.exists(NODES_CSV):
             return jsonify({
                 'success': False,
                 'message': 'No data to upload. Please run a scrape first.'
             }), 400
         
-        result = uploader.upload()
+        hold_response = publishing_hold_response()
+        if hold_response:
+            return hold_response
         
-        # Update stats
-        stats['github_history'].insert(0, {
-            'timestamp': start_time,
-            'status': 'success' if result['success'] else 'error',
-            'message': f"[FORCED] {result.get('message', '')}",
-            'forced': True
-        })
-        stats['github_history'] = stats['github_history'][:100]
-        save_stats()
-        
-        return jsonify({
-            'success': result['success'],
-            'message': result.get('message', '')
-        })
+        job, created = job_runner.submit('github', force_upload_github_background)
+        return job_response(job, created, 'GitHub upload job started')
         
     except Exception as e:
         logger.error(f"Force GitHub upload failed: {e}")
@@ -363,6 +858,38 @@ def force_upload_github():
             'message': str(e)
         }), 500
 
+@app.route('/api/anomaly')
+def get_anomaly():
+    """API endpoint for the anomaly baseline, thresholds and publishing hold"""
+    return jsonify(anomaly_detector.status())
+
+@app.route('/api/anomaly/release', methods=['POST'])
+def release_anomaly():
+    """API endpoint to lift a publishing hold by hand.
+    
+    Pass {"rebaseline": true} when the network really changed, so the next
+    scrape starts a new baseline instead of being held again.
+    """
+    rebaseline = bool((request.get_json(silent=True) or {}).get('rebaseline', False))
+    hold = anomaly_detector.release(rebaseline=rebaseline)
+    return jsonify({
+        'success': True,
+        'message': ('Publishing hold released' if hold else 'Publishing was not held') +
+                   (' - baseline reset' if rebaseline else ''),
+        'released': hold
+    })
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """API endpoint for background job status, progress and result"""
+    job = job_runner.get(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': f'Unknown job: {job_id}'
+        }), 404
+    return jsonify(job)
+
 @app.route('/api/force-upload-opencti', methods=['POST'])
 def force_upload_opencti():
     """API endpoint to force OpenCTI import (for testing)"""
@@ -374,15 +901,19 @@ def force_upload_opencti():
     
     try:
         # Check if CSV file exists
-        if not os.path.exists('/app/data/tor_nodes.csv'):
+        if not os.path.exists(NODES_CSV):
             return jsonify({
                 'success': False,
                 'message': 'No data to import. Please run a scrape first.'
             }), 400
         
+        hold_response = publishing_hold_response()
+        if hold_response:
+            return hold_response
+        
         # Count nodes to give user an estimate
         import pandas as pd
-        df = pd.read_csv('/app/data/tor_nodes.csv')
+        df = pd.read_csv(NODES_CSV)
         node_count = len(df)
         
         # Test OpenCTI API availability FIRST before starting background thread
@@ -407,14 +938,13 @@ def force_upload_opencti():
             else:
                 logger.error(f"❌ [FORCED] API Test: FAILED - OpenCTI API returned status code {response.status_code}")
                 # Add failed API test to history
-                stats['opencti_history'].insert(0, {
+                record_history('opencti_history', {
                     'timestamp': datetime.now(),
                     'status': 'error',
                     'message': f"[FORCED] ❌ API Test Failed - HTTP {response.status_code}",
                     'imported': 0,
                     'forced': True
                 })
-                save_stats()
                 return jsonify({
                     'success': False,
                     'message': f'OpenCTI API test failed - HTTP {response.status_code}. Cannot proceed with import.'
@@ -423,14 +953,13 @@ def force_upload_opencti():
         except requests.exceptions.Timeout:
             logger.error(f"❌ [FORCED] API Test: FAILED - Connection timeout to {api_url}")
             # Add failed API test to history
-            stats['opencti_history'].insert(0, {
+            record_history('opencti_history', {
                 'timestamp': datetime.now(),
                 'status': 'error',
                 'message': f"[FORCED] ❌ API Test Failed - Connection timeout",
                 'imported': 0,
                 'forced': True
             })
-            save_stats()
             return jsonify({
                 'success': False,
                 'message': f'OpenCTI API connection timeout to {api_url}. Cannot proceed with import.'
@@ -438,14 +967,13 @@ def force_upload_opencti():
         except Exception as e:
             logger.error(f"❌ [FORCED] API Test: FAILED - {str(e)}")
             # Add failed API test to history
-            stats['opencti_history'].insert(0, {
+            record_history('opencti_history', {
                 'timestamp': datetime.now(),
                 'status': 'error',
                 'message': f"[FORCED] ❌ API Test Failed - {str(e)}",
                 'imported': 0,
                 'forced': True
             })
-            save_stats()
             return jsonify({
                 'success': False,
                 'message': f'OpenCTI API connectivity failed: {str(e)}. Cannot proceed with import.'
@@ -456,24 +984,17 @@ def force_upload_opencti():
         
         # Add success entry showing API test passed and job started
         start_time = datetime.now()
-        stats['opencti_history'].insert(0, {
+        record_history('opencti_history', {
             'timestamp': start_time,
             'status': 'success',
             'message': f"[FORCED] ✅ API Test Successful - Import job started for {node_count} entries",
             'imported': 0,
             'forced': True
         })
-        save_stats()
         
-        # Start import in background - fire and forget
-        import_thread = threading.Thread(target=force_upload_to_opencti_background)
-        import_thread.daemon = True
-        import_thread.start()
-        
-        return jsonify({
-            'success': True,
-            'message': f'OpenCTI API test passed! Import job started for {node_count} nodes.',
-        })
+        # Start import on the job runner
+        job, created = job_runner.submit('opencti', force_upload_to_opencti_background)
+        return job_response(job, created, f'OpenCTI API test passed! Import job started for {node_count} nodes.')
         
     except Exception as e:
         logger.error(f"Force OpenCTI import failed: {e}")
@@ -489,7 +1010,7 @@ def save_email_settings():
         settings = request.json
         
         # Save email settings to a file for persistence
-        email_settings_file = '/app/data/email_settings.json'
+        email_settings_file = EMAIL_SETTINGS_FILE
         with open(email_settings_file, 'w') as f:
             json.dump(settings, f, indent=2)
         
@@ -518,7 +1039,7 @@ def send_test_email():
     
     try:
         from email_notifier import EmailNotifier
-        notifier = EmailNotifier()
+        notifier = EmailNotifier(DATA_DIR)
         
         # Check if this is a summary test or simple test
         test_type = request.json.get('type', 'simple') if request.json else 'simple'
@@ -560,7 +1081,7 @@ def send_test_email():
 
 def load_email_settings():
     """Load email settings from file"""
-    email_settings_file = '/app/data/email_settings.json'
+    email_settings_file = EMAIL_SETTINGS_FILE
     default_settings = {
         'enabled': False,
         'includeNodeStats': True,
@@ -582,25 +1103,34 @@ def load_email_settings():
 
 def send_email_summary():
     """Send email summary if enabled"""
-    notifier = EmailNotifier()
+    from email_notifier import EmailNotifier
+    notifier = EmailNotifier(DATA_DIR)
     notifier.send_summary(stats)
 
 def setup_schedulers():
-    """Configure and start schedulers"""
-    global stats
+    """Configure and start schedulers (returns the started scheduler)"""
+    global stats, scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
     stats = load_stats()
+    # API workers only map the node snapshot; (re)build it here if it is
+    # missing or from an older version
+    ensure_snapshot(NODES_CSV)
+    scheduler = BackgroundScheduler()
     
     # Schedule scraping (only if enabled)
     if os.getenv('SCRAPE_ENABLED', 'true').lower() == 'true':
         scrape_hours = int(os.getenv('TOR_SCRAPE_FREQUENCY_HOURS', '1'))
+        # The first run starts straight away on the scheduler's thread pool, so
+        # startup does not wait for it; the last saved data is served meanwhile
         scheduler.add_job(
             scrape_tor_nodes,
             'interval',
             hours=scrape_hours,
             id='scrape_tor',
+            next_run_time=datetime.now(),
             replace_existing=True
         )
-        logger.info(f"Scraping scheduled every {scrape_hours} hour(s)")
+        logger.info(f"Scraping scheduled every {scrape_hours} hour(s), initial scrape running in the background")
     else:
         logger.info("Scraping is disabled via SCRAPE_ENABLED environment variable")
     
@@ -638,10 +1168,7 @@ def setup_schedulers():
         )
     
     scheduler.start()
-    
-    # Run initial scrape (only if enabled)
-    if os.getenv('SCRAPE_ENABLED', 'true').lower() == 'true':
-        scrape_tor_nodes()
+    return scheduler
 
 if __name__ == '__main__':
     setup_schedulers()
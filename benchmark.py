@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the scrape, import and export paths.
+
+Generates synthetic torlist/tornodes pages and node CSVs, then drives the real
+code against fakes (no network):
+    scrape   - TorNodeScraper stages 1-4 against a fake HTTP session
+    rescrape - the same, over an existing CSV sharing 95% of the nodes
+    iplist   - ip_list.parse_ip_list on a torlist response (vs the old parser);
+               run it on 1M lines with --cases iplist --sizes 1000000. From
+               IPLIST_CHECK_MIN_LINES up it fails unless IPLIST_MIN_SPEEDUP
+               and IPLIST_MAX_BYTES_PER_LINE are met
+    opencti  - OpenCTIImporter.import_nodes against a mock OpenCTI client
+    github   - GitHubUploader.upload against a fake GitHub contents API
+    lookup   - Snapshot build and IPv4/IPv6 lookups over a dual-stack CSV
+    snapshot - NodeIndex startup from the mapped binary snapshot (vs parsing the CSV)
+    enrich   - enrich.py streaming over a proxy log of `size` lines
+    api      - GET /api/nodes through the Flask test client
+    startup  - import app, start the schedulers and serve the first dashboard and
+               API responses from persisted data (target: STARTUP_TARGET_SECONDS)
+
+Each case runs in its own process so peak memory is measured per case.
+Results are compared with benchmark_baseline.json and regressions reported;
+with --compare a regression beyond --tolerance makes the exit code 1.
+
+Usage:
+    python benchmark.py                          # all cases at 6k, 60k, 600k rows
+    python benchmark.py --compare                # the same, failing on regressions
+    python benchmark.py --sizes 6000 --cases scrape api
+    python benchmark.py --save-baseline          # record the current numbers
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DEFAULT_SIZES = [6000, 60000, 600000]
+CSV_HEADERS = ['IP', 'IsExit', 'Name', 'OnionPort', 'DirPort', 'Flags', 'Uptime', 'Version', 'Contact', 'CollectionDate', 'Fingerprint',
+               'FlagsMask', 'VersionCode', 'ContactEmail', 'ContactUrl', 'ContactAbuse', 'Sources', 'Provenance',
+               'ASN', 'ASName', 'Country']
+# Seconds from `import app` to the first API response
+STARTUP_TARGET_SECONDS = 2.0
+# iplist acceptance: from this many lines up, parse_ip_list must beat the old
+# parser by this factor and grow peak RSS by at most this much per line
+IPLIST_CHECK_MIN_LINES = 100000
+IPLIST_MIN_SPEEDUP = 1.5
+IPLIST_MAX_BYTES_PER_LINE = 200
+# Modules that must not be imported while their feature is disabled
+INTEGRATION_MODULES = ['scraper', 'github_uploader', 'opencti_importer', 'pycti', 'email_notifier', 'pandas']
+FLAG_SETS = ['FRSV', 'FGHRSDV', 'FHRSDV', 'FEGHRSDV', 'FRV', 'FEHRSV']
+VERSIONS = ['Tor 0.4.8.13', 'Tor 0.4.8.16', 'Tor 0.4.7.16', 'Tor 0.4.9.1-alpha', 'Tor 0.4.8.12']
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+def synthetic_nodes(count, seed=1, ipv6_share=0.05):
+    """Deterministic list of node dicts with unique IPv4/IPv6 addresses (~20% exits)"""
+    rng = random.Random(seed)
+    nodes = []
+    for value in rng.sample(range(1 << 24, 224 << 24), count):
+        if rng.random() < ipv6_share:
+            ip = f'2001:db8:{value >> 16:x}:{value & 0xffff:x}::1'
+        else:
+            ip = f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}'
+        is_exit = rng.random() < 0.2
+        nodes.append({
+            'IP': ip,
+            'IsExit': 'ExitNode' if is_exit else '',
+            'Name': f'relay{rng.randrange(10 ** 6)}',
+            'OnionPort': str(rng.choice([443, 9001, 9000, 8443])),
+            'DirPort': str(rng.choice([0, 0, 80, 9030])),
+            'Flags': rng.choice(FLAG_SETS),
+            'Uptime': str(rng.randrange(0, 90 * 86400)),
+            'Version': rng.choice(VERSIONS),
+            'Contact': rng.choice(['', f'admin &lt;ops{rng.randrange(500)}@example.org&gt;', 'email:abuse[]example.net url:example.net']),
+            'CollectionDate': '2025-07-25'
+        })
+    return nodes
+
+def torlist_page(nodes, exits_only=False):
+    """Body of /torlist/?full or /torlist/?exit"""
+    return '\n'.join(node['IP'] for node in nodes if not exits_only or node['IsExit']) + '\n'
+
+def tornodes_page(nodes):
+    """Body of /tornodes with the node list section"""
+    lines = [
+        '|'.join([node['IP'], node['Name'], node['OnionPort'], node['DirPort'], node['Flags'],
+                  node['Uptime'], node['Version'], node['Contact']])
+        for node in nodes
+    ]
+    return (
+        '<html><body><h1>Tor nodes</h1>\n<!-- __BEGIN_TOR_NODE_LIST__ //-->\n'
+        + '<br>\n'.join(lines)
+        + '<br>\n<!-- __END_TOR_NODE_LIST__ //--></body></html>'
+    )
+
+def write_nodes_csv(path, nodes):
+    import csv
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+        writer.writeheader()
+        writer.writerows(nodes)
+
+# ---------------------------------------------------------------------------
+# Fakes
+# ---------------------------------------------------------------------------
+
+class FakeResponse:
+    def __init__(self, status_code=200, text='', payload=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.payload = payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f'{self.status_code} error')
+
+    def json(self):
+        return self.payload
+
+class FakeTorSite:
+    """Stands in for requests.Session against dan.me.uk"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.headers = {}
+
+    def get(self, url, timeout=None):
+        for suffix, body in self.pages.items():
+            if url.endswith(suffix):
+                return FakeResponse(200, body)
+        return FakeResponse(404, 'not found')
+
+class FakeGitHubSession:
+    """Stands in for requests.Session against the GitHub contents API"""
+
+    def __init__(self):
+        self.verify = True
+        self.files = {}
+        self.bytes_uploaded = 0
+
+    def get(self, url, headers=None):
+        if url in self.files:
+            return FakeResponse(200, payload={'sha': self.files[url]})
+        return FakeResponse(404)
+
+    def put(self, url, json=None, headers=None):
+        self.bytes_uploaded += len(json['content'])
+        self.files[url] = uuid.uuid4().hex
+        return FakeResponse(201)
+
+class MockOpenCTIEntity:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, **kwargs):
+        self.client.calls += 1
+        return {'id': str(uuid.uuid4())}
+
+class MockOpenCTIClient:
+    """Accepts every create call like an OpenCTI server with zero latency"""
+
+    def __init__(self):
+        self.calls = 0
+        self.identity = MockOpenCTIEntity(self)
+        self.stix_cyber_observable = MockOpenCTIEntity(self)
+        self.indicator = MockOpenCTIEntity(self)
+        self.stix_core_relationship = MockOpenCTIEntity(self)
+
+# ---------------------------------------------------------------------------
+# Cases - each receives (size, workdir, timer), does its setup untimed, wraps
+# the measured call in `with timer:` and returns (rows, extra details)
+# ---------------------------------------------------------------------------
+
+def case_scrape(size, workdir, timer):
+    import scraper as scraper_module
+
+    nodes = synthetic_nodes(size)
+    pages = {
+        '/torlist/?full': torlist_page(nodes),
+        '/torlist/?exit': torlist_page(nodes, exits_only=True),
+        '/tornodes': tornodes_page(nodes)
+    }
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+
+    def run_scrape():
+        scraper = scraper_module.TorNodeScraper(csv_file=csv_file)
+        scraper.data_file = os.path.join(workdir, 'node_data.txt')
+        scraper.session = FakeTorSite(pages)
+        scraper.wait = lambda seconds: None
+        return scraper, scraper.run_all_stages()
+
+    # Cold run: no existing CSV in the work directory
+    with timer:
+        scraper, result = run_scrape()
+    details = {
+        'stages': scraper.instrumentation()['timings'],
+        'bytes_fetched': scraper.bytes_fetched,
+        'nodes_total': result['total_nodes']
+    }
+    return size, details
+
+def case_rescrape(size, workdir, timer):
+    """Scrape over an existing CSV that shares 95% of its nodes with the new pages"""
+    import scraper as scraper_module
+
+    previous = synthetic_nodes(size, seed=1)
+    current = previous[size // 20:] + synthetic_nodes(size // 20, seed=2)
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, previous)
+
+    scraper = scraper_module.TorNodeScraper(csv_file=csv_file)
+    scraper.data_file = os.path.join(workdir, 'node_data.txt')
+    scraper.session = FakeTorSite({
+        '/torlist/?full': torlist_page(current),
+        '/torlist/?exit': torlist_page(current, exits_only=True),
+        '/tornodes': tornodes_page(current)
+    })
+    scraper.wait = lambda seconds: None
+
+    with timer:
+        result = scraper.run_all_stages()
+    details = {
+        'stages': scraper.instrumentation()['timings'],
+        'nodes_added': result['new_nodes'],
+        'nodes_removed': result['removed_nodes']
+    }
+    return size, details
+
+def legacy_parse_ip_list(text):
+    """The pre-ip_list torlist parser, kept for comparison"""
+    import re
+
+    def is_valid_ip(ip):
+        try:
+            parts = ip.split('.')
+            return len(parts) == 4 and all(0 <= int(part) <= 255 for part in parts)
+        except:
+            return False
+
+    tokens = set(re.split(r'[\n<br>]+', text.strip()))
+    return {ip.strip() for ip in tokens if ip.strip() and is_valid_ip(ip.strip())}
+
+def case_iplist(size, workdir, timer):
+    """Parse a torlist response of `size` lines (mixed IPv4, IPv6, <br> and junk)"""
+    import ip_list
+
+    rng = random.Random(3)
+    lines = []
+    for value in rng.sample(range(1 << 24, 224 << 24), size):
+        roll = rng.random()
+        if roll < 0.05:
+            lines.append(f'2001:db8:{value >> 16:x}::{value & 0xffff:x}')
+        elif roll < 0.06:
+            lines.append('not-an-ip')
+        else:
+            lines.append(f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}')
+    text = '<br>\n'.join(lines)
+    raw = text.encode('ascii')
+
+    with timer:
+        parsed = ip_list.parse_ip_list(raw)
+
+    # After the measured block so the old parser's memory is not in its peak
+    legacy_start = time.perf_counter()
+    legacy = legacy_parse_ip_list(text)
+    legacy_seconds = time.perf_counter() - legacy_start
+
+    if size >= IPLIST_CHECK_MIN_LINES:
+        if timer.seconds * IPLIST_MIN_SPEEDUP > legacy_seconds:
+            raise RuntimeError(f'parse took {timer.seconds:.3f}s, not {IPLIST_MIN_SPEEDUP}x faster '
+                               f'than the old parser ({legacy_seconds:.3f}s)')
+        growth = (timer.rss_after - timer.rss_before) * 1024
+        if growth > size * IPLIST_MAX_BYTES_PER_LINE:
+            raise RuntimeError(f'peak RSS grew {growth / size:.0f} bytes/line '
+                               f'(limit {IPLIST_MAX_BYTES_PER_LINE})')
+    return size, {
+        'ipv4': len(parsed.v4),
+        'ipv6': parsed.v6_count,
+        'invalid': parsed.invalid,
+        'packed_bytes': len(parsed.v4) * parsed.v4.itemsize + len(parsed.v6),
+        'legacy_seconds': round(legacy_seconds, 4),
+        'legacy_ipv4': len(legacy)
+    }
+
+def case_opencti(size, workdir, timer):
+    try:
+        import opencti_importer
+    except ImportError as e:
+        raise SkipCase(f'pycti not installed ({e})')
+    import requests
+
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, synthetic_nodes(size))
+
+    importer = opencti_importer.OpenCTIImporter.__new__(opencti_importer.OpenCTIImporter)
+    importer.api_url = 'http://opencti.invalid'
+    importer.api_key = 'benchmark'
+    importer.csv_file = csv_file
+    importer.organization_name = 'PeeBee'
+    importer.client = MockOpenCTIClient()
+    importer.payloads = opencti_importer.PayloadBuilder(workdir)
+    importer.ledger = opencti_importer.ImportLedger(workdir, importer.api_url)
+    importer.seen_store = opencti_importer.SeenStore(os.path.join(workdir, 'seen.db'))
+    importer.batch_size = 500
+
+    # import_nodes runs a GraphQL health check first
+    requests.post = lambda *args, **kwargs: FakeResponse(200, payload={'data': {}})
+    opencti_importer.logger.setLevel('WARNING')
+
+    with timer:
+        result = importer.import_nodes()
+    if not result['success']:
+        raise RuntimeError(result['message'])
+    return size, {'imported': result['imported'], 'api_calls': importer.client.calls}
+
+def case_github(size, workdir, timer):
+    os.environ.setdefault('GITHUB_TOKEN', 'benchmark')
+    os.environ.setdefault('GITHUB_REPO', 'benchmark/tor-nodes')
+    import github_uploader
+
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, synthetic_nodes(size))
+
+    uploader = github_uploader.GitHubUploader()
+    uploader.csv_file = csv_file
+    uploader.ip_only_file = os.path.join(workdir, 'tor_nodes_IP_only.csv')
+    uploader.session = FakeGitHubSession()
+
+    with timer:
+        result = uploader.upload()
+    if not result['success']:
+        raise RuntimeError(result['message'])
+    return size, {'bytes_uploaded': uploader.session.bytes_uploaded}
+
+def case_lookup(size, workdir, timer):
+    """Snapshot build plus `size` lookups of each family (hits and misses)"""
+    from node_index import NodeIndex
+    from snapshot import ensure_snapshot
+
+    nodes = synthetic_nodes(size, ipv6_share=0.5)
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, nodes)
+    index = NodeIndex(csv_file)
+
+    queries = {4: [], 6: []}
+    for i, node in enumerate(nodes):
+        family = 6 if ':' in node['IP'] else 4
+        # Every other IPv6 query uses the expanded text form of the address
+        ip = node['IP'].replace('::', ':0:0:0:') if family == 6 and i % 2 else node['IP']
+        queries[family].append(ip)
+    queries[4] += [f'240.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(size // 10)]
+    queries[6] += [f'fd00::{i:x}' for i in range(size // 10)]
+
+    family_seconds = {}
+    with timer:
+        # What the scheduler does at startup; workers then only map the snapshot
+        ensure_snapshot(csv_file)
+        index.refresh()
+        for family, ips in queries.items():
+            start = time.perf_counter()
+            hits = sum(1 for ip in ips if index.lookup(ip))
+            family_seconds[family] = (time.perf_counter() - start, len(ips), hits)
+    if family_seconds[4][2] + family_seconds[6][2] != len(nodes):
+        raise RuntimeError('lookup hit count does not match the node count')
+    return size, {
+        f'ipv{family}_lookups_per_s': round(count / seconds) if seconds else 0
+        for family, (seconds, count, hits) in family_seconds.items()
+    }
+
+def case_snapshot(size, workdir, timer):
+    """Worker startup from an existing snapshot: map it and answer the first lookup"""
+    from node_index import NodeIndex
+    from snapshot import snapshot_path, write_snapshot
+
+    nodes = synthetic_nodes(size)
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, nodes)
+    start = time.perf_counter()
+    write_snapshot(nodes, snapshot_path(csv_file))
+    write_seconds = time.perf_counter() - start
+
+    index = NodeIndex(csv_file)
+    with timer:
+        if not index.lookup(nodes[-1]['IP']):
+            raise RuntimeError('snapshot lookup missed a known node')
+    if not index.use_snapshot:
+        raise RuntimeError('snapshot was not mapped')
+
+    start = time.perf_counter()
+    exits = sum(1 for _ in index.select(exit=True))
+    select_seconds = time.perf_counter() - start
+
+    # The per-process dict the index falls back to without a snapshot
+    fallback = NodeIndex(csv_file)
+    start = time.perf_counter()
+    fallback._load_csv(os.path.getmtime(csv_file))
+    csv_seconds = time.perf_counter() - start
+    return size, {
+        'snapshot_bytes': os.path.getsize(snapshot_path(csv_file)),
+        'write_s': round(write_seconds, 4),
+        'select_exits_s': round(select_seconds, 4),
+        'exits': exits,
+        'csv_index_load_s': round(csv_seconds, 4)
+    }
+
+def case_enrich(size, workdir, timer):
+    """enrich.py over a `size`-line proxy log against a 6k-node index (memory should stay flat)"""
+    from enrich import Enricher, iter_lines, format_rows
+    from node_index import NodeIndex
+
+    nodes = synthetic_nodes(6000)
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, nodes)
+    log_file = os.path.join(workdir, 'proxy.log')
+    rng = random.Random(5)
+    with open(log_file, 'w') as f:
+        for i in range(size):
+            if rng.random() < 0.1:
+                ip = rng.choice(nodes)['IP']
+            else:
+                ip = f'{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}'
+            f.write(f'2025-07-25T12:{i % 60:02d}:00Z {ip} - - "GET /path/{i} HTTP/1.1" 200 {rng.randrange(99999)}\n')
+
+    enricher = Enricher(NodeIndex(csv_file))
+    output_bytes = 0
+    with timer:
+        with open(log_file, 'rb') as stream:
+            for text in format_rows(enricher.rows(iter_lines(stream))):
+                output_bytes += len(text)
+    return size, {'tor_matches': enricher.stats['tor'], 'output_bytes': output_bytes}
+
+def case_api(size, workdir, timer):
+    os.environ['DATA_DIR'] = workdir
+    os.environ['LOG_FILE'] = ''
+    os.environ['LOG_LEVEL'] = 'WARNING'
+    try:
+        import app as app_module
+    except ImportError as e:
+        raise SkipCase(f'app dependencies not installed ({e})')
+
+    write_nodes_csv(app_module.NODES_CSV, synthetic_nodes(size))
+    client = app_module.app.test_client()
+
+    with timer:
+        response = client.get('/api/nodes')
+    if response.status_code != 200:
+        raise RuntimeError(f'/api/nodes returned {response.status_code}')
+    return size, {'response_bytes': len(response.data)}
+
+def case_startup(size, workdir, timer):
+    """Process startup with integrations disabled and a recent scrape on disk"""
+    from snapshot import snapshot_path, write_snapshot
+
+    os.environ.update({
+        'DATA_DIR': workdir, 'LOG_FILE': '', 'LOG_LEVEL': 'WARNING',
+        'UPLOAD_TO_GITHUB': 'false', 'UPLOAD_TO_OPENCTI': 'false', 'EMAIL_ENABLED': 'false'
+    })
+    nodes = synthetic_nodes(size)
+    csv_file = os.path.join(workdir, 'tor_nodes.csv')
+    write_nodes_csv(csv_file, nodes)
+    write_snapshot(nodes, snapshot_path(csv_file))
+    # A scrape a minute ago, so the initial background scrape is rate limited (no network)
+    with open(os.path.join(workdir, 'stats.json'), 'w') as f:
+        json.dump({
+            'scrape_history': [{'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - 60)),
+                                'status': 'success'}],
+            'github_history': [], 'opencti_history': [],
+            'node_stats': {'total_nodes': size, 'exit_nodes': 0}
+        }, f)
+
+    phases = {}
+    with timer:
+        start = time.perf_counter()
+        try:
+            import app as app_module
+        except ImportError as e:
+            raise SkipCase(f'app dependencies not installed ({e})')
+        phases['import'] = time.perf_counter() - start
+        scheduler = app_module.setup_schedulers()
+        phases['schedulers'] = time.perf_counter() - start - phases['import']
+        client = app_module.app.test_client()
+        for path in ('/', '/api/stats', f"/api/lookup/{nodes[0]['IP']}"):
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+        phases['first_responses'] = time.perf_counter() - start - phases['import'] - phases['schedulers']
+    scheduler.shutdown(wait=True)
+
+    if response.get_json().get('is_tor') is not True:
+        raise RuntimeError('lookup did not find a persisted node')
+    loaded = [name for name in INTEGRATION_MODULES if name in sys.modules]
+    if loaded:
+        raise RuntimeError(f"disabled integrations were imported at startup: {', '.join(loaded)}")
+    return size, {
+        'stages': {phase: round(seconds, 4) for phase, seconds in phases.items()},
+        'within_target': timer.seconds <= STARTUP_TARGET_SECONDS
+    }
+
+CASES = {
+    'scrape': case_scrape,
+    'rescrape': case_rescrape,
+    'iplist': case_iplist,
+    'opencti': case_opencti,
+    'github': case_github,
+    'lookup': case_lookup,
+    'snapshot': case_snapshot,
+    'enrich': case_enrich,
+    'api': case_api,
+    'startup': case_startup
+}
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+class SkipCase(Exception):
+    pass
+
+class Timer:
+    """Times the measured block and records peak RSS before/after it"""
+
+    def __enter__(self):
+        self.rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return False
+
+def _run_case_in_child(name, size, conn):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix=f'torbench-{name}-')
+    try:
+        timer = Timer()
+        rows, details = CASES[name](size, workdir, timer)
+        conn.send({
+            'status': 'ok',
+            'seconds': round(timer.seconds, 4),
+            'rows_per_second': round(rows / timer.seconds, 1) if timer.seconds else None,
+            'peak_rss_mb': round(timer.rss_after / 1024, 1),
+            'rss_growth_mb': round((timer.rss_after - timer.rss_before) / 1024, 1),
+            'details': details
+        })
+    except SkipCase as e:
+        conn.send({'status': 'skipped', 'message': str(e)})
+    except Exception as e:
+        conn.send({'status': 'error', 'message': f'{type(e).__name__}: {e}'})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        conn.close()
+
+def run_case(name, size, timeout):
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case_in_child, args=(name, size, child_conn))
+    process.start()
+    child_conn.close()
+    if parent_conn.poll(timeout):
+        result = parent_conn.recv()
+    else:
+        process.terminate()
+        result = {'status': 'timeout', 'message': f'exceeded {timeout}s'}
+    process.join()
+    return result
+
+def compare(results, baseline, tolerance):
+    """Return regression messages for results worse than baseline by more than tolerance.
+
+    A case that errored or timed out while its baseline passed is a regression too.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base or base.get('status') != 'ok' or result.get('status') == 'skipped':
+            continue
+        if result.get('status') != 'ok':
+            regressions.append(f"{key}: {result['status']} ({result.get('message', '')})")
+            continue
+        if base.get('rows_per_second') and result['rows_per_second'] < base['rows_per_second'] * (1 - tolerance):
+            regressions.append(
+                f"{key}: throughput {result['rows_per_second']:.0f} rows/s vs baseline {base['rows_per_second']:.0f}"
+            )
+        if base.get('peak_rss_mb') and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(
+                f"{key}: peak memory {result['peak_rss_mb']} MB vs baseline {base['peak_rss_mb']} MB"
+            )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite for the Tor node monitor')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Row counts to benchmark')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=list(CASES), help='Cases to run')
+    parser.add_argument('--timeout', type=int, default=900, help='Seconds before a case is abandoned')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown/memory growth vs baseline')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='Exit non-zero when a case regresses beyond --tolerance or no baseline exists')
+    parser.add_argument('--json', help='Also write results to this JSON file')
+    args = parser.parse_args()
+
+    print("⏱️  Tor Node Monitor Benchmarks")
+    print("=" * 78)
+    print(f"{'case':<10}{'rows':>9}{'seconds':>11}{'rows/s':>13}{'peak MB':>10}{'Δ MB':>9}  status")
+
+    results = {}
+    for name in args.cases:
+        for size in args.sizes:
+            key = f'{name}:{size}'
+            result = run_case(name, size, args.timeout)
+            results[key] = result
+            if result['status'] == 'ok':
+                print(f"{name:<10}{size:>9}{result['seconds']:>11.3f}{result['rows_per_second']:>13.0f}"
+                      f"{result['peak_rss_mb']:>10.1f}{result['rss_growth_mb']:>9.1f}  ok")
+                stages = result['details'].get('stages')
+                if stages:
+                    print(' ' * 12 + ' | '.join(f'{stage} {seconds:.3f}s' for stage, seconds in stages.items()))
+                if 'legacy_seconds' in result['details']:
+                    print(' ' * 12 + f"legacy parser {result['details']['legacy_seconds']:.3f}s")
+                if 'within_target' in result['details']:
+                    print(' ' * 12 + f"startup target {STARTUP_TARGET_SECONDS:.1f}s: "
+                          f"{'met' if result['details']['within_target'] else 'MISSED'}")
+                if 'csv_index_load_s' in result['details']:
+                    print(' ' * 12 + f"snapshot write {result['details']['write_s']:.3f}s | "
+                          f"exit select {result['details']['select_exits_s']:.3f}s | "
+                          f"CSV index load {result['details']['csv_index_load_s']:.3f}s")
+                if 'ipv4_lookups_per_s' in result['details']:
+                    print(' ' * 12 + f"IPv4 {result['details']['ipv4_lookups_per_s']} lookups/s | "
+                          f"IPv6 {result['details']['ipv6_lookups_per_s']} lookups/s")
+            else:
+                print(f"{name:<10}{size:>9}{'-':>11}{'-':>13}{'-':>10}{'-':>9}  {result['status']}: {result.get('message', '')}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({key: result for key, result in results.items() if result['status'] == 'ok'})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\n💾 Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("\nℹ️  No baseline found - run with --save-baseline to record one")
+        return 1 if args.compare else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s) against {args.baseline}:")
+        for regression in regressions:
+            print(f"   - {regression}")
+        return 1 if args.compare else 0
+    print(f"\n✅ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,112 @@
 import os
 import logging
 import smtplib
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 import json
+import threading
+from analytics import ChurnAnalytics
+from report import ReportRollup, render
 
 logger = logging.getLogger(__name__)
 
+# Report sections and their defaults (overridden by email_settings.json)
+DEFAULT_SETTINGS = {
+    'includeNodeStats': True,
+    'includeScrapeHistory': True,
+    'includeGithubHistory': False,
+    'includeOpenctiHistory': False,
+    'includeErrors': True,
+    'includeSystemHealth': False
+}
+# Report window per EMAIL_FREQUENCY
+WINDOW_HOURS = {'daily': 24, 'weekly': 7 * 24}
+
+# email_settings.json path -> (mtime, settings), shared by notifier instances
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+# (server, port, username) -> SMTPSession, shared by notifier instances in this process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+class SMTPSession:
+    """One SMTP connection (STARTTLS + login done once), reused for later messages.
+
+    The connection is dropped after idle_timeout seconds without a message
+    (checked on the next send, or by close_if_idle()), and re-opened once
+    if the server closed it in the meantime.
+    """
+
+    def __init__(self, server, port, username='', password='', idle_timeout=60, timeout=30):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.conn = None
+        self.last_used = 0
+        self.connects = 0
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            # Only use TLS if not on port 25 or 1025 (local test servers)
+            if self.port not in [25, 1025]:
+                conn.starttls()
+            # Only login if credentials are provided
+            if self.username and self.password:
+                conn.login(self.username, self.password)
+        except Exception:
+            conn.close()
+            raise
+        self.conn = conn
+        self.connects += 1
+        logger.info(f"SMTP session opened to {self.server}:{self.port}")
+
+    def _close(self):
+        if self.conn is not None:
+            try:
+                self.conn.quit()
+            except (smtplib.SMTPException, OSError):
+                self.conn.close()
+            self.conn = None
+
+    def send(self, msg):
+        with self.lock:
+            if self.conn is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self._close()
+            for attempt in range(2):
+                if self.conn is None:
+                    self._connect()
+                try:
+                    self.conn.send_message(msg)
+                    break
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Server dropped the idle connection - reconnect once
+                    self.conn = None
+                    if attempt:
+                        raise
+            self.last_used = time.monotonic()
+            self.sent += 1
+
+    def close_if_idle(self):
+        with self.lock:
+            if self.conn is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self._close()
+                logger.info(f"SMTP session to {self.server}:{self.port} closed after {self.idle_timeout}s idle")
+
+    def close(self):
+        with self.lock:
+            self._close()
+
 class EmailNotifier:
-    def __init__(self):
+    def __init__(self, data_dir='/app/data'):
         self.enabled = os.getenv('EMAIL_ENABLED', 'false').lower() == 'true'
         self.smtp_server = os.getenv('EMAIL_SMTP_SERVER', '')
         self.smtp_port = int(os.getenv('EMAIL_SMTP_PORT', '587'))
@@ -18,7 +115,33 @@ class EmailNotifier:
         self.from_email = os.getenv('EMAIL_FROM', '')
         self.to_email = os.getenv('EMAIL_TO', '')
         self.frequency = os.getenv('EMAIL_FREQUENCY', 'daily')
-        self.last_sent_file = '/app/data/last_email_sent.txt'
+        self.data_dir = data_dir
+        self.last_sent_file = os.path.join(data_dir, 'last_email_sent.txt')
+        self.settings_file = os.path.join(data_dir, 'email_settings.json')
+        self.rollup = ReportRollup(data_dir)
+        self.idle_timeout = int(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+    
+    def session(self):
+        """The shared SMTP session for this server and account"""
+        key = (self.smtp_server, self.smtp_port, self.username)
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None or session.password != self.password:
+                session = _sessions[key] = SMTPSession(
+                    self.smtp_server, self.smtp_port, self.username, self.password, self.idle_timeout
+                )
+            return session
+    
+    def send_message(self, subject, text, html, to_email=None):
+        """Send a multipart text + HTML message over the shared session (raises on failure)"""
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        msg['From'] = self.from_email
+        msg['To'] = to_email or self.to_email
+        # Plain text alternative first, HTML last (preferred by clients)
+        msg.attach(MIMEText(text, 'plain', 'utf-8'))
+        msg.attach(MIMEText(html, 'html', 'utf-8'))
+        self.session().send(msg)
     
     def should_send_email(self):
         """Check if email should be sent based on frequency"""
@@ -57,34 +180,13 @@ class EmailNotifier:
         
         try:
             # Prepare email content
-            is_test = stats.get('test', False)
-            if is_test:
+            if stats.get('test', False):
                 subject = f"[TEST] Tor Node Monitor - Test Email"
+                text, html = self.render_test_email()
             else:
-                subject = f"Tor Node Monitor Summary - {datetime.now().strftime('%Y-%m-%d')}"
-            
-            body = self.generate_email_body(stats)
-            
-            # Create message
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = self.from_email
-            msg['To'] = self.to_email
+                subject, text, html = self.render_summary(stats)
             
-            # Add HTML body
-            msg.attach(MIMEText(body, 'html'))
-            
-            # Send email
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                # Only use TLS if not on port 25 or 1025 (local test servers)
-                if self.smtp_port not in [25, 1025]:
-                    server.starttls()
-                
-                # Only login if credentials are provided
-                if self.username and self.password:
-                    server.login(self.username, self.password)
-                
-                server.send_message(msg)
+            self.send_message(subject, text, html)
             
             # Update last sent time (only for non-test emails)
             if not stats.get('test', False):
@@ -98,194 +200,71 @@ class EmailNotifier:
             logger.error(f"Failed to send email: {e}")
             return False
     
-    def generate_email_body(self, stats):
-        """Generate HTML email body"""
-        # Check if this is a test email
-        if stats.get('test', False):
-            return self.generate_test_email_body()
-        
-        # Load email settings to determine what to include
-        import json
-        email_settings_file = '/app/data/email_settings.json'
-        settings = {
-            'includeNodeStats': True,
-            'includeScrapeHistory': True,
-            'includeGithubHistory': False,
-            'includeOpenctiHistory': False,
-            'includeErrors': True,
-            'includeSystemHealth': False
-        }
-        
-        if os.path.exists(email_settings_file):
-            try:
-                with open(email_settings_file, 'r') as f:
-                    saved_settings = json.load(f)
-                    settings.update(saved_settings)
-            except:
-                pass
-        
-        # Get recent history
-        scrape_summary = self.summarize_history(stats.get('scrape_history', []))
-        github_summary = self.summarize_history(stats.get('github_history', []))
-        opencti_summary = self.summarize_history(stats.get('opencti_history', []))
-        
-        # Current node statistics
-        node_stats = stats.get('node_stats', {})
-        
-        # Build email content based on settings
-        html_parts = ["""
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <h2>Tor Node Monitor Weekly Summary</h2>
-            <p>Report generated on {}</p>
-        """.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))]
-        
-        # Node Statistics
-        if settings.get('includeNodeStats', True):
-            html_parts.append(f"""
-            <h3>Current Node Statistics</h3>
-            <table border="1" cellpadding="5" cellspacing="0">
-                <tr>
-                    <td><b>Total Nodes:</b></td>
-                    <td>{node_stats.get('total_nodes', 0)}</td>
-                </tr>
-                <tr>
-                    <td><b>Exit Nodes:</b></td>
-                    <td>{node_stats.get('exit_nodes', 0)}</td>
-                </tr>
-                <tr>
-                    <td><b>Recently Added:</b></td>
-                    <td>{node_stats.get('added_nodes', 0)}</td>
-                </tr>
-                <tr>
-                    <td><b>Recently Removed:</b></td>
-                    <td>{node_stats.get('removed_nodes', 0)}</td>
-                </tr>
-            </table>
-            """)
-        
-        # Operation Summary
-        if any([settings.get('includeScrapeHistory'), settings.get('includeGithubHistory'), 
-                settings.get('includeOpenctiHistory')]):
-            html_parts.append("<h3>Operation Summary (Last 7 Days)</h3>")
-        
-        # Scraping History
-        if settings.get('includeScrapeHistory', True):
-            html_parts.append(f"""
-            <h4>Scraping Operations</h4>
-            <p>Success: {scrape_summary['success']} | Failed: {scrape_summary['error']} | Skipped: {scrape_summary['skipped']}</p>
-            """)
-            if settings.get('includeErrors', True):
-                html_parts.append(self.format_errors(scrape_summary['recent_errors'], 'Scraping'))
-        
-        # GitHub History
-        if settings.get('includeGithubHistory', False):
-            html_parts.append(f"""
-            <h4>GitHub Uploads</h4>
-            <p>Success: {github_summary['success']} | Failed: {github_summary['error']}</p>
-            """)
-            if settings.get('includeErrors', True):
-                html_parts.append(self.format_errors(github_summary['recent_errors'], 'GitHub'))
-        
-        # OpenCTI History
-        if settings.get('includeOpenctiHistory', False):
-            html_parts.append(f"""
-            <h4>OpenCTI Imports</h4>
-            <p>Success: {opencti_summary['success']} | Failed: {opencti_summary['error']}</p>
-            """)
-            if settings.get('includeErrors', True):
-                html_parts.append(self.format_errors(opencti_summary['recent_errors'], 'OpenCTI'))
-        
-        # System Health
-        if settings.get('includeSystemHealth', False):
-            html_parts.append("""
-            <h4>System Health Status</h4>
-            <p>✅ All systems operational</p>
-            <p>Uptime: System running normally</p>
-            """)
-        
-        html_parts.append("""
-            <hr>
-            <p style="font-size: 12px; color: #666;">
-                This is an automated report from the Tor Node Monitor system.
-            </p>
-        </body>
-        </html>
-        """)
-        
-        html = ''.join(html_parts)
-        
-        return html
+    def load_settings(self):
+        """Report sections to include (email_settings.json is re-read only when it changes)"""
+        try:
+            mtime = os.path.getmtime(self.settings_file)
+        except OSError:
+            return dict(DEFAULT_SETTINGS)
+        with _settings_lock:
+            cached = _settings_cache.get(self.settings_file)
+            if not cached or cached[0] != mtime:
+                settings = dict(DEFAULT_SETTINGS)
+                try:
+                    with open(self.settings_file, 'r') as f:
+                        settings.update(json.load(f))
+                except (OSError, ValueError):
+                    pass
+                cached = _settings_cache[self.settings_file] = (mtime, settings)
+            return dict(cached[1])
     
-    def summarize_history(self, history):
-        """Summarize history for the last 24 hours"""
-        summary = {
-            'success': 0,
-            'error': 0,
-            'skipped': 0,
-            'recent_errors': []
-        }
-        
-        cutoff = datetime.now() - timedelta(hours=24)
-        
-        for item in history:
-            try:
-                timestamp = datetime.fromisoformat(item['timestamp'])
-                if timestamp < cutoff:
-                    break
-                
-                status = item.get('status', '')
-                if status == 'success':
-                    summary['success'] += 1
-                elif status == 'error':
-                    summary['error'] += 1
-                    summary['recent_errors'].append({
-                        'time': timestamp.strftime('%H:%M'),
-                        'message': item.get('message', 'Unknown error')
-                    })
-                elif status == 'skipped':
-                    summary['skipped'] += 1
-            except:
-                continue
-        
-        return summary
+    def churn(self, hours):
+        """Relay churn over the report window from the precomputed churn analytics"""
+        analytics = ChurnAnalytics(self.data_dir).summary()
+        if not analytics:
+            return None
+        if hours > 24:
+            churn = dict(analytics.get('rollups', {}).get('7d', {}))
+        else:
+            cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+            runs = [run for run in analytics.get('runs', []) if run['timestamp'] >= cutoff and not run.get('baseline')]
+            churn = {'scrapes': len(runs)}
+            for key in ('added', 'removed', 'exit_promotions', 'exit_demotions'):
+                churn[key] = sum(run.get(key, 0) for run in runs)
+        churn['flapping'] = analytics.get('flapping', {}).get('count', 0)
+        return churn
     
-    def format_errors(self, errors, operation_type):
-        """Format error list for email"""
-        if not errors:
-            return ""
-        
-        html = f"<p style='color: red;'>Recent {operation_type} Errors:</p><ul>"
-        for error in errors[:5]:  # Show max 5 recent errors
-            html += f"<li>{error['time']}: {error['message']}</li>"
-        html += "</ul>"
-        
-        return html
+    def render_summary(self, stats):
+        """Subject, plain text and HTML for the periodic summary"""
+        hours = WINDOW_HOURS.get(self.frequency, 24)
+        # Existing installs: build the rollups from stats.json history once
+        self.rollup.seed({
+            'scrape': stats.get('scrape_history', []),
+            'github': stats.get('github_history', []),
+            'opencti': stats.get('opencti_history', [])
+        })
+        now = datetime.now()
+        context = {
+            'generated_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'period': 'Weekly' if hours > 24 else 'Daily',
+            'window': 'Last 7 Days' if hours > 24 else 'Last 24 Hours',
+            'settings': self.load_settings(),
+            'node_stats': stats.get('node_stats', {}),
+            'jobs': self.rollup.summary(hours),
+            'churn': self.churn(hours)
+        }
+        text, html = render('summary', **context)
+        subject = f"Tor Node Monitor {context['period']} Summary - {now.strftime('%Y-%m-%d')}"
+        return subject, text, html
     
-    def generate_test_email_body(self):
-        """Generate test email body"""
-        html = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <h2>Tor Node Monitor - Test Email</h2>
-            <p>This is a test email from your Tor Node Monitor system.</p>
-            
-            <p><strong>Email Configuration:</strong></p>
-            <ul>
-                <li>SMTP Server: {self.smtp_server}</li>
-                <li>SMTP Port: {self.smtp_port}</li>
-                <li>From: {self.from_email}</li>
-                <li>To: {self.to_email}</li>
-                <li>Authentication: {'Enabled' if self.username else 'Disabled'}</li>
-            </ul>
-            
-            <p><strong>If you received this email, your email configuration is working correctly!</strong></p>
-            
-            <hr>
-            <p style="font-size: 12px; color: #666;">
-                Generated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            </p>
-        </body>
-        </html>
-        """
-        return html
\ No newline at end of file
+    def render_test_email(self):
+        """Plain text and HTML for the test email"""
+        return render(
+            'test',
+            smtp_server=self.smtp_server,
+            smtp_port=self.smtp_port,
+            from_email=self.from_email,
+            to_email=self.to_email,
+            authentication='Enabled' if self.username else 'Disabled',
+            generated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Annotate the IP addresses in a log file or IP list with Tor node data.
+
+The input is read in fixed-size chunks and results are written as they are
+produced, so memory use does not grow with the size of the input.
+
+Usage:
+    python enrich.py access.log                  # Tor matches as CSV
+    python enrich.py --all --format jsonl fw.log # every IP, JSON lines
+    python enrich.py --history proxy.log         # also match IPs that were Tor nodes earlier
+    python enrich.py --port 443 fw.log           # also check each exit's policy for port 443
+    zcat big.log.gz | python enrich.py -
+
+The same engine backs POST /api/enrich.
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import re
+import sys
+
+from ip_list import canonical_ip
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Lines per batch for index refresh and seen-store queries
+BATCH_LINES = 2000
+# Distinct IPs remembered between batches (bounded so memory stays flat)
+CACHE_SIZE = 100000
+
+# Candidates only - every match is validated with inet_pton
+IPV4_CANDIDATE = re.compile(r'(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?![\d.])')
+IPV6_CANDIDATE = re.compile(r'(?<![0-9A-Fa-f:])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}(?![0-9A-Fa-f:])')
+
+FIELDS = ['line', 'ip', 'is_tor', 'is_exit', 'was_tor', 'relays', 'first_seen', 'last_seen', 'seen_count']
+# Extra column when a destination port is given
+PORT_FIELD = 'exit_allows_port'
+
+def iter_lines(stream, chunk_size=CHUNK_SIZE):
+    """Yield decoded lines from a binary stream, reading chunk_size bytes at a time"""
+    remainder = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if remainder:
+        yield remainder.decode('utf-8', 'replace')
+
+def extract_ips(line):
+    """Valid IPv4/IPv6 addresses in a line (canonical form, first occurrence order)"""
+    found = []
+    for pattern in (IPV4_CANDIDATE, IPV6_CANDIDATE):
+        if pattern is IPV6_CANDIDATE and ':' not in line:
+            continue
+        for candidate in pattern.findall(line):
+            ip = canonical_ip(candidate)
+            if ip and ip not in found:
+                found.append(ip)
+    return found
+
+class Enricher:
+    """Matches extracted IPs against the node index and, optionally, the seen store.
+
+    With a port and an ExitPolicyIndex, each row also says whether the exit's
+    policy accepts that port (empty when no policy is known).
+    """
+
+    def __init__(self, node_index, seen_store=None, history=False, include_all=False, exit_policies=None, port=None):
+        self.node_index = node_index
+        self.seen_store = seen_store
+        self.history = history and seen_store is not None
+        self.include_all = include_all
+        self.exit_policies = exit_policies
+        self.port = port if exit_policies is not None else None
+        self.fields = FIELDS + [PORT_FIELD] if self.port is not None else FIELDS
+        self.cache = {}
+        self.stats = {'lines': 0, 'ips': 0, 'tor': 0, 'exit': 0, 'historical': 0}
+
+    def annotate(self, ips):
+        """{ip: annotation} for a batch of distinct IPs, using the cache where possible"""
+        results = {ip: self.cache[ip] for ip in ips if ip in self.cache}
+        missing = [ip for ip in ips if ip not in results]
+        if missing:
+            if len(self.cache) + len(missing) > CACHE_SIZE:
+                self.cache.clear()
+            current = {ip: self.node_index.lookup(ip, refresh=False) for ip in missing}
+            wanted = [ip for ip in missing if current[ip] or self.history]
+            seen = self.seen_store.get_many(wanted) if self.seen_store and wanted else {}
+            for ip in missing:
+                nodes = current[ip]
+                record = seen.get(ip, {})
+                self.cache[ip] = {
+                    'is_tor': bool(nodes),
+                    'is_exit': any(node.get('IsExit') == 'ExitNode' for node in nodes),
+                    'was_tor': not nodes and bool(record),
+                    'relays': ';'.join(node.get('Name', '') for node in nodes if node.get('Name')),
+                    'first_seen': record.get('first_seen', ''),
+                    'last_seen': record.get('last_seen', ''),
+                    'seen_count': record.get('seen_count', 0)
+                }
+                if self.port is not None:
+                    allowed = self.exit_policies.allows(ip, self.port, refresh=False) if nodes else None
+                    self.cache[ip][PORT_FIELD] = '' if allowed is None else allowed
+                results[ip] = self.cache[ip]
+        return results
+
+    def rows(self, lines):
+        """Yield one annotated row per (line, IP) match"""
+        batch = []
+        for line_no, line in enumerate(lines, 1):
+            batch.append((line_no, extract_ips(line)))
+            if len(batch) >= BATCH_LINES:
+                yield from self._process(batch)
+                batch = []
+        if batch:
+            yield from self._process(batch)
+
+    def _process(self, batch):
+        self.node_index.refresh()
+        if self.port is not None:
+            self.exit_policies.refresh()
+        distinct = list(dict.fromkeys(ip for _, ips in batch for ip in ips))
+        annotations = self.annotate(distinct)
+        for line_no, ips in batch:
+            self.stats['lines'] += 1
+            for ip in ips:
+                annotation = annotations[ip]
+                self.stats['ips'] += 1
+                self.stats['tor'] += annotation['is_tor']
+                self.stats['exit'] += annotation['is_exit']
+                self.stats['historical'] += annotation['was_tor']
+                if self.include_all or annotation['is_tor'] or (self.history and annotation['was_tor']):
+                    yield dict(annotation, line=line_no, ip=ip)
+
+def format_rows(rows, output_format='csv', fields=FIELDS):
+    """Serialise rows as CSV (with header) or JSON lines, one string per row"""
+    if output_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when there were no rows
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+def main():
+    from exit_policy import ExitPolicyIndex
+    from node_index import NodeIndex
+    from seen_store import SeenStore
+
+    data_dir = os.getenv('DATA_DIR', '/app/data')
+    parser = argparse.ArgumentParser(description='Annotate IPs in a log file or IP list with Tor node data')
+    parser.add_argument('input', help="log file or IP list ('-' for stdin)")
+    parser.add_argument('--csv', default=os.path.join(data_dir, 'tor_nodes.csv'), help='node CSV')
+    parser.add_argument('--seen-db', default=os.path.join(data_dir, 'seen.db'), help='first/last seen store')
+    parser.add_argument('--history', action='store_true', help='also report IPs that were Tor nodes in earlier scrapes')
+    parser.add_argument('--all', action='store_true', help='report every IP found, not only Tor matches')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    parser.add_argument('--port', type=int, help="also report whether each exit's policy accepts this destination port")
+    parser.add_argument('--exit-policies', default=os.path.join(data_dir, 'exit_policies.json'), help='exit policy index')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    enricher = Enricher(NodeIndex(args.csv), SeenStore(args.seen_db), history=args.history, include_all=args.all,
+                        exit_policies=ExitPolicyIndex(args.exit_policies) if args.port else None, port=args.port)
+
+    stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    try:
+        for text in format_rows(enricher.rows(iter_lines(stream)), args.format, enricher.fields):
+            sys.stdout.write(text)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    print(f"Lines: {enricher.stats['lines']}, IPs: {enricher.stats['ips']}, Tor: {enricher.stats['tor']} "
+          f"(exit: {enricher.stats['exit']}), previously Tor: {enricher.stats['historical']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+from bisect import bisect_right
+from datetime import datetime
+
+from ip_list import canonical_ip
+
+logger = logging.getLogger(__name__)
+
+MAX_PORT = 65535
+
+def merge_intervals(intervals):
+    """Sorted, non-overlapping (lo, hi) port ranges; adjacent ranges are joined"""
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1] = (merged[-1][0], hi)
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def invert(intervals):
+    """Ports 1-65535 not covered by the (merged) ranges"""
+    result, start = [], 1
+    for lo, hi in intervals:
+        if lo > start:
+            result.append((start, lo - 1))
+        start = max(start, hi + 1)
+    if start <= MAX_PORT:
+        result.append((start, MAX_PORT))
+    return result
+
+def intersect(a, b):
+    """Ranges covered by both merged range lists"""
+    result, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        lo, hi = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if lo <= hi:
+            result.append((lo, hi))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+def parse_ports(items):
+    """'80,443,1000-2000' or ['80', '1000-2000'] -> merged (lo, hi) ranges ('*' is every port)"""
+    if isinstance(items, str):
+        items = items.split(',')
+    intervals = []
+    for item in items:
+        item = str(item).strip()
+        if item == '*':
+            intervals.append((1, MAX_PORT))
+            continue
+        lo, _, hi = item.partition('-')
+        try:
+            lo, hi = int(lo), int(hi or lo)
+        except ValueError:
+            continue
+        if 1 <= lo <= hi <= MAX_PORT:
+            intervals.append((lo, hi))
+    return merge_intervals(intervals)
+
+def summary_intervals(summary):
+    """Accepted port ranges of an Onionoo-style summary ({'accept': [...]} or
+    {'reject': [...]}) or a microdescriptor 'accept 80,443' / 'reject 1-65535' line"""
+    if isinstance(summary, str):
+        action, _, ports = summary.strip().partition(' ')
+        summary = {action: ports}
+    if not summary:
+        return []
+    if 'accept' in summary:
+        return parse_ports(summary['accept'])
+    if 'reject' in summary:
+        return invert(parse_ports(summary['reject']))
+    return []
+
+def summarize_rules(rules):
+    """Accepted port ranges of a full exit policy (['accept *:80', 'reject *:*', ...]).
+
+    Like Tor's own policy summaries, only rules for every destination ('*',
+    '*4', '0.0.0.0/0') decide a port; rules for specific networks (e.g.
+    reject private addresses) do not make a port unreachable in general.
+    """
+    undecided = [(1, MAX_PORT)]
+    accepted = []
+    for rule in rules:
+        action, _, target = rule.strip().partition(' ')
+        address, _, ports = target.rpartition(':')
+        if action not in ('accept', 'reject') or address not in ('*', '*4', '0.0.0.0/0'):
+            continue
+        decided = parse_ports(ports)
+        # Ports of this rule that no earlier rule decided
+        matched = intersect(undecided, decided)
+        if action == 'accept':
+            accepted.extend(matched)
+        undecided = intersect(undecided, invert(decided))
+        if not undecided:
+            break
+    return merge_intervals(accepted)
+
+def describe(intervals):
+    """'accept 80,443,1000-2000' for a list of ranges"""
+    if not intervals:
+        return 'reject 1-65535'
+    return 'accept ' + ','.join(str(lo) if lo == hi else f'{lo}-{hi}' for lo, hi in intervals)
+
+def write_exit_policies(policies, path):
+    """Write {ip: [(lo, hi), ...]} atomically; identical policies are stored once"""
+    table, index, ips = [], {}, {}
+    for ip, intervals in policies.items():
+        key = tuple(intervals)
+        if key not in index:
+            index[key] = len(table)
+            table.append([bound for interval in intervals for bound in interval])
+        ips[ip] = index[key]
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'policies': table,
+            'ips': ips
+        }, f)
+    os.replace(tmp_file, path)
+    logger.info(f"Exit policies written: {len(ips)} exit IPs, {len(table)} distinct policies")
+
+class ExitPolicyIndex:
+    """Per-exit accepted port intervals, reloaded when the scraper replaces the file.
+
+    Each distinct policy is compiled once into a tuple of range starts and a
+    tuple of range ends, so a query is a dict lookup plus one bisect.
+    """
+
+    def __init__(self, path='/app/data/exit_policies.json'):
+        self.path = path
+        self.policies = {}
+        self.generated_at = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to load exit policies from {self.path}: {e}")
+                return
+            compiled = [(tuple(bounds[0::2]), tuple(bounds[1::2])) for bounds in data.get('policies', [])]
+            self.policies = {ip: compiled[policy] for ip, policy in data.get('ips', {}).items()}
+            self.generated_at = data.get('generated_at')
+            self.mtime = mtime
+            logger.info(f"Exit policy index loaded: {len(self.policies)} exit IPs, {len(compiled)} distinct policies")
+
+    def allows(self, ip, port, refresh=True):
+        """True/False if the exit policy of ip accepts/rejects port, None if no
+        policy is known for ip (not an exit, or no policy source)"""
+        if refresh:
+            self.refresh()
+        policy = self.policies.get(canonical_ip(ip) or ip)
+        if policy is None:
+            return None
+        starts, ends = policy
+        slot = bisect_right(starts, port) - 1
+        return slot >= 0 and port <= ends[slot]
+
+    def allows_many(self, queries):
+        """[allows(ip, port)] for [(ip, port), ...]"""
+        self.refresh()
+        return [self.allows(ip, port, refresh=False) for ip, port in queries]
+
+    def policy(self, ip):
+        """'accept 80,443' summary for ip, or None"""
+        self.refresh()
+        policy = self.policies.get(canonical_ip(ip) or ip)
+        if policy is None:
+            return None
+        return describe(list(zip(*policy)))
+
+    def __len__(self):
+        self.refresh()
+        return len(self.policies)
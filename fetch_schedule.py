@@ -0,0 +1,158 @@
+import email.utils
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# "You can only fetch the data every 30 minutes" and similar upstream messages
+INTERVAL_PATTERN = re.compile(r'every\s+(\d+)\s*(second|minute|hour)', re.IGNORECASE)
+UNIT_SECONDS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+def parse_timestamp(value):
+    """datetime from a datetime or an ISO string (either separator), or None"""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace(' ', 'T', 1))
+    except ValueError:
+        return None
+
+def parse_interval(text):
+    """Seconds from an "every N minutes" rate-limit message, or None"""
+    match = INTERVAL_PATTERN.search(text or '')
+    if not match:
+        return None
+    return int(match.group(1)) * UNIT_SECONDS[match.group(2).lower()]
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta seconds or HTTP date), or None"""
+    if not value:
+        return None
+    if str(value).strip().isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+class FetchSchedule:
+    """Per-source next-allowed fetch times, shared by every process.
+
+    fetch_schedule.json holds {source: {'next_allowed', 'last_fetch',
+    'backoff', 'reason'}}. A successful fetch allows the next one after
+    SCRAPE_MIN_INTERVAL_MINUTES; a rate-limit response backs off for the
+    interval the upstream asked for, doubling on each consecutive limit up
+    to SCRAPE_MAX_BACKOFF_HOURS. Every slot gets up to SCRAPE_JITTER_SECONDS
+    of random delay so restarts and workers do not all fetch on the boundary.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.state_file = os.path.join(data_dir, 'fetch_schedule.json')
+        self.min_interval = float(os.getenv('SCRAPE_MIN_INTERVAL_MINUTES', '30')) * 60
+        self.jitter = float(os.getenv('SCRAPE_JITTER_SECONDS', '120'))
+        self.max_backoff = float(os.getenv('SCRAPE_MAX_BACKOFF_HOURS', '6')) * 3600
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        """Serialise updates across the scheduler and API worker processes"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with self.lock, open(f'{self.state_file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def _slot(self, seconds):
+        return (datetime.now() + timedelta(seconds=seconds + random.uniform(0, self.jitter))).isoformat(timespec='seconds')
+
+    def record_fetch(self, source):
+        """A fetch from source succeeded: the next one is allowed after the minimum interval"""
+        with self.file_lock():
+            state = self.load()
+            state[source] = {
+                'next_allowed': self._slot(self.min_interval),
+                'last_fetch': datetime.now().isoformat(timespec='seconds'),
+                'backoff': 0,
+                'reason': None
+            }
+            self._save(state)
+
+    def record_rate_limit(self, source, text='', retry_after=None):
+        """source refused a fetch: back off for the interval it asked for (Retry-After,
+        or "every N minutes" in text), doubling for each consecutive refusal"""
+        with self.file_lock():
+            state = self.load()
+            entry = state.get(source) or {'backoff': 0}
+            interval = parse_retry_after(retry_after) or parse_interval(text) or self.min_interval
+            delay = min(interval * 2 ** entry.get('backoff', 0), max(self.max_backoff, interval))
+            entry.update(
+                next_allowed=self._slot(delay),
+                backoff=entry.get('backoff', 0) + 1,
+                reason=(text or 'rate limited')[:200]
+            )
+            state[source] = entry
+            self._save(state)
+        logger.warning(f"Rate limited by {source} - next fetch allowed at {entry['next_allowed']} "
+                       f"(backoff {delay / 60:.0f} min, {entry['backoff']} consecutive)")
+        return entry['next_allowed']
+
+    def seed(self, source, last_fetch):
+        """Allow source's next fetch only after the minimum interval since last_fetch,
+        if nothing is recorded for it yet (data dirs from before this schedule existed)"""
+        last_fetch = parse_timestamp(last_fetch)
+        if last_fetch is None or source in self.load():
+            return
+        with self.file_lock():
+            state = self.load()
+            if source in state:
+                return
+            state[source] = {
+                'next_allowed': (last_fetch + timedelta(seconds=self.min_interval)).isoformat(timespec='seconds'),
+                'last_fetch': last_fetch.isoformat(timespec='seconds'),
+                'backoff': 0,
+                'reason': None
+            }
+            self._save(state)
+
+    def next_slot(self, sources=None):
+        """Earliest time every source (default: all recorded ones) may be fetched again"""
+        state = self.load()
+        slots = [parse_timestamp(entry.get('next_allowed')) for source, entry in state.items()
+                 if sources is None or source in sources]
+        return max([datetime.now()] + [slot for slot in slots if slot])
+
+    def wait_seconds(self, sources=None):
+        """Seconds until next_slot(sources), 0 if a fetch is allowed now"""
+        return max(0.0, (self.next_slot(sources) - datetime.now()).total_seconds())
+
+    def status(self):
+        state = self.load()
+        slot = self.next_slot()
+        return {
+            'next_allowed': slot.isoformat(timespec='seconds'),
+            'wait_seconds': round(max(0.0, (slot - datetime.now()).total_seconds())),
+            'sources': state
+        }
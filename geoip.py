@@ -0,0 +1,264 @@
+import csv
+import ipaddress
+import json
+import logging
+import os
+from bisect import bisect_right
+
+from ip_list import canonical_ip
+
+logger = logging.getLogger(__name__)
+
+# (asn, AS name, country code) for an address no database covers
+UNKNOWN = (None, '', '')
+
+# CSV column names accepted for each field (lower-cased header)
+NETWORK_COLUMNS = ('network', 'cidr', 'prefix')
+START_COLUMNS = ('range_start', 'start_ip', 'first_ip', 'start')
+END_COLUMNS = ('range_end', 'end_ip', 'last_ip', 'end')
+ASN_COLUMNS = ('asn', 'as_number', 'autonomous_system_number')
+AS_NAME_COLUMNS = ('as_name', 'as_org', 'as_description', 'autonomous_system_organization', 'organization')
+COUNTRY_COLUMNS = ('country', 'country_code', 'country_iso_code', 'cc')
+# Column order of header-less files (iptoasn.com ip2asn-combined.tsv)
+HEADERLESS_COLUMNS = ['range_start', 'range_end', 'as_number', 'country_code', 'as_description']
+
+def parse_asn(value):
+    """1234 from 1234, '1234' or 'AS1234'; None for 0 (not routed) or anything else"""
+    if isinstance(value, int):
+        return value or None
+    value = str(value or '').strip().upper()
+    if value.startswith('AS'):
+        value = value[2:]
+    return (int(value) or None) if value.isdigit() else None
+
+def country_code(value):
+    """Two-letter code from a plain value or a MaxMind {'iso_code': ...} record"""
+    if isinstance(value, dict):
+        value = value.get('iso_code')
+    value = str(value or '').strip().upper()
+    # iptoasn marks unknown countries as 'None' / 'ZZ'
+    return value if len(value) == 2 and value != 'ZZ' else ''
+
+def flatten(ranges):
+    """Non-overlapping (start, end, value) ranges from nested ones sorted by (start, -end);
+    inside a range, a more specific (nested) range wins"""
+    flat = []
+    stack = []
+    position = None
+
+    def emit(start, end, value):
+        if start > end:
+            return
+        if flat and flat[-1][2] == value and flat[-1][1] + 1 == start:
+            flat[-1] = (flat[-1][0], end, value)
+        else:
+            flat.append((start, end, value))
+
+    for start, end, value in ranges:
+        while stack and stack[-1][1] < start:
+            _, top_end, top_value = stack.pop()
+            emit(position, top_end, top_value)
+            position = top_end + 1
+        if stack:
+            emit(position, start - 1, stack[-1][2])
+        stack.append((start, end, value))
+        position = start
+    while stack:
+        _, top_end, top_value = stack.pop()
+        emit(position, top_end, top_value)
+        position = top_end + 1
+    return flat
+
+class IntervalTable:
+    """Sorted, non-overlapping address ranges per IP version; lookup is one bisect"""
+
+    def __init__(self, ranges):
+        self.tables = {}
+        for version in (4, 6):
+            flat = flatten(sorted(((start, end, value) for v, start, end, value in ranges if v == version),
+                                  key=lambda item: (item[0], -item[1])))
+            self.tables[version] = ([item[0] for item in flat], [item[1] for item in flat], [item[2] for item in flat])
+
+    def get(self, address):
+        starts, ends, values = self.tables[address.version]
+        number = int(address)
+        slot = bisect_right(starts, number) - 1
+        if slot >= 0 and number <= ends[slot]:
+            return values[slot]
+        return UNKNOWN
+
+    def __len__(self):
+        return sum(len(table[0]) for table in self.tables.values())
+
+def read_csv_database(path):
+    """IntervalTable from a CSV/TSV of prefixes (network) or ranges (start, end) with
+    any of the ASN, AS name and country columns"""
+    interned = {}
+    ranges = []
+    with open(path, 'r', newline='', encoding='utf-8', errors='replace') as f:
+        first = f.readline()
+        f.seek(0)
+        reader = csv.reader(f, delimiter='\t' if '\t' in first else ',')
+        header = next(reader, [])
+        if canonical_ip(header[0].split('/')[0] if header else ''):
+            columns = HEADERLESS_COLUMNS
+            rows = [header]
+        else:
+            columns = [name.strip().lower() for name in header]
+            rows = []
+
+        def column(names):
+            return next((columns.index(name) for name in names if name in columns), None)
+
+        network, start, end = column(NETWORK_COLUMNS), column(START_COLUMNS), column(END_COLUMNS)
+        asn, as_name, country = column(ASN_COLUMNS), column(AS_NAME_COLUMNS), column(COUNTRY_COLUMNS)
+        if network is None and (start is None or end is None):
+            raise ValueError(f'no network or range_start/range_end column in {columns}')
+
+        def field(row, index):
+            return row[index] if index is not None and index < len(row) else ''
+
+        for row in rows + [row for row in reader]:
+            try:
+                if network is not None:
+                    net = ipaddress.ip_network(row[network].strip(), strict=False)
+                    version, low, high = net.version, int(net.network_address), int(net.broadcast_address)
+                else:
+                    low, high = ipaddress.ip_address(row[start].strip()), ipaddress.ip_address(row[end].strip())
+                    version, low, high = low.version, int(low), int(high)
+            except (ValueError, IndexError):
+                continue
+            number = parse_asn(field(row, asn))
+            # An AS name without a number is a placeholder ('Not routed')
+            value = (number, field(row, as_name).strip() if number or asn is None else '', country_code(field(row, country)))
+            if value == UNKNOWN or low > high:
+                continue
+            ranges.append((version, low, high, interned.setdefault(value, value)))
+    return IntervalTable(ranges)
+
+class MMDBDatabase:
+    """MaxMind-format database (GeoLite2/GeoIP2 ASN or Country, ipinfo, ...), read
+    through the optional maxminddb package"""
+
+    def __init__(self, path):
+        import maxminddb
+        self.reader = maxminddb.open_database(path)
+
+    def get(self, address):
+        record = self.reader.get(str(address))
+        if not isinstance(record, dict):
+            return UNKNOWN
+        return (
+            parse_asn(record.get('autonomous_system_number') or record.get('asn')),
+            record.get('autonomous_system_organization') or record.get('as_name') or record.get('as_org') or '',
+            country_code(record.get('country') or record.get('country_code') or record.get('registered_country'))
+        )
+
+class GeoEnricher:
+    """ASN and country per relay IP from local offline databases.
+
+    GEOIP_DATABASES lists the databases (.mmdb files, or CSV/TSV files of
+    prefixes or ranges), queried in order: each field comes from the first
+    database that has it. Results are memoised per IP in geo_cache.json, so
+    a scrape only looks up IPs it has not seen before, and the databases are
+    only opened when there is something to look up. Replacing a database
+    file (new mtime or size) invalidates the cache, and nothing is cached
+    while a configured database fails to load.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.cache_file = os.path.join(data_dir, 'geo_cache.json')
+        self.paths = [path.strip() for path in os.getenv('GEOIP_DATABASES', '').split(',') if path.strip()]
+        self.databases = None
+        # Configured databases that could not be loaded
+        self.failed = []
+        self.stats = {}
+
+    @property
+    def enabled(self):
+        return bool(self.paths)
+
+    def signature(self):
+        """[path, mtime, size] per database, to tell when the cache is stale"""
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signature.append([path, int(stat.st_mtime), stat.st_size])
+            except OSError:
+                signature.append([path, None, None])
+        return signature
+
+    def load_databases(self):
+        databases = []
+        self.failed = []
+        for path in self.paths:
+            try:
+                database = MMDBDatabase(path) if path.endswith('.mmdb') else read_csv_database(path)
+            except ImportError:
+                logger.error(f"GeoIP database {path} needs the maxminddb package: pip install maxminddb")
+                self.failed.append(path)
+                continue
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to load GeoIP database {path}: {e}")
+                self.failed.append(path)
+                continue
+            logger.info(f"GeoIP database loaded: {path}")
+            databases.append(database)
+        return databases
+
+    def load_cache(self, signature):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('databases') != signature:
+            logger.info("GeoIP databases changed - cached lookups discarded")
+            return {}
+        return {ip: tuple(value) for ip, value in cache.get('ips', {}).items()}
+
+    def save_cache(self, signature, ips):
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'databases': signature, 'ips': ips}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def lookup_one(self, ip):
+        asn, as_name, country = UNKNOWN
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return UNKNOWN
+        for database in self.databases:
+            found = database.get(address)
+            asn, as_name, country = asn or found[0], as_name or found[1], country or found[2]
+            if asn and as_name and country:
+                break
+        return (asn, as_name, country)
+
+    def lookup(self, ips):
+        """{ip: (asn, AS name, country code)} for ips; IPs no longer asked for
+        are dropped from the cache"""
+        signature = self.signature()
+        cache = self.load_cache(signature)
+        missing = [ip for ip in ips if ip not in cache]
+        if missing and self.databases is None:
+            self.databases = self.load_databases()
+        results = {ip: cache[ip] for ip in ips if ip in cache}
+        for ip in missing:
+            results[ip] = self.lookup_one(ip)
+        self.stats = {
+            'cached': len(ips) - len(missing),
+            'looked_up': len(missing),
+            'resolved': sum(1 for value in results.values() if value != UNKNOWN)
+        }
+        if self.failed and missing:
+            # Lookups without every database are not memoised, so they are
+            # redone once the databases load (e.g. maxminddb installed)
+            logger.warning(f"GeoIP: {len(self.failed)} database(s) not loaded - lookups not cached")
+        elif missing or len(cache) != len(results):
+            self.save_cache(signature, results)
+        logger.info(f"GeoIP: {self.stats['looked_up']} IPs looked up, {self.stats['cached']} from cache, "
+                    f"{self.stats['resolved']} resolved")
+        return results
@@ -5,6 +5,7 @@ import logging
 from datetime import datetime
 import certifi
 import ssl
+from ip_list import parse_ip_list
 
 # Configure requests to use certifi's certificates
 os.environ['REQUESTS_CA_BUNDLE'] = certifi.where()
@@ -17,6 +18,7 @@ class GitHubUploader:
         self.token = os.getenv('GITHUB_TOKEN', '')
         self.repo = os.getenv('GITHUB_REPO', '')  # format: owner/repo
         self.csv_file = '/app/data/tor_nodes.csv'
+        self.ip_only_file = '/app/data/tor_nodes_IP_only.csv'
         self.api_base = 'https://api.github.com'
         
         if not self.token or not self.repo:
@@ -52,19 +54,21 @@ class GitHubUploader:
         return None
     
     def create_ip_only_csv(self):
-        """Create IP-only CSV file from the main CSV"""
+        """Create IP-only CSV file from the main CSV (IPv4 section, then IPv6 section)"""
         try:
             import pandas as pd
             
             # Read the main CSV
-            df = pd.read_csv(self.csv_file)
+            df = pd.read_csv(self.csv_file, usecols=['IP'], dtype=str)
             
-            # Create IP-only dataframe (just the IP column)
-            ip_only_df = df[['IP']].copy()
+            # Sorted, de-duplicated addresses: all IPv4 first, then all IPv6
+            ip_list = parse_ip_list('\n'.join(df['IP'].dropna()))
+            ip_only_df = pd.DataFrame({'IP': ip_list.ipv4_strings() + ip_list.ipv6_strings()})
             
             # Save IP-only CSV
-            ip_only_path = '/app/data/tor_nodes_IP_only.csv'
+            ip_only_path = self.ip_only_file
             ip_only_df.to_csv(ip_only_path, index=False)
+            logger.info(f"IP-only CSV: {len(ip_list.v4)} IPv4, {ip_list.v6_count} IPv6 addresses")
             
             return ip_only_path
             
@@ -123,7 +127,7 @@ class GitHubUploader:
                 'message': str(e)
             }
 
-    def upload(self):
+    def upload(self, progress=None):
         """Upload only tor_nodes_latest.csv and tor_nodes_IP_only.csv to GitHub"""
         try:
             # Check if main CSV file exists
@@ -146,6 +150,8 @@ class GitHubUploader:
             results.append(latest_result['message'])
             if not latest_result['success']:
                 upload_success = False
+            if progress:
+                progress(50, latest_result['message'])
             
             # 2. Create and upload tor_nodes_IP_only.csv
             ip_only_path = self.create_ip_only_csv()
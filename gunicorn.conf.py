@@ -0,0 +1,17 @@
+import multiprocessing
+import os
+
+# Gunicorn settings for the production API workers (wsgi:app)
+bind = os.getenv('BIND', '0.0.0.0:5002')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', '4'))
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+
+
+def on_starting(server):
+    """Drop metrics files left by this host's previous workers (see metrics.py)"""
+    from metrics import metrics
+    metrics.clear_store()
@@ -0,0 +1,185 @@
+import re
+import socket
+import sys
+from array import array
+
+# dan.me.uk separates entries with newlines and/or <br> tags
+BR_TAG = re.compile(rb'<br\s*/?>', re.IGNORECASE)
+
+class IPList:
+    """Sorted, de-duplicated IPv4/IPv6 addresses in packed form.
+
+    v4 is an array('I') of addresses as integers; v6 is a bytes object of
+    concatenated 16-byte addresses. Both are in ascending numeric order.
+    """
+
+    def __init__(self, v4=None, v6=b'', invalid=0):
+        self.v4 = v4 if v4 is not None else array('I')
+        self.v6 = v6
+        self.invalid = invalid
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6) // 16
+
+    @property
+    def v6_count(self):
+        return len(self.v6) // 16
+
+    def ipv4_strings(self):
+        """IPv4 addresses as dotted-quad strings"""
+        return [socket.inet_ntoa(value.to_bytes(4, 'big')) for value in self.v4]
+
+    def ipv6_strings(self):
+        """IPv6 addresses in canonical (compressed) form"""
+        return [socket.inet_ntop(socket.AF_INET6, self.v6[i:i + 16]) for i in range(0, len(self.v6), 16)]
+
+    def strings(self):
+        """All addresses, IPv4 first"""
+        return self.ipv4_strings() + self.ipv6_strings()
+
+def _parse_tokens(tokens):
+    """inet_pton on each distinct token: (IPv4 integers, packed IPv6, invalid count)"""
+    pton, af_inet, af_inet6 = socket.inet_pton, socket.AF_INET, socket.AF_INET6
+    packed_v4 = []
+    packed_v6 = []
+    invalid = 0
+    for token in tokens:
+        try:
+            if b':' in token:
+                packed_v6.append(pton(af_inet6, token.decode('ascii')))
+            else:
+                packed_v4.append(pton(af_inet, token.decode('ascii')))
+        except (OSError, ValueError):
+            invalid += 1
+    v4 = array('I', b''.join(packed_v4))
+    if sys.byteorder == 'little':
+        v4.byteswap()
+    return sorted(v4), packed_v6, invalid
+
+def _parse_tokens_vectorised(tokens, np):
+    """Same as _parse_tokens, with the IPv4 tokens checked by numpy.
+
+    The distinct tokens are joined into one buffer and every token is
+    walked a byte column at a time, so no Python code runs per IPv4 token.
+    The rules match inet_pton: four 1-3 digit octets up to 255, no leading
+    zeros. Only the tokens containing ':' go through inet_pton.
+    """
+    joined = b'\n'.join(tokens)
+    buf = np.frombuffer(joined, dtype=np.uint8)
+    ends = np.append(np.flatnonzero(buf == 10), len(buf))
+    starts = np.append(0, ends[:-1] + 1)
+
+    is_v6 = np.zeros(len(ends), dtype=bool)
+    is_v6[np.searchsorted(ends, np.flatnonzero(buf == 58))] = True
+    packed_v6 = []
+    invalid = 0
+    pton, af_inet6 = socket.inet_pton, socket.AF_INET6
+    for start, end in zip(starts[is_v6].tolist(), ends[is_v6].tolist()):
+        try:
+            packed_v6.append(pton(af_inet6, joined[start:end].decode('ascii')))
+        except (OSError, ValueError):
+            invalid += 1
+
+    # The longest dotted quad is 15 bytes; column 15 closes the last octet
+    lengths = ends - starts
+    candidates = ~is_v6 & (lengths <= 15)
+    invalid += int(np.count_nonzero(~is_v6)) - int(np.count_nonzero(candidates))
+    starts, lengths = starts[candidates], lengths[candidates]
+    count = len(starts)
+    padded = np.concatenate([buf, np.zeros(16, dtype=np.uint8)])
+    packed = np.zeros(count, dtype=np.uint32)
+    value = np.zeros(count, dtype=np.uint16)
+    digits = np.zeros(count, dtype=np.uint8)
+    dots = np.zeros(count, dtype=np.uint8)
+    bad = np.zeros(count, dtype=bool)
+    for column in range(16):
+        inside = column < lengths
+        char = padded[starts + column]
+        char[~inside] = 0
+        digit = char - np.uint8(48)
+        is_digit = digit < 10
+        is_dot = char == 46
+        closes = is_dot | (column == lengths)
+        bad |= inside & ~(is_digit | is_dot)
+        # A leading zero followed by another digit, or an empty octet
+        bad |= is_digit & (digits == 1) & (value == 0)
+        bad |= closes & (digits == 0)
+        np.copyto(packed, (packed << 8) | value, where=closes)
+        value *= 10
+        value += digit * is_digit
+        value[closes] = 0
+        digits += is_digit
+        digits[closes] = 0
+        bad |= (digits > 3) | (value > 255)
+        dots += is_dot
+    bad |= dots != 3
+    invalid += int(np.count_nonzero(bad))
+    # Without leading zeros distinct tokens are distinct addresses
+    return np.sort(packed[~bad]), packed_v6, invalid
+
+def parse_ip_list(data):
+    """Tokenise a raw torlist response once and pack every valid address.
+
+    Accepts str or bytes. Tokens are split on whitespace and <br> tags and
+    validated like inet_pton (strict dotted-quad IPv4, any IPv6 text form);
+    anything else is counted (once per distinct token) in IPList.invalid.
+    """
+    # Split the raw bytes once and only validate distinct tokens
+    if isinstance(data, str):
+        data = data.encode('ascii', 'replace')
+    data = data.replace(b'<br>', b'\n')
+    if b'<' in data:
+        data = BR_TAG.sub(b'\n', data)
+    tokens = set(data.split())
+    del data
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None and tokens:
+        v4_values, packed_v6, invalid = _parse_tokens_vectorised(tokens, np)
+        v4 = array('I')
+        v4.frombytes(v4_values.astype(np.uint32).tobytes())
+    else:
+        v4_values, packed_v6, invalid = _parse_tokens(tokens)
+        v4 = array('I', v4_values)
+    # Big-endian packed IPv6 bytes sort in numeric order; distinct text forms
+    # of one address are merged here
+    return IPList(v4, b''.join(sorted(set(packed_v6))), invalid)
+
+def pack_ip(ip):
+    """Packed 4-byte (IPv4) or 16-byte (IPv6) key for an address, or None.
+
+    Any textual IPv6 form packs to the same key, so the packed value is
+    what indexes should be keyed on.
+    """
+    try:
+        ip = ip.strip().strip('[]')
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, ValueError, TypeError, AttributeError):
+        return None
+
+def unpack_ip(packed):
+    """Canonical text form of a packed address"""
+    if len(packed) == 16:
+        return socket.inet_ntop(socket.AF_INET6, packed)
+    return socket.inet_ntoa(packed)
+
+def canonical_ip(ip):
+    """Canonical text form (compressed, lower-case IPv6) or None if invalid"""
+    packed = pack_ip(ip)
+    return unpack_ip(packed) if packed is not None else None
+
+def ip_version(ip):
+    """4, 6 or None"""
+    packed = pack_ip(ip)
+    if packed is None:
+        return None
+    return 6 if len(packed) == 16 else 4
+
+def is_valid_ip(ip):
+    """IPv4 or IPv6 check"""
+    return pack_ip(ip) is not None
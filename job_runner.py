@@ -0,0 +1,213 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class JobRunner:
+    """Run manual trigger jobs on a bounded thread pool and track their status.
+
+    When state_dir is set, job records are also written there and each job
+    kind holds an exclusive file lock while it runs, so several API worker
+    processes share job status and never run the same kind twice at once.
+    """
+
+    def __init__(self, max_workers=2, max_jobs=100, state_dir=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_jobs = max_jobs
+        self.state_dir = state_dir
+        self.jobs = OrderedDict()
+        self.active = {}  # kind -> job id of the scheduled/queued/running job
+        self.kind_locks = {}  # kind -> open lock file held while the job is active
+        self.lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.state_dir, f'{job_id}.json')
+
+    def _persist(self, job):
+        """Write the job record for other processes (caller holds self.lock)"""
+        if not self.state_dir:
+            return
+        try:
+            tmp_path = self._job_path(job['id']) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(job, f, default=str)
+            os.replace(tmp_path, self._job_path(job['id']))
+        except Exception as e:
+            logger.error(f"Failed to persist job {job['id']}: {e}")
+
+    def _load(self, job_id):
+        if not self.state_dir or not job_id or not job_id.isalnum():
+            return None
+        try:
+            with open(self._job_path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _claim_kind(self, kind):
+        """Take the cross-process lock for a job kind.
+
+        Returns (lock_file, None) on success or (None, active_job) when another
+        process already runs a job of this kind.
+        """
+        if not self.state_dir:
+            return None, None
+        lock_file = open(os.path.join(self.state_dir, f'{kind}.lock'), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            active_job = self._load(lock_file.read().strip())
+            lock_file.close()
+            return None, active_job or {'id': None, 'kind': kind, 'status': 'running'}
+        return lock_file, None
+
+    def _release_kind(self, kind):
+        lock_file = self.kind_locks.pop(kind, None)
+        if lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def submit(self, kind, func, *args, not_before=None, **kwargs):
+        """Queue func as a job of the given kind.
+
+        With not_before (a datetime), the job is 'scheduled' until then and
+        only takes a pool worker once that time comes, so waiting never
+        blocks other jobs.
+
+        Returns (job, created). If a job of the same kind is already queued,
+        scheduled or running, that job is returned instead of starting a duplicate.
+        """
+        with self.lock:
+            active_id = self.active.get(kind)
+            if active_id:
+                logger.info(f"Job {kind} already in progress ({active_id}) - not starting a duplicate")
+                return dict(self.jobs[active_id]), False
+
+            lock_file, active_job = self._claim_kind(kind)
+            if active_job:
+                logger.info(f"Job {kind} already in progress in another process ({active_job['id']}) - not starting a duplicate")
+                return active_job, False
+
+            job_id = uuid.uuid4().hex
+            delay = (not_before - datetime.now()).total_seconds() if not_before else 0
+            job = {
+                'id': job_id,
+                'kind': kind,
+                'status': 'scheduled' if delay > 0 else 'queued',
+                'not_before': not_before.isoformat(timespec='seconds') if delay > 0 else None,
+                'progress': 0,
+                'message': f"Scheduled for {not_before.strftime('%H:%M:%S')}" if delay > 0 else 'Waiting for a free worker',
+                'result': None,
+                'created_at': datetime.now().isoformat(),
+                'started_at': None,
+                'finished_at': None
+            }
+            self.jobs[job_id] = job
+            self.active[kind] = job_id
+            if lock_file:
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(job_id)
+                lock_file.flush()
+                self.kind_locks[kind] = lock_file
+            self._persist(job)
+
+            # Keep only the most recent jobs
+            while len(self.jobs) > self.max_jobs:
+                oldest_id = next(iter(self.jobs))
+                if oldest_id in self.active.values():
+                    break
+                self.jobs.pop(oldest_id)
+                if self.state_dir:
+                    try:
+                        os.remove(self._job_path(oldest_id))
+                    except OSError:
+                        pass
+
+            snapshot = dict(job)
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._start, (job_id, func, args, kwargs))
+            timer.daemon = True
+            timer.start()
+            logger.info(f"Job {kind} scheduled for {snapshot['not_before']} ({job_id})")
+        else:
+            self.executor.submit(self._run, job_id, func, args, kwargs)
+            logger.info(f"Job {kind} queued ({job_id})")
+        return snapshot, True
+
+    def _start(self, job_id, func, args, kwargs):
+        """Queue a scheduled job once its not_before time has come"""
+        with self.lock:
+            job = self.jobs[job_id]
+            job['status'] = 'queued'
+            job['message'] = 'Waiting for a free worker'
+            self._persist(job)
+        self.executor.submit(self._run, job_id, func, args, kwargs)
+
+    def get(self, job_id):
+        """Return a copy of the job, or None if unknown"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                return dict(job)
+        # The job may belong to another worker process
+        return self._load(job_id)
+
+    def update(self, job_id, progress=None, message=None):
+        """Record progress for a running job"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return
+            if progress is not None:
+                job['progress'] = max(0, min(100, int(progress)))
+            if message is not None:
+                job['message'] = message
+            self._persist(job)
+
+    def _run(self, job_id, func, args, kwargs):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['status'] = 'running'
+            job['message'] = 'Running'
+            job['started_at'] = datetime.now().isoformat()
+            kind = job['kind']
+            self._persist(job)
+
+        def progress(percent, message=None):
+            self.update(job_id, percent, message)
+
+        try:
+            result = func(*args, progress=progress, **kwargs)
+            success = result.get('success', True) if isinstance(result, dict) else True
+            status = 'success' if success else 'error'
+            message = result.get('message', '') if isinstance(result, dict) else ''
+        except Exception as e:
+            logger.error(f"Job {kind} ({job_id}) failed: {e}")
+            result = {'success': False, 'message': str(e)}
+            status = 'error'
+            message = str(e)
+
+        with self.lock:
+            job['status'] = status
+            job['progress'] = 100
+            job['message'] = message
+            job['result'] = result
+            job['finished_at'] = datetime.now().isoformat()
+            self._persist(job)
+            if self.active.get(kind) == job_id:
+                del self.active[kind]
+                self._release_kind(kind)
+
+        logger.info(f"Job {kind} ({job_id}) finished with status {status}")
@@ -0,0 +1,75 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from fetch_schedule import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = 'active'
+DEPARTED = 'departed'
+EXPIRED = 'expired'
+
+def stix_time(value):
+    """RFC 3339 UTC timestamp ('...Z') for a datetime (naive values are local time)"""
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class IndicatorLifecycle:
+    """Validity window and score of an indicator, from the relay's seen history.
+
+    An active relay (in the latest scrape) keeps INDICATOR_BASE_SCORE and is
+    valid from first_seen until INDICATOR_VALID_DAYS past last_seen; that
+    window is only extended once less than INDICATOR_RENEW_DAYS of it is
+    left, so active indicators are not re-pushed on every scrape. A departed
+    relay's window stops at last_seen + INDICATOR_VALID_DAYS and its score
+    halves every INDICATOR_DECAY_HALF_LIFE_DAYS, in steps of
+    INDICATOR_SCORE_STEP. Once the window has passed the indicator is expired
+    and drops to INDICATOR_EXPIRED_SCORE.
+    """
+
+    def __init__(self, now=None):
+        self.now = now or datetime.now()
+        self.base_score = int(os.getenv('INDICATOR_BASE_SCORE', '75'))
+        self.valid_days = float(os.getenv('INDICATOR_VALID_DAYS', '14'))
+        self.renew_days = float(os.getenv('INDICATOR_RENEW_DAYS', str(self.valid_days / 2)))
+        self.half_life = float(os.getenv('INDICATOR_DECAY_HALF_LIFE_DAYS', '7'))
+        self.step = max(1, int(os.getenv('INDICATOR_SCORE_STEP', '5')))
+        self.expired_score = int(os.getenv('INDICATOR_EXPIRED_SCORE', '0'))
+
+    def decayed(self, age_days):
+        score = self.base_score * 0.5 ** (max(0.0, age_days) / self.half_life) if self.half_life > 0 else self.base_score
+        return max(self.expired_score, int(score) // self.step * self.step)
+
+    def evaluate(self, first_seen, last_seen, active, previous=None):
+        """{'state', 'valid_from', 'valid_until', 'score'} for an indicator.
+
+        previous is the lifecycle last pushed for it (or None); an active
+        indicator keeps its pushed valid_until while that is far enough away.
+        """
+        last = parse_timestamp(last_seen) or self.now
+        first = parse_timestamp(first_seen) or last
+        valid_until = last + timedelta(days=self.valid_days)
+        if active:
+            state, score = ACTIVE, self.base_score
+            pushed_until = parse_timestamp((previous or {}).get('valid_until', '').replace('Z', '+00:00'))
+            if (previous or {}).get('state') == ACTIVE and pushed_until is not None:
+                pushed_until = pushed_until.astimezone().replace(tzinfo=None)
+                if pushed_until - self.now >= timedelta(days=self.renew_days):
+                    valid_until = pushed_until
+        elif self.now >= valid_until:
+            state, score = EXPIRED, self.expired_score
+        else:
+            state, score = DEPARTED, self.decayed((self.now - last).total_seconds() / 86400)
+        return {
+            'state': state,
+            'valid_from': stix_time(first),
+            'valid_until': stix_time(valid_until),
+            'score': score
+        }
+
+    @staticmethod
+    def changed(lifecycle, previous):
+        """True if lifecycle differs from what was last pushed"""
+        if not previous:
+            return True
+        return any(lifecycle[key] != previous.get(key) for key in ('state', 'valid_from', 'valid_until', 'score'))
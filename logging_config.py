@@ -0,0 +1,74 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Dashboard pollers and scrapers that would otherwise flood the access log
+ROUTINE_PATHS = ('/api/stats', '/api/jobs/', '/metrics', '/static/')
+
+ACCESS_LINE = re.compile(r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3})')
+
+class AccessLogFilter(logging.Filter):
+    """Sample successful access-log lines for routine endpoints.
+
+    Errors (status >= 400) and requests to other endpoints are always kept.
+    With sample_rate=0 routine requests are suppressed entirely.
+    """
+
+    def __init__(self, sample_rate=0.0, routine_paths=ROUTINE_PATHS):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.routine_paths = routine_paths
+
+    def filter(self, record):
+        match = ACCESS_LINE.search(record.getMessage())
+        if not match:
+            return True
+        if int(match.group('status')) >= 400:
+            return True
+        if not match.group('path').startswith(self.routine_paths):
+            return True
+        return random.random() < self.sample_rate
+
+def setup_logging(log_file='/app/logs/app.log'):
+    """Route all logging through a queue so request threads never block on disk.
+
+    A background QueueListener writes to a size-rotated log file and stderr.
+    An empty log_file logs to stderr only (used by multi-process API workers,
+    which must not rotate the same file). Werkzeug access lines for routine
+    endpoints are sampled according to ACCESS_LOG_SAMPLE_RATE (default 0.01).
+    """
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    handlers = [stream_handler]
+
+    if log_file:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        file_handler = RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+            backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5'))
+        )
+        file_handler.setFormatter(formatter)
+        handlers.insert(0, file_handler)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+
+    sample_rate = float(os.getenv('ACCESS_LOG_SAMPLE_RATE', '0.01'))
+    logging.getLogger('werkzeug').addFilter(AccessLogFilter(sample_rate))
+
+    return listener
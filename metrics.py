@@ -0,0 +1,222 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds (Prometheus histogram "le" bounds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+class Metrics:
+    """Minimal counter/gauge/histogram registry rendered in Prometheus text format.
+
+    With a store_dir, each process (API worker or scheduler) also writes its
+    counters and histograms to metrics-<host>-<pid>.json there, at most every
+    flush_interval seconds, and render() sums the files of all processes, so
+    totals do not depend on which worker answers the scrape. Files of
+    processes that exited are kept, so counters never go backwards. Gauges
+    stay per process.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, store_dir=None, flush_interval=1.0):
+        self.buckets = tuple(buckets)
+        self.counters = {}    # name -> {labels: value}
+        self.gauges = {}      # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self.help = {}
+        self.lock = threading.Lock()
+        self.store_dir = store_dir
+        self.flush_interval = flush_interval
+        self.flushed_at = 0.0
+        self.dirty = False
+        self.pid = os.getpid()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def describe(self, name, text):
+        """Set the HELP text for a metric"""
+        self.help[name] = text
+
+    def store_file(self):
+        return os.path.join(self.store_dir, f'metrics-{socket.gethostname()}-{os.getpid()}.json')
+
+    def _changed(self):
+        """Mark the registry changed and write it out if the last write is old enough (lock held)"""
+        if not self.store_dir:
+            return
+        if os.getpid() != self.pid:
+            # Forked child: the parent's values stay in the parent's file
+            self.pid = os.getpid()
+            self.counters, self.histograms = {}, {}
+        self.dirty = True
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self._flush()
+
+    def _flush(self):
+        """Write this process's counters and histograms to its store file (lock held)"""
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            store_file = self.store_file()
+            tmp_file = f'{store_file}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({
+                    'counters': {name: [[list(map(list, key)), value] for key, value in series.items()]
+                                 for name, series in self.counters.items()},
+                    'histograms': {name: [[list(map(list, key)), counts] for key, counts in series.items()]
+                                   for name, series in self.histograms.items()}
+                }, f)
+            os.replace(tmp_file, store_file)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.store_dir}: {e}")
+        self.flushed_at = time.monotonic()
+        self.dirty = False
+
+    def flush(self):
+        with self.lock:
+            if self.store_dir and self.dirty:
+                self._flush()
+
+    def clear_store(self):
+        """Remove the store files written on this host (call before starting workers)"""
+        if not self.store_dir:
+            return
+        for path in glob.glob(os.path.join(self.store_dir, f'metrics-{socket.gethostname()}-*.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _load_store(self):
+        """Counters and histograms of the other processes' store files"""
+        counters, histograms = {}, {}
+        own_file = self.store_file()
+        for path in glob.glob(os.path.join(self.store_dir, 'metrics-*.json')):
+            if path == own_file:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, series in data.get('counters', {}).items():
+                merged = counters.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(map(tuple, key))
+                    merged[key] = merged.get(key, 0) + value
+            for name, series in data.get('histograms', {}).items():
+                merged = histograms.setdefault(name, {})
+                for key, counts in series:
+                    key = tuple(map(tuple, key))
+                    if len(counts) != len(self.buckets) + 2:
+                        continue
+                    total = merged.setdefault(key, [0] * len(counts))
+                    for i, count in enumerate(counts):
+                        total[i] += count
+        return counters, histograms
+
+    def inc(self, name, labels=None, value=1):
+        """Increment a counter"""
+        key = self._key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._changed()
+
+    def set(self, name, value, labels=None):
+        """Set a gauge"""
+        with self.lock:
+            self.gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        """Record a histogram observation"""
+        key = self._key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+            self._changed()
+
+    @staticmethod
+    def _format_labels(key, extra=None):
+        pairs = list(key) + (extra or [])
+        if not pairs:
+            return ''
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self, extra_gauges=None):
+        """Render all metrics in Prometheus text exposition format.
+
+        extra_gauges is an optional {name: [(labels, value), ...]} mapping
+        computed at scrape time (e.g. from the shared stats.json).
+        """
+        lines = []
+        counters, histograms = self._load_store() if self.store_dir else ({}, {})
+        with self.lock:
+            for name, series in self.counters.items():
+                merged = counters.setdefault(name, {})
+                for key, value in series.items():
+                    merged[key] = merged.get(key, 0) + value
+            for name, series in self.histograms.items():
+                merged = histograms.setdefault(name, {})
+                for key, counts in series.items():
+                    total = merged.setdefault(key, [0] * len(counts))
+                    for i, count in enumerate(counts):
+                        total[i] += count
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+
+        for name, series in (extra_gauges or {}).items():
+            for labels, value in series:
+                gauges.setdefault(name, {})[self._key(labels)] = value
+
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(metrics):
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(metrics[name].items()):
+                    lines.append(f'{name}{self._format_labels(key)} {value}')
+
+        for name in sorted(histograms):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, counts in sorted(histograms[name].items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{name}_bucket{self._format_labels(key, [("le", bound)])} {count}')
+                lines.append(f'{name}_bucket{self._format_labels(key, [("le", "+Inf")])} {counts[-1]}')
+                lines.append(f'{name}_sum{self._format_labels(key)} {counts[-2]}')
+                lines.append(f'{name}_count{self._format_labels(key)} {counts[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+# Process-wide registry, shared between processes through METRICS_DIR (empty: this process only)
+metrics = Metrics(store_dir=os.getenv('METRICS_DIR', os.path.join(os.getenv('DATA_DIR', '/app/data'), 'metrics')) or None)
+atexit.register(metrics.flush)
+metrics.describe('http_requests_total', 'HTTP requests by endpoint, method and status')
+metrics.describe('http_request_duration_seconds', 'HTTP request latency by endpoint and method')
+metrics.describe('job_runs_total', 'Scrape/GitHub/OpenCTI job runs by status')
+metrics.describe('job_duration_seconds', 'Scrape/GitHub/OpenCTI job duration')
+metrics.describe('job_last_duration_seconds', 'Duration of the most recent run of each job (shared across processes)')
+metrics.describe('scrape_stage_duration_seconds', 'Scrape time per stage (fetch, parse, merge, seen, detail_apply, read, write, snapshot, wait, total)')
+metrics.describe('scrape_bytes_fetched_total', 'Bytes downloaded from the upstream site by scrapes')
+metrics.describe('scrape_rows_processed_total', 'Rows parsed by scrapes')
+metrics.describe('tor_nodes', 'Current number of Tor nodes')
+metrics.describe('tor_exit_nodes', 'Current number of Tor exit nodes')
+metrics.describe('tor_ipv6_nodes', 'Current number of Tor nodes listed with an IPv6 address')
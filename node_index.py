@@ -0,0 +1,93 @@
+import csv
+import logging
+import os
+import threading
+from ip_list import pack_ip
+from snapshot import NodeSnapshot, snapshot_path, typed_row
+
+logger = logging.getLogger(__name__)
+
+class NodeIndex:
+    """IP index over the node data, reloaded when the scraper replaces it.
+
+    Lookups go to the binary snapshot the scraper writes with every CSV
+    save (see snapshot.py). It is memory-mapped, so every API worker shares
+    one copy in the page cache and a new scrape is picked up by re-mapping
+    instead of re-parsing. Workers never build the snapshot themselves;
+    the scraper writes it and the scheduler rebuilds it at startup when it
+    is missing or outdated (snapshot.ensure_snapshot).
+
+    If no snapshot can be mapped (e.g. a read-only data directory) the
+    index falls back to a per-process dict keyed on packed addresses (4 or
+    16 bytes), so any textual form of an address still finds the same rows.
+    """
+
+    def __init__(self, csv_file='/app/data/tor_nodes.csv'):
+        self.csv_file = csv_file
+        self.snapshot = NodeSnapshot(snapshot_path(csv_file))
+        self.use_snapshot = False
+        self.nodes = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Map the current snapshot (one stat when unchanged), or reload the CSV
+        fallback if no snapshot can be mapped and the CSV has changed"""
+        if self.snapshot.refresh():
+            if not self.use_snapshot:
+                self.use_snapshot = True
+                self.nodes = {}
+            return
+        try:
+            mtime = os.path.getmtime(self.csv_file)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime != self.mtime:
+                self._load_csv(mtime)
+
+    def _load_csv(self, mtime):
+        nodes = {}
+        try:
+            with open(self.csv_file, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    key = pack_ip(row.get('IP', ''))
+                    if key is not None:
+                        # Same field types as rows decoded from the snapshot
+                        nodes.setdefault(key, []).append(typed_row(row))
+        except Exception as e:
+            logger.error(f"Failed to load node index from {self.csv_file}: {e}")
+            return
+        self.use_snapshot = False
+        self.nodes = nodes
+        self.mtime = mtime
+        ipv6 = sum(1 for key in nodes if len(key) == 16)
+        logger.info(f"Node index loaded from CSV: {len(nodes)} IPs ({ipv6} IPv6)")
+
+    def lookup(self, ip, refresh=True):
+        """Return the node rows for an IP (empty list if it is not a Tor node).
+
+        Bulk callers can pass refresh=False after calling refresh() once per batch.
+        """
+        if refresh:
+            self.refresh()
+        if self.use_snapshot:
+            return self.snapshot.lookup(ip)
+        key = pack_ip(ip)
+        if key is None:
+            return []
+        return self.nodes.get(key, [])
+
+    def select(self, **filters):
+        """Filtered rows from the snapshot (see NodeSnapshot.select), or None
+        when only the CSV fallback is available"""
+        self.refresh()
+        if not self.use_snapshot:
+            return None
+        return self.snapshot.select(**filters)
+
+    def __len__(self):
+        self.refresh()
+        return self.snapshot.ips() if self.use_snapshot else len(self.nodes)
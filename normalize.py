@@ -0,0 +1,134 @@
+import html
+import re
+from functools import lru_cache
+
+# dan.me.uk flag letters -> bit
+FLAG_BITS = {
+    'A': 1 << 0,   # Authority
+    'B': 1 << 1,   # BadExit
+    'D': 1 << 2,   # V2Dir
+    'E': 1 << 3,   # Exit
+    'F': 1 << 4,   # Fast
+    'G': 1 << 5,   # Guard
+    'H': 1 << 6,   # HSDir
+    'N': 1 << 7,   # Named
+    'R': 1 << 8,   # Running
+    'S': 1 << 9,   # Stable
+    'U': 1 << 10,  # Unnamed
+    'V': 1 << 11,  # Valid
+}
+FLAG_NAMES = {
+    'A': 'Authority', 'B': 'BadExit', 'D': 'V2Dir', 'E': 'Exit', 'F': 'Fast', 'G': 'Guard',
+    'H': 'HSDir', 'N': 'Named', 'R': 'Running', 'S': 'Stable', 'U': 'Unnamed', 'V': 'Valid'
+}
+
+VERSION = re.compile(r'(\d+)\.(\d+)\.(\d+)(?:\.(\d+))?')
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+URL = re.compile(r'https?://[^\s<>"\']+', re.IGNORECASE)
+# ContactInfo sharing spec fields (email:user[]example.org url:... abuse:...)
+CIISS_FIELD = re.compile(r'\b(email|url|abuse):(\S+)', re.IGNORECASE)
+AT = re.compile(r'\s*(?:\[at\]|\(at\)|\{at\}|\s+at\s+)\s*', re.IGNORECASE)
+DOT = re.compile(r'\s*(?:\[dot\]|\(dot\)|\{dot\}|\s+dot\s+)\s*', re.IGNORECASE)
+
+def parse_uptime(value):
+    """Uptime in seconds as an int, or None"""
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+@lru_cache(maxsize=1024)
+def flags_mask(flags):
+    """Bitmask of the flag letters (unknown letters are ignored)"""
+    mask = 0
+    for letter in flags or '':
+        mask |= FLAG_BITS.get(letter, 0)
+    return mask
+
+def flag_names(mask):
+    """Flag names set in a bitmask"""
+    return [FLAG_NAMES[letter] for letter, bit in FLAG_BITS.items() if mask & bit]
+
+def parse_flag_filter(text):
+    """Bitmask from flag letters ('GE') or comma-separated names ('Guard,Exit')"""
+    by_name = {name.lower(): FLAG_BITS[letter] for letter, name in FLAG_NAMES.items()}
+    names = [name.strip().lower() for name in text.split(',') if name.strip()]
+    if names and all(name in by_name for name in names):
+        return sum(by_name[name] for name in set(names))
+    return flags_mask(text.upper())
+
+def parse_version(value):
+    """'Tor 0.4.8.13' -> (0, 4, 8, 13); None if there is no version number"""
+    match = VERSION.search(value or '')
+    if not match:
+        return None
+    return tuple(int(part) for part in match.groups(default='0'))
+
+@lru_cache(maxsize=1024)
+def version_code(version):
+    """Integer that sorts like the version tuple (each component < 1000)"""
+    if isinstance(version, str):
+        version = parse_version(version)
+    if not version:
+        return None
+    code = 0
+    for part in (tuple(version) + (0, 0, 0, 0))[:4]:
+        code = code * 1000 + min(part, 999)
+    return code
+
+def deobfuscate(text):
+    """Undo common address obfuscation ('user [at] host [dot] org', 'user[]host.org')"""
+    text = AT.sub('@', text)
+    text = DOT.sub('.', text)
+    return text.replace('[]', '@')
+
+@lru_cache(maxsize=65536)
+def parse_contact(raw):
+    """Unescape a contact string and extract email, url and abuse tokens.
+
+    Returns (contact, email, url, abuse); missing tokens are ''. Cached
+    because relay families share the same contact string.
+    """
+    contact = html.unescape(raw or '').strip()
+    fields = {}
+    for name, value in CIISS_FIELD.findall(contact):
+        fields.setdefault(name.lower(), value)
+
+    email = deobfuscate(fields['email']) if 'email' in fields else ''
+    abuse = deobfuscate(fields['abuse']) if 'abuse' in fields else ''
+    url = fields.get('url', '')
+
+    if not email or not url:
+        plain = deobfuscate(contact)
+        if not email:
+            match = EMAIL.search(plain)
+            email = match.group(0) if match else ''
+        if not url:
+            match = URL.search(contact)
+            url = match.group(0) if match else ''
+    if not abuse and email.lower().startswith('abuse@'):
+        abuse = email
+    if url and '://' not in url:
+        url = f'https://{url}'
+    return contact, email, url, abuse
+
+def normalize_details(details):
+    """Typed columns for a detail line, stored as CSV text.
+
+    Uptime becomes a plain integer ('' if unknown), Flags gain FlagsMask,
+    Version gains VersionCode (see version_code) and Contact is unescaped
+    with ContactEmail/ContactUrl/ContactAbuse extracted.
+    """
+    uptime = parse_uptime(details.get('Uptime'))
+    code = version_code(details.get('Version'))
+    contact, email, url, abuse = parse_contact(details.get('Contact', ''))
+    details.update({
+        'Uptime': str(uptime) if uptime is not None else '',
+        'FlagsMask': str(flags_mask(details.get('Flags'))),
+        'VersionCode': str(code) if code is not None else '',
+        'Contact': contact,
+        'ContactEmail': email,
+        'ContactUrl': url,
+        'ContactAbuse': abuse
+    })
+    return details
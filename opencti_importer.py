@@ -2,6 +2,10 @@ import csv
 import logging
 import os
 from pycti import OpenCTIApiClient
+from lifecycle import IndicatorLifecycle
+from opencti_ledger import ImportLedger
+from opencti_payloads import PayloadBuilder, build_payload
+from seen_store import SeenStore
 
 # Configure logger to inherit from root logger
 logger = logging.getLogger(__name__)
@@ -24,6 +28,14 @@ class OpenCTIImporter:
         logger.info(f"Initializing OpenCTI connection to {self.api_url}")
         self.client = OpenCTIApiClient(self.api_url, self.api_key)
         self.organization_name = "PeeBee"
+        # Names, descriptions and patterns are built before the network loop
+        self.payloads = PayloadBuilder(os.path.dirname(self.csv_file))
+        # Objects carry deterministic STIX ids, so the ledger can skip what the server already has
+        self.ledger = ImportLedger(os.path.dirname(self.csv_file), self.api_url)
+        # first_seen / last_seen per IP, for the indicator lifecycle
+        self.seen_store = SeenStore(os.path.join(os.path.dirname(self.csv_file), 'seen.db'))
+        # Lifecycle-only indicator updates are pushed in batches; the ledger is saved after each
+        self.batch_size = max(1, int(os.getenv('OPENCTI_BATCH_SIZE', '500')))
     
     def create_organization(self):
         """Create or update an Organisation named 'PeeBee'."""
@@ -40,74 +52,60 @@ class OpenCTIImporter:
             logger.error(f"Error creating organization: {str(e)}")
             raise
 
-    def create_ipv4(self, ip, peebee_id):
-        """Create (or update) an IPv4 observable."""
+    def create_ip_observable(self, payload, peebee_id):
+        """Create (or update) an IPv4-Addr or IPv6-Addr observable, upserted by its STIX id."""
+        observable_type = payload['observable_type']
         try:
             observable = self.client.stix_cyber_observable.create(
                 observableData={
-                    'type': 'IPv4-Addr',
-                    'value': ip
+                    'id': payload['observable_id'],
+                    'type': observable_type,
+                    'value': payload['ip']
                 },
                 createdById=peebee_id,
                 update=True
             )
-            logger.debug(f"Created/Updated IPv4: {observable}")
+            logger.debug(f"Created/Updated {observable_type}: {observable}")
             return observable
         except Exception as e:
-            logger.error(f"Error creating IPv4 {ip}: {str(e)}")
+            logger.error(f"Error creating {observable_type} {payload['ip']}: {str(e)}")
             return None
 
-    def create_indicator(self, ip_data, peebee_id):
-        """Create (or update) an Indicator for the IP data."""
-        # Determine indicator name based on IsExit
-        exit_node_value = ip_data.get("IsExit", "").strip().lower()
-        if exit_node_value in ["exitnode", "true", "yes", "1"]:
-            indicator_name = f"TOR Exit Node - {ip_data.get('IP')}"
-        else:
-            indicator_name = f"TOR Node - {ip_data.get('IP')}"
-
-        # Build description
-        description = (
-            f"TOR Node Information:\n"
-            f"IP: {ip_data.get('IP')}\n"
-            f"IsExit: {ip_data.get('IsExit')}\n"
-            f"Name: {ip_data.get('Name')}\n"
-            f"OnionPort: {ip_data.get('OnionPort')}\n"
-            f"DirPort: {ip_data.get('DirPort')}\n"
-            f"Flags: {ip_data.get('Flags')}\n"
-            f"Uptime: {ip_data.get('Uptime')}\n"
-            f"Version: {ip_data.get('Version')}\n"
-            f"Contact: {ip_data.get('Contact')}\n"
-            f"CollectionDate: {ip_data.get('CollectionDate')}"
-        )
-
-        # Create STIX pattern
-        ip_value = ip_data.get("IP", "")
-        stix_pattern = f"[ipv4-addr:value = '{ip_value}']"
+    def create_indicator(self, payload, peebee_id, lifecycle):
+        """Create (or update) an Indicator from a prebuilt payload (see opencti_payloads)
+        with its lifecycle (validity window and score, see lifecycle.py).
 
+        A payload without a description (lifecycle-only update) leaves the
+        description on the server as it is."""
+        fields = {'description': payload['description']} if payload.get('description') else {}
         try:
             indicator = self.client.indicator.create(
-                name=indicator_name,
-                description=description,
-                pattern=stix_pattern,
+                stix_id=payload['indicator_id'],
+                name=payload['name'],
+                pattern=payload['pattern'],
                 pattern_type="stix",
-                x_opencti_main_observable_type="IPv4-Addr",
-                x_opencti_score=75,
+                x_opencti_main_observable_type=payload['observable_type'],
+                valid_from=lifecycle['valid_from'],
+                valid_until=lifecycle['valid_until'],
+                x_opencti_score=lifecycle['score'],
                 createdById=peebee_id,
-                update=True
+                update=True,
+                **fields
             )
             logger.debug(f"Created/Updated indicator: {indicator}")
             return indicator
         except Exception as e:
-            logger.error(f"Error creating indicator for IP {ip_value}: {str(e)}")
+            logger.error(f"Error creating indicator for IP {payload['ip']}: {str(e)}")
             return None
 
-    def create_relationship(self, indicator, ipv4, peebee_id):
-        """Create (or update) a 'based-on' relationship."""
+    def create_relationship(self, payload, peebee_id):
+        """Create (or update) a 'based-on' relationship between the payload's
+        indicator and observable, referenced by their STIX ids."""
         try:
             relationship = self.client.stix_core_relationship.create(
-                fromId=indicator["id"],
-                toId=ipv4["id"],
+                stix_id=payload['relationship_id'],
+                fromId=payload['indicator_id'],
+                toId=payload['observable_id'],
                 relationship_type="based-on",
                 description="Indicator based on IP observable",
                 createdById=peebee_id,
@@ -119,7 +117,27 @@ class OpenCTIImporter:
             logger.error(f"Error creating relationship: {str(e)}")
             return None
 
-    def import_nodes(self):
+    def push_lifecycles(self, updates, peebee_id, progress=None):
+        """Push lifecycle-only updates [(payload, lifecycle)] in batches.
+        Returns (updated, errors)"""
+        updated = errors = 0
+        for start in range(0, len(updates), self.batch_size):
+            for payload, lifecycle in updates[start:start + self.batch_size]:
+                indicator = self.create_indicator(payload, peebee_id, lifecycle)
+                if indicator and "id" in indicator:
+                    self.ledger.record_lifecycle(payload['indicator_id'], lifecycle)
+                    updated += 1
+                else:
+                    errors += 1
+            # Checkpoint: an interrupted import does not push these again
+            self.ledger.save()
+            done = min(start + self.batch_size, len(updates))
+            logger.info(f"📈 Indicator lifecycle updates: {done}/{len(updates)} pushed ({errors} errors)")
+            if progress:
+                progress(done * 100.0 / len(updates), f"{done}/{len(updates)} indicator lifecycle updates pushed")
+        return updated, errors
+
+    def import_nodes(self, progress=None):
         """Import all nodes from CSV to OpenCTI"""
         from datetime import datetime
         import_start_time = datetime.now()
@@ -129,11 +147,17 @@ class OpenCTIImporter:
         logger.info(f"📅 Import started at: {import_start_time.strftime('%Y-%m-%d %H:%M:%S UTC')}")
         
         try:
-            # Count total rows first
+            # Group relay rows by IP - one observable/indicator per IP
+            relays_by_ip = {}
             with open(self.csv_file, 'r', encoding='utf-8') as f:
-                total_rows = sum(1 for line in f) - 1  # Subtract header
+                for row in csv.DictReader(f):
+                    ip = row.get("IP", "").strip()
+                    if ip:
+                        relays_by_ip.setdefault(ip, []).append(row)
+            total_rows = len(relays_by_ip)
             
             logger.info(f"📊 Found {total_rows} Tor nodes to import to OpenCTI")
+            payloads = self.payloads.build(relays_by_ip)
             
             # Test OpenCTI API availability first
             logger.info("🔍 Testing OpenCTI API connectivity...")
@@ -199,49 +223,89 @@ class OpenCTIImporter:
             
             imported_count = 0
             error_count = 0
+            unchanged_count = 0
+            self.ledger.load()
+            lifecycle = IndicatorLifecycle()
+            # Indicators pushed before whose relay is no longer listed
+            current_ids = {payload['indicator_id'] for payload in payloads.values() if payload}
+            departed = {entry['ip']: (indicator_id, entry) for indicator_id, entry in self.ledger.entries.items()
+                        if indicator_id not in current_ids and entry.get('ip')}
+            seen = self.seen_store.get_many(list(payloads) + list(departed))
+            lifecycle_updates = []
             
             # Start the import job
             logger.info(f"📋 IMPORT JOB STARTED: Processing {total_rows} entries")
             logger.info(f"📤 Starting import of {total_rows} Tor nodes to OpenCTI...")
             
-            # Read CSV and create objects
-            with open(self.csv_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for i, row in enumerate(reader, 1):
-                    ip = row.get("IP", "").strip()
-                    if not ip:
+            # Create objects per IP
+            for i, (ip, payload) in enumerate(payloads.items(), 1):
+                
+                # Log progress every 100 nodes
+                if i % 100 == 0:
+                    progress_percent = (i / total_rows * 100) if total_rows > 0 else 0
+                    logger.info(f"📈 OpenCTI import progress: {i}/{total_rows} nodes processed ({progress_percent:.1f}% complete, {imported_count} imported, {unchanged_count} unchanged, {error_count} errors)")
+                    if progress:
+                        progress(progress_percent, f"{i}/{total_rows} nodes processed ({imported_count} imported, {unchanged_count} unchanged, {error_count} errors)")
+                
+                if payload is None:
+                    logger.error(f"Not a valid IP address: {ip}")
+                    error_count += 1
+                    continue
+                record = seen.get(ip, {})
+                previous = self.ledger.entry(payload['indicator_id'])
+                state = lifecycle.evaluate(record.get('first_seen'), record.get('last_seen'), True, previous)
+                if self.ledger.unchanged(payload):
+                    if lifecycle.changed(state, previous):
+                        lifecycle_updates.append((payload, state))
+                    else:
+                        unchanged_count += 1
+                    continue
+                
+                try:
+                    # Create IPv4/IPv6 observable
+                    ip_observable = self.create_ip_observable(payload, peebee_id)
+                    if not ip_observable or "id" not in ip_observable:
+                        error_count += 1
                         continue
                     
-                    # Log progress every 100 nodes
-                    if i % 100 == 0:
-                        progress_percent = (i / total_rows * 100) if total_rows > 0 else 0
-                        logger.info(f"📈 OpenCTI import progress: {i}/{total_rows} nodes processed ({progress_percent:.1f}% complete, {imported_count} imported, {error_count} errors)")
-                    
-                    try:
-                        # Create IPv4 observable
-                        ipv4_observable = self.create_ipv4(ip, peebee_id)
-                        if not ipv4_observable or "id" not in ipv4_observable:
-                            error_count += 1
-                            continue
-                        
-                        # Create Indicator
-                        indicator = self.create_indicator(row, peebee_id)
-                        if not indicator or "id" not in indicator:
-                            error_count += 1
-                            continue
-                        
-                        # Create relationship
-                        self.create_relationship(indicator, ipv4_observable, peebee_id)
-                        imported_count += 1
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing IP {ip}: {e}")
+                    # Create Indicator
+                    indicator = self.create_indicator(payload, peebee_id, state)
+                    if not indicator or "id" not in indicator:
                         error_count += 1
+                        continue
+                    
+                    # Create relationship
+                    if self.create_relationship(payload, peebee_id):
+                        self.ledger.record(payload, state)
+                    imported_count += 1
+                    
+                except Exception as e:
+                    logger.error(f"Error processing IP {ip}: {e}")
+                    error_count += 1
+            self.ledger.save()
             
+            # Departed relays: the window stops growing and the score decays
+            for ip, (indicator_id, entry) in departed.items():
+                record = seen.get(ip)
+                if not record:
+                    continue
+                state = lifecycle.evaluate(record['first_seen'], record['last_seen'], False, entry)
+                if lifecycle.changed(state, entry):
+                    payload = build_payload(ip, [{'IP': ip}])
+                    if payload and payload['indicator_id'] == indicator_id:
+                        lifecycle_updates.append((dict(payload, name=entry.get('name') or payload['name'], description=None), state))
+            
+            # Changed lifecycles only, whether or not the node itself changed
+            logger.info(f"🔁 {len(lifecycle_updates)} indicator lifecycle updates ({len(departed)} departed relays tracked)")
+            lifecycle_count, lifecycle_errors = self.push_lifecycles(lifecycle_updates, peebee_id, progress)
+            error_count += lifecycle_errors
+        
             # Final summary with detailed server confirmation
             import_end_time = datetime.now()
             total_duration = import_end_time - import_start_time
-            success_rate = (imported_count / total_rows * 100) if total_rows > 0 else 0
+            # Nodes the ledger shows the server already has count as successful
+            succeeded = max(0, total_rows - error_count)
+            success_rate = (succeeded / total_rows * 100) if total_rows > 0 else 0
             
             # Log job completion summary
             logger.info(f"📋 IMPORT JOB COMPLETED: Processed {total_rows} entries")
@@ -252,17 +316,17 @@ class OpenCTIImporter:
             
             if error_count == 0:
                 logger.info(f"🎉 OpenCTI import completed successfully!")
-                logger.info(f"✅ JOB SUMMARY: Successfully processed {total_rows} entries - All {imported_count} nodes imported")
+                logger.info(f"✅ JOB SUMMARY: Successfully processed {total_rows} entries - {imported_count} nodes imported, {unchanged_count} unchanged")
                 logger.info(f"✅ OpenCTI server confirmed acceptance of all {imported_count} nodes")
-                logger.info(f"📊 Success rate: {success_rate:.1f}% ({imported_count}/{total_rows})")
-                message = f"Successfully imported {imported_count} nodes to {self.api_url}"
+                logger.info(f"📊 Success rate: {success_rate:.1f}% ({succeeded}/{total_rows})")
+                message = f"Successfully imported {imported_count} nodes to {self.api_url} ({unchanged_count} unchanged, {lifecycle_count} lifecycle updates)"
             else:
                 logger.info(f"⚠️  OpenCTI import completed with some errors")
-                logger.info(f"📋 JOB SUMMARY: Processed {total_rows} entries - {imported_count} imported, {error_count} failed")
+                logger.info(f"📋 JOB SUMMARY: Processed {total_rows} entries - {imported_count} imported, {unchanged_count} unchanged, {error_count} failed")
                 logger.info(f"✅ OpenCTI server confirmed acceptance of {imported_count} nodes")
                 logger.info(f"❌ OpenCTI server rejected {error_count} nodes")
-                logger.info(f"📊 Success rate: {success_rate:.1f}% ({imported_count}/{total_rows})")
-                message = f"Imported {imported_count} nodes to {self.api_url} ({error_count} errors)"
+                logger.info(f"📊 Success rate: {success_rate:.1f}% ({succeeded}/{total_rows})")
+                message = f"Imported {imported_count} nodes to {self.api_url} ({unchanged_count} unchanged, {lifecycle_count} lifecycle updates, {error_count} errors)"
             
             logger.info(f"🏆 Final result: Import job completed - Data transmitted to OpenCTI server {self.api_url}")
             
@@ -270,7 +334,10 @@ class OpenCTIImporter:
                 'success': True,
                 'message': message,
                 'imported': imported_count,
-                'errors': error_count
+                'errors': error_count,
+                'unchanged': unchanged_count,
+                'lifecycle_updates': lifecycle_count,
+                'payloads': self.payloads.stats
             }
             
         except Exception as e:
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class ImportLedger:
+    """What the OpenCTI server already holds, keyed by deterministic STIX id.
+
+    opencti_ledger.json maps each indicator id to the last pushed state:
+    {'hash', 'ip', 'name', 'state', 'valid_from', 'valid_until', 'score'}.
+    'hash' is the content hash of the payload (observable and relationship
+    ids derive from the same IP, so the indicator id stands for all three),
+    the rest is the indicator lifecycle. An import skips payloads whose hash
+    is unchanged and only updates indicators whose lifecycle changed. The
+    ledger is tied to the server URL; pointing the importer at another server
+    starts from an empty ledger. OPENCTI_FULL_SYNC=true ignores it and
+    pushes everything.
+    """
+
+    def __init__(self, data_dir='/app/data', server=''):
+        self.ledger_file = os.path.join(data_dir, 'opencti_ledger.json')
+        self.server = server
+        self.full_sync = os.getenv('OPENCTI_FULL_SYNC', 'false').lower() == 'true'
+        self.entries = None
+
+    def load(self):
+        try:
+            with open(self.ledger_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get('server') != self.server:
+            data = {}
+        # Ledgers written before lifecycles were tracked hold only the hash
+        self.entries = {
+            indicator_id: entry if isinstance(entry, dict) else {'hash': entry}
+            for indicator_id, entry in data.get('indicators', {}).items()
+        }
+        return self.entries
+
+    def entry(self, indicator_id):
+        if self.entries is None:
+            self.load()
+        return self.entries.get(indicator_id)
+
+    def unchanged(self, payload):
+        """True if the server already has this payload (same id, same content)"""
+        entry = self.entry(payload['indicator_id'])
+        return not self.full_sync and entry is not None and entry.get('hash') == payload['hash']
+
+    def record(self, payload, lifecycle):
+        """Record a pushed payload and its lifecycle"""
+        if self.entries is None:
+            self.load()
+        self.entries[payload['indicator_id']] = dict(lifecycle, hash=payload['hash'], ip=payload['ip'], name=payload['name'])
+
+    def record_lifecycle(self, indicator_id, lifecycle):
+        """Record a lifecycle-only update of an indicator already in the ledger"""
+        self.entries[indicator_id].update(lifecycle)
+
+    def save(self):
+        if self.entries is None:
+            return
+        tmp_file = f'{self.ledger_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'server': self.server,
+                'updated_at': datetime.now().isoformat(timespec='seconds'),
+                'indicators': self.entries
+            }, f)
+        os.replace(tmp_file, self.ledger_file)
+        logger.info(f"OpenCTI ledger saved: {len(self.entries)} indicators")
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ip_list import ip_version
+
+logger = logging.getLogger(__name__)
+
+# Observable type and STIX pattern object per IP version
+OBSERVABLE_TYPES = {4: 'IPv4-Addr', 6: 'IPv6-Addr'}
+STIX_PATTERN_TYPES = {4: 'ipv4-addr', 6: 'ipv6-addr'}
+
+# STIX 2.1 namespace for deterministic (UUIDv5) ids, as used by OpenCTI/pycti
+STIX_NAMESPACE = uuid.UUID('00abedb4-aa42-466c-9c01-fed23315a9b7')
+
+# Row fields a payload is built from; a node whose fields are unchanged reuses its payload
+PAYLOAD_FIELDS = ['IP', 'IsExit', 'Name', 'OnionPort', 'DirPort', 'Flags', 'Uptime', 'Version', 'Contact',
+                  'CollectionDate', 'ASN', 'ASName', 'Country']
+# Bump when build_payload changes, so cached payloads are rebuilt
+PAYLOAD_VERSION = 2
+
+def content_hash(relays):
+    """Hash of the payload fields of every relay row of an IP"""
+    digest = hashlib.blake2b(str(PAYLOAD_VERSION).encode(), digest_size=16)
+    for relay in relays:
+        digest.update('\x1f'.join(relay.get(field) or '' for field in PAYLOAD_FIELDS).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+def stix_id(object_type, properties):
+    """Deterministic STIX id: UUIDv5 over the canonical JSON of the id-contributing
+    properties, so the same object always gets the same id"""
+    canonical = json.dumps(properties, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return f'{object_type}--{uuid.uuid5(STIX_NAMESPACE, canonical)}'
+
+def is_exit(row):
+    return (row.get('IsExit') or '').strip().lower() in ('exitnode', 'true', 'yes', '1')
+
+def build_payload(ip, relays):
+    """Observable and indicator fields for one IP (every relay row of it), or None
+    if ip is not a valid address. Pure: depends only on the rows"""
+    version = ip_version(ip)
+    if not version:
+        return None
+    row = relays[0]
+    description = (
+        f"TOR Node Information:\n"
+        f"IP: {row.get('IP')}\n"
+        f"IsExit: {row.get('IsExit')}\n"
+        f"Name: {row.get('Name')}\n"
+        f"OnionPort: {row.get('OnionPort')}\n"
+        f"DirPort: {row.get('DirPort')}\n"
+        f"Flags: {row.get('Flags')}\n"
+        f"Uptime: {row.get('Uptime')}\n"
+        f"Version: {row.get('Version')}\n"
+        f"Contact: {row.get('Contact')}\n"
+        f"CollectionDate: {row.get('CollectionDate')}"
+    )
+    if row.get('ASN'):
+        description += f"\nASN: AS{row.get('ASN')}" + (f" ({row.get('ASName')})" if row.get('ASName') else '')
+    if row.get('Country'):
+        description += f"\nCountry: {row.get('Country')}"
+    if len(relays) > 1:
+        description += "\nRelays on this IP: " + ", ".join(
+            f"{relay.get('Name')} (ORPort {relay.get('OnionPort')})" for relay in relays
+        )
+    pattern = f"[{STIX_PATTERN_TYPES[version]}:value = '{ip}']"
+    observable_id = stix_id(STIX_PATTERN_TYPES[version], {'value': ip})
+    indicator_id = stix_id('indicator', {'pattern': pattern})
+    return {
+        'ip': ip,
+        'observable_type': OBSERVABLE_TYPES[version],
+        'observable_id': observable_id,
+        'indicator_id': indicator_id,
+        'relationship_id': stix_id('relationship', {
+            'relationship_type': 'based-on', 'source_ref': indicator_id, 'target_ref': observable_id
+        }),
+        'name': f"TOR Exit Node - {row.get('IP')}" if is_exit(row) else f"TOR Node - {row.get('IP')}",
+        'description': description,
+        'pattern': pattern
+    }
+
+def build_shard(shard):
+    """[(hash, payload)] for a shard of (hash, ip, relays); runs in a worker process.
+    Each payload carries its content hash, which the import ledger records"""
+    results = []
+    for key, ip, relays in shard:
+        payload = build_payload(ip, relays)
+        if payload is not None:
+            payload['hash'] = key
+        results.append((key, payload))
+    return results
+
+class PayloadBuilder:
+    """Builds OpenCTI payloads ahead of the import, so the network loop only sends them.
+
+    Payloads are cached in opencti_payloads.json by the content hash of the
+    node's rows; only nodes whose rows changed are rebuilt. Rebuilds are split
+    into shards of OPENCTI_PAYLOAD_SHARD_SIZE IPs and, when there is more than
+    one shard, built in a pool of OPENCTI_PAYLOAD_WORKERS processes.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.cache_file = os.path.join(data_dir, 'opencti_payloads.json')
+        self.workers = int(os.getenv('OPENCTI_PAYLOAD_WORKERS', '0')) or os.cpu_count() or 1
+        self.shard_size = max(1, int(os.getenv('OPENCTI_PAYLOAD_SHARD_SIZE', '2000')))
+        self.stats = {}
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def build(self, relays_by_ip):
+        """{ip: payload (or None for an invalid IP)} for {ip: [relay rows]}"""
+        cache = self.load_cache()
+        keys = {ip: content_hash(relays) for ip, relays in relays_by_ip.items()}
+        missing = [(key, ip, [{field: relay.get(field) for field in PAYLOAD_FIELDS} for relay in relays_by_ip[ip]])
+                   for ip, key in keys.items() if key not in cache]
+        shards = [missing[i:i + self.shard_size] for i in range(0, len(missing), self.shard_size)]
+
+        built = {}
+        if len(shards) > 1 and self.workers > 1:
+            # Workers only run build_shard (no locks, no logging), so forking from
+            # the job thread is safe
+            try:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(shards))) as pool:
+                    for results in pool.map(build_shard, shards):
+                        built.update(results)
+            except (OSError, BrokenProcessPool) as e:
+                logger.warning(f"Payload process pool unavailable ({e}) - building in-process")
+        for shard in shards:
+            if shard[0][0] not in built:
+                built.update(build_shard(shard))
+
+        # Keep only the current nodes' payloads
+        previous = len(cache)
+        cache = {key: built[key] if key in built else cache[key] for key in keys.values()}
+        if built or previous != len(cache):
+            self.save_cache(cache)
+        self.stats = {'nodes': len(keys), 'cached': len(keys) - len(missing), 'built': len(missing), 'shards': len(shards)}
+        logger.info(f"OpenCTI payloads: {self.stats['built']} built in {len(shards)} shard(s), {self.stats['cached']} from cache")
+        return {ip: cache[key] for ip, key in keys.items()}
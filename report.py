@@ -0,0 +1,174 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+# Recent errors kept per job
+MAX_ERRORS = 20
+COUNTERS = ['success', 'error', 'skipped', 'runs', 'added', 'removed']
+
+def hour_key(timestamp):
+    """'YYYY-MM-DDTHH' bucket for a datetime or ISO string (sorts chronologically)"""
+    return iso_timestamp(timestamp)[:13]
+
+def iso_timestamp(timestamp):
+    """ISO string for a datetime, or for a datetime that json.dump(default=str) wrote"""
+    if isinstance(timestamp, datetime):
+        return timestamp.isoformat()
+    return str(timestamp).replace(' ', 'T', 1)
+
+@lru_cache(maxsize=1)
+def template_environment():
+    """Jinja environment for the email templates; compiled templates are cached in it"""
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        autoescape=select_autoescape(['html']),
+        trim_blocks=True,
+        lstrip_blocks=True
+    )
+
+def render(name, **context):
+    """Render templates/email/<name>.txt and <name>.html -> (text, html)"""
+    environment = template_environment()
+    return (
+        environment.get_template(f'{name}.txt').render(**context),
+        environment.get_template(f'{name}.html').render(**context)
+    )
+
+class ReportRollup:
+    """Per-job hourly rollups for the summary email, updated as history entries arrive.
+
+    report_state.json holds {job: {'hours': {hour: counters}, 'errors': [...]}}
+    for the last REPORT_RETENTION_DAYS days, so building a report sums at
+    most a week of hourly buckets instead of parsing the whole history.
+    """
+
+    def __init__(self, data_dir='/app/data'):
+        self.state_file = os.path.join(data_dir, 'report_state.json')
+        self.retention_days = int(os.getenv('REPORT_RETENTION_DAYS', '8'))
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        """Serialise updates across the scheduler and API worker processes"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with self.lock, open(f'{self.state_file}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _fold(self, state, job, entry):
+        timestamp = entry.get('timestamp') or datetime.now()
+        status = entry.get('status', '')
+        job_state = state.setdefault(job, {'hours': {}, 'errors': []})
+        bucket = job_state['hours'].setdefault(hour_key(timestamp), dict.fromkeys(COUNTERS, 0))
+        bucket['runs'] += 1
+        if status in ('success', 'error', 'skipped'):
+            bucket[status] += 1
+        bucket['added'] += entry.get('nodes_added', 0) or 0
+        bucket['removed'] += entry.get('nodes_removed', 0) or 0
+        if 'duration_seconds' in entry:
+            bucket['timed'] = bucket.get('timed', 0) + 1
+            bucket['duration_total'] = bucket.get('duration_total', 0) + entry['duration_seconds']
+            bucket['duration_max'] = max(bucket.get('duration_max', 0), entry['duration_seconds'])
+        if entry.get('timings'):
+            bucket['staged'] = bucket.get('staged', 0) + 1
+            stages = bucket.setdefault('stages', {})
+            for stage, seconds in entry['timings'].items():
+                stages[stage] = stages.get(stage, 0) + seconds
+        if status == 'error':
+            job_state['errors'].insert(0, {
+                'timestamp': iso_timestamp(timestamp),
+                'message': entry.get('message') or 'Unknown error'
+            })
+            del job_state['errors'][MAX_ERRORS:]
+
+    def _prune(self, state):
+        cutoff = hour_key(datetime.now() - timedelta(days=self.retention_days))
+        for job_state in state.values():
+            for hour in [hour for hour in job_state['hours'] if hour < cutoff]:
+                del job_state['hours'][hour]
+
+    def record(self, job, entry):
+        """Fold one history entry (as written to stats.json) into the rollups"""
+        with self.file_lock():
+            state = self.load()
+            self._fold(state, job, entry)
+            self._prune(state)
+            self._save(state)
+
+    def seed(self, histories):
+        """Build the rollups from existing {job: [entries, newest first]} if there are
+        none yet. Returns False (and does nothing) if they already exist"""
+        if os.path.exists(self.state_file):
+            return False
+        with self.file_lock():
+            if os.path.exists(self.state_file):
+                return False
+            state = {}
+            cutoff = hour_key(datetime.now() - timedelta(days=self.retention_days))
+            for job, history in histories.items():
+                state.setdefault(job, {'hours': {}, 'errors': []})
+                for entry in reversed(history):
+                    if hour_key(entry.get('timestamp', '')) >= cutoff:
+                        self._fold(state, job, entry)
+            self._save(state)
+            logger.info(f"Report rollups seeded from history: {sum(len(h) for h in histories.values())} entries")
+            return True
+
+    def summary(self, hours):
+        """Totals per job over the last `hours` hours"""
+        cutoff = hour_key(datetime.now() - timedelta(hours=hours))
+        error_cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+        summary = {}
+        for job, job_state in self.load().items():
+            totals = dict.fromkeys(COUNTERS, 0)
+            timed = staged = duration_total = duration_max = 0
+            stages = {}
+            for hour, bucket in job_state['hours'].items():
+                if hour < cutoff:
+                    continue
+                for counter in COUNTERS:
+                    totals[counter] += bucket.get(counter, 0)
+                timed += bucket.get('timed', 0)
+                staged += bucket.get('staged', 0)
+                duration_total += bucket.get('duration_total', 0)
+                duration_max = max(duration_max, bucket.get('duration_max', 0))
+                for stage, seconds in bucket.get('stages', {}).items():
+                    stages[stage] = stages.get(stage, 0) + seconds
+            totals.update({
+                'avg_duration': round(duration_total / timed, 1) if timed else None,
+                'max_duration': round(duration_max, 1) if timed else None,
+                # Average seconds per stage over the runs that reported timings, slowest first
+                'stages': [
+                    {'stage': stage, 'seconds': round(seconds / staged, 2)}
+                    for stage, seconds in sorted(stages.items(), key=lambda item: -item[1])
+                    if stage != 'total'
+                ] if staged else [],
+                'recent_errors': [error for error in job_state['errors'] if error['timestamp'] >= error_cutoff][:5]
+            })
+            summary[job] = totals
+        return summary
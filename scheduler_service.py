@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Scheduler process for production deployments.
+
+Runs the scrape, GitHub, OpenCTI and email jobs without serving HTTP, so the
+API can be scaled out separately with gunicorn (see wsgi.py).
+"""
+import logging
+import time
+from app import setup_schedulers
+
+logger = logging.getLogger('scheduler_service')
+
+if __name__ == '__main__':
+    scheduler = setup_schedulers()
+    logger.info("Scheduler service running")
+    try:
+        while True:
+            time.sleep(60)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.shutdown()
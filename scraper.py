@@ -1,45 +1,131 @@
 import requests
 import csv
-from datetime import datetime, date
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 import os
 import re
 import time
 import logging
+from ip_list import parse_ip_list, canonical_ip, ip_version
+from seen_store import SeenStore
+from anomaly import AnomalyDetector
+from fetch_schedule import FetchSchedule
+from sources import SourceData, SourceMerge, configured_sources, format_provenance, load_source, parse_provenance, utcnow
+from normalize import normalize_details
+from snapshot import snapshot_path, write_snapshot
+from exit_policy import write_exit_policies
+from geoip import UNKNOWN, GeoEnricher
 
 logger = logging.getLogger(__name__)
 
+# Upstream rate-limit page text, e.g. "You can only fetch the data every 30 minutes"
+RATE_LIMIT_MESSAGE = re.compile(r'only fetch the data every\s+\d+\s*\w+', re.IGNORECASE)
+
+def address_key(row):
+    """(IP, ORPort, Name) - identifies a relay when no fingerprint is known"""
+    return (row.get('IP', ''), row.get('OnionPort', ''), row.get('Name', ''))
+
+def relay_key(row):
+    """Relay identity: the fingerprint when known, otherwise (IP, ORPort, Name)"""
+    fingerprint = row.get('Fingerprint', '')
+    if fingerprint:
+        return ('fingerprint', fingerprint)
+    return ('address',) + address_key(row)
+
+def source_name(url):
+    """Rate-limit key for a URL (host, path and query)"""
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else '')
+
 class TorNodeScraper:
     def __init__(self, csv_file='/app/data/tor_nodes.csv'):
         self.base_url = os.getenv('TOR_SCRAPE_SITE', 'https://www.dan.me.uk')
         self.details_url = f'{self.base_url}/tornodes'
         self.csv_file = csv_file
         self.data_file = '/app/data/node_data.txt'
-        self.headers = ['IP', 'IsExit', 'Name', 'OnionPort', 'DirPort', 'Flags', 'Uptime', 'Version', 'Contact', 'CollectionDate']
-        self.stats = {'total_nodes': 0, 'exit_nodes': 0, 'new_nodes': 0, 'updated_nodes': 0, 'removed_nodes': 0, 'detail_errors': 0}
+        self.seen_store = SeenStore(os.path.join(os.path.dirname(csv_file), 'seen.db'))
+        self.anomaly = AnomalyDetector(os.path.dirname(csv_file))
+        self.schedule = FetchSchedule(os.path.dirname(csv_file))
+        # Accepted port ranges per exit IP, for the port-reachability queries
+        self.policy_file = os.path.join(os.path.dirname(csv_file), 'exit_policies.json')
+        self.geo = GeoEnricher(os.path.dirname(csv_file))
+        # Rate-limited upstream sources; a scrape only starts when all of them may be fetched
+        self.sources = [source_name(url) for url in (f'{self.base_url}/torlist/?full', f'{self.base_url}/torlist/?exit', self.details_url)]
+        # One row per relay; an IP running several relays has several rows.
+        # FlagsMask, VersionCode and Contact* are typed columns derived at parse time.
+        # Sources lists the sources that listed the IP, Provenance the source of each field.
+        # ASN, ASName and Country come from the local GeoIP databases (see geoip.py)
+        self.headers = ['IP', 'IsExit', 'Name', 'OnionPort', 'DirPort', 'Flags', 'Uptime', 'Version', 'Contact', 'CollectionDate', 'Fingerprint',
+                        'FlagsMask', 'VersionCode', 'ContactEmail', 'ContactUrl', 'ContactAbuse', 'Sources', 'Provenance',
+                        'ASN', 'ASName', 'Country']
+        # Extra node sources merged with dan.me.uk (see sources.py)
+        self.extra_sources = configured_sources()
+        self.source_max_age = timedelta(hours=float(os.getenv('SOURCE_MAX_AGE_HOURS', '6')))
+        self.dan = None
+        self.merge = None
+        # IP -> source of the winning exit opinion, from stage 2 for stage 4
+        self.exit_sources = {}
+        # Stage 1 node set and seen-store update, committed by stage 2
+        self.pending = None
+        # Node rows after stage 4, for the aggregates
+        self.rows = None
+        self.stats = {'total_nodes': 0, 'total_relays': 0, 'exit_nodes': 0, 'ipv6_nodes': 0, 'new_nodes': 0, 'updated_nodes': 0, 'removed_nodes': 0, 'detail_errors': 0}
+        # Seconds spent per stage (fetch, parse, merge, seen, detail_apply, geo, read, write, wait)
+        self.timings = {}
+        self.bytes_fetched = 0
+        self.rows_processed = 0
+        # Set when an older CSV layout was loaded, so stage 1 rewrites it
+        self.schema_migrated = False
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
 
+    @contextmanager
+    def timed(self, stage):
+        """Add the wall-clock time of the block (monotonic clock) to self.timings[stage]"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
 
     def fetch_url(self, url, max_retries=3):
+        with self.timed('fetch'):
+            return self._fetch_url(url, max_retries)
+
+    def _fetch_url(self, url, max_retries):
+        if url.startswith('file://'):
+            # Replay from fixtures: file:///dir/torlist/?full reads /dir/torlist/full
+            parts = urlsplit(url)
+            with open(os.path.join(parts.path, parts.query) if parts.query else parts.path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            self.bytes_fetched += len(content)
+            return content
+        source = source_name(url)
         for attempt in range(max_retries):
             try:
                 response = self.session.get(url, timeout=10)
+                self.bytes_fetched += len(response.content)
                 
                 # Check for rate limiting (403 Forbidden often indicates rate limiting)
                 if response.status_code == 403:
-                    logger.warning("Rate limited by server (403 Forbidden) - can only fetch data every 30 minutes")
-                    raise Exception("RATE_LIMITED: Server returned 403 Forbidden. You can only fetch data every 30 minutes. Please wait before trying again.")
+                    retry_after = getattr(response, 'headers', {}).get('Retry-After')
+                    next_allowed = self.schedule.record_rate_limit(source, 'HTTP 403 Forbidden', retry_after=retry_after)
+                    raise Exception(f"RATE_LIMITED: Server returned 403 Forbidden. Next fetch allowed at {next_allowed}.")
                 
                 response.raise_for_status()
                 
-                # Check for rate limiting message in content
+                # Check for rate limiting message in content ("You can only fetch the data every 30 minutes")
                 content = response.text
-                if "You can only fetch the data every 30 minutes" in content:
-                    logger.warning("Rate limited by server - can only fetch data every 30 minutes")
-                    raise Exception("RATE_LIMITED: Server allows fetching data only every 30 minutes. Please wait before trying again.")
+                match = RATE_LIMIT_MESSAGE.search(content)
+                if match:
+                    next_allowed = self.schedule.record_rate_limit(source, match.group(0))
+                    raise Exception(f"RATE_LIMITED: {match.group(0)}. Next fetch allowed at {next_allowed}.")
                 
+                self.schedule.record_fetch(source)
                 return content
             except requests.RequestException as e:
                 # Don't retry if it's a rate limit error
@@ -51,36 +137,78 @@ class TorNodeScraper:
                 continue
         return None
 
+    def collect_sources(self):
+        """Fetch and parse the extra sources concurrently and set up the merge
+        (dan.me.uk first, so it wins timestamp ties)"""
+        self.dan = SourceData('dan', 'dan', self.base_url, published=utcnow())
+        extra = []
+        if self.extra_sources:
+            with self.timed('sources'):
+                with ThreadPoolExecutor(max_workers=len(self.extra_sources), thread_name_prefix='source') as pool:
+                    extra = list(pool.map(lambda source: load_source(*source, session=self.session), self.extra_sources))
+            self.bytes_fetched += sum(source.bytes for source in extra)
+        self.merge = SourceMerge([self.dan] + extra, max_age=self.source_max_age)
+
     def stage1_collect_all_nodes(self):
         logger.info("Stage 1: Collecting All Nodes")
+        if self.merge is None:
+            self.collect_sources()
         all_nodes_text = self.fetch_url(f'{self.base_url}/torlist/?full')
         if not all_nodes_text:
             raise Exception("Failed to collect all nodes")
 
-        all_nodes = set(re.split(r'[\n<br>]+', all_nodes_text.strip()))
-        all_nodes = {ip.strip() for ip in all_nodes if ip.strip() and self.is_valid_ip(ip.strip())}
+        with self.timed('parse'):
+            # IPv4 and IPv6 relays, in canonical text form
+            ip_list = parse_ip_list(all_nodes_text)
+            self.dan.listed = dict.fromkeys(ip_list.strings(), self.dan.published)
+        self.rows_processed += len(self.dan.listed)
         
         existing_data = self.load_csv()
-        existing_ips = {row.get('IP', '') for row in existing_data}
         
-        today = date.today().isoformat()
-        self.stats['total_nodes'] = len(all_nodes)
-        self.stats['new_nodes'] = len(all_nodes - existing_ips)
-        self.stats['removed_nodes'] = len(existing_ips - all_nodes)
-
-        updated_data = []
-        for ip in all_nodes:
-            node_data = next((row for row in existing_data if row.get('IP', '') == ip), None)
-            if node_data:
-                node_data['CollectionDate'] = today
-                updated_data.append(node_data)
-            else:
-                updated_data.append({
-                    'IP': ip, 'IsExit': '', 'Name': '', 'OnionPort': '', 'DirPort': '', 
-                    'Flags': '', 'Uptime': '', 'Version': '', 'Contact': '', 'CollectionDate': today
-                })
-
-        self.save_csv(updated_data)
+        with self.timed('merge'):
+            # Node set: every IP a usable source lists (dan.me.uk plus extra sources)
+            listed = self.merge.membership()
+            all_nodes = set(listed)
+            existing_by_ip = {row.get('IP', ''): row for row in existing_data}
+            existing_ips = set(existing_by_ip)
+            
+            today = date.today().isoformat()
+            new_ips = all_nodes - existing_ips
+            removed_ips = existing_ips - all_nodes
+            self.stats['total_nodes'] = len(all_nodes)
+            self.stats['ipv6_nodes'] = sum(1 for ip in all_nodes if ':' in ip)
+            self.stats['new_nodes'] = len(new_ips)
+            self.stats['removed_nodes'] = len(removed_ips)
+
+            # Existing rows keep their order and their CollectionDate (the
+            # date the node was first collected); new nodes are appended
+            updated_data = []
+            sources_changed = 0
+            for row in existing_data:
+                ip = row.get('IP', '')
+                if ip in removed_ips:
+                    continue
+                sources = ';'.join(listed[ip])
+                if row.get('Sources') != sources:
+                    row['Sources'] = sources
+                    sources_changed += 1
+                updated_data.append(row)
+            for ip in sorted(new_ips):
+                updated_data.append(self.new_row(ip, today, Sources=';'.join(listed[ip])))
+
+        # Nothing is recorded or saved if the node set looks like a partial page
+        self.anomaly.check_nodes(len(all_nodes), len(new_ips), len(removed_ips), previous_total=len(existing_ips))
+
+        # Held until stage 2 has checked the exit count too, so a scrape that
+        # fails either check leaves the CSV and seen store untouched
+        self.pending = {
+            'rows': updated_data,
+            'changed': bool(new_ips or removed_ips or sources_changed or self.schema_migrated),
+            'nodes': all_nodes,
+            'seen_at': datetime.now().isoformat(timespec='seconds'),
+            # Nodes collected before the store existed start from their CollectionDate
+            'first_seen': {ip: row.get('CollectionDate') for ip, row in existing_by_ip.items()}
+        }
         logger.info(f"Stage 1 complete: {self.stats['total_nodes']} nodes")
 
     def stage2_update_exit_nodes(self):
@@ -89,18 +217,51 @@ class TorNodeScraper:
         if not exit_nodes_text:
             raise Exception("Failed to collect exit nodes")
 
-        exit_nodes = set(re.split(r'[\n<br>]+', exit_nodes_text.strip()))
-        exit_nodes = {ip.strip() for ip in exit_nodes if ip.strip() and self.is_valid_ip(ip.strip())}
-        self.stats['exit_nodes'] = len(exit_nodes)
+        with self.timed('parse'):
+            exit_nodes = set(parse_ip_list(exit_nodes_text).strings())
+        self.rows_processed += len(exit_nodes)
+        if self.merge is None:
+            self.collect_sources()
 
-        existing_data = self.load_csv()
-        for row in existing_data:
-            if row.get('IP', '') in exit_nodes:
-                row['IsExit'] = 'ExitNode'
-            else:
-                row['IsExit'] = ''
+        pending = self.pending
+        existing_data = pending['rows'] if pending else self.load_csv()
+        with self.timed('merge'):
+            # dan.me.uk has an exit opinion on every IP it lists (the CSV node
+            # set when stage 1 did not run in this scrape)
+            published = self.dan.published
+            listed = self.dan.listed or {row.get('IP', '') for row in existing_data}
+            self.dan.exits = {ip: (ip in exit_nodes, published) for ip in listed}
+            opinions = self.merge.exits()
+            self.exit_sources = {ip: source for ip, (_, source) in opinions.items()}
+            exit_ips = {ip for ip, (is_exit, _) in opinions.items() if is_exit}
+        self.stats['exit_nodes'] = len(exit_ips)
+        self.anomaly.check_exits(len(exit_ips))
+
+        changed = 0
+        with self.timed('merge'):
+            for row in existing_data:
+                ip = row.get('IP', '')
+                is_exit = 'ExitNode' if ip in exit_ips else ''
+                if row.get('IsExit') != is_exit:
+                    row['IsExit'] = is_exit
+                    changed += 1
+                source = self.exit_sources.get(ip)
+                if source and row.get('Provenance') != source:
+                    provenance = parse_provenance(row.get('Provenance'))
+                    if provenance.get('IsExit') != source:
+                        provenance['IsExit'] = source
+                        row['Provenance'] = format_provenance(provenance)
+                        changed += 1
 
-        self.save_csv(existing_data)
+        # Both checks passed: commit the stage 1 node set with the exit flags
+        if pending:
+            with self.timed('seen'):
+                self.seen_store.record(pending['nodes'], pending['seen_at'], first_seen=pending['first_seen'])
+            self.pending = None
+        if changed or (pending and pending['changed']):
+            self.save_csv(existing_data)
+        else:
+            logger.info("Stage 2: node set and exit flags unchanged, CSV not rewritten")
         logger.info(f"Stage 2 complete: {self.stats['exit_nodes']} exit nodes")
 
     def stage3_collect_details(self):
@@ -109,8 +270,9 @@ class TorNodeScraper:
         if not details_text:
             raise Exception("Failed to fetch node details")
 
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            f.write(details_text)
+        with self.timed('write'):
+            with open(self.data_file, 'w', encoding='utf-8') as f:
+                f.write(details_text)
         logger.info(f"Saved node details to {self.data_file}")
 
     def stage4_update_from_details(self):
@@ -119,9 +281,117 @@ class TorNodeScraper:
             raise Exception(f"Detail file {self.data_file} not found")
 
         nodes = self.load_csv()
-        with open(self.data_file, 'r', encoding='utf-8') as f:
-            details_text = f.read()
+        with self.timed('read'):
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                details_text = f.read()
+
+        if self.merge is None:
+            self.collect_sources()
+        with self.timed('parse'):
+            self.dan.relays = self.parse_details(details_text)
+        self.rows_processed += len(self.dan.relays)
+
+        with self.timed('merge'):
+            node_details = self.merge.relays(self.exit_sources)
 
+        with self.timed('detail_apply'):
+            nodes, changed = self.apply_details(nodes, node_details)
+        if self.geo.enabled:
+            with self.timed('geo'):
+                changed += self.apply_geo(nodes)
+            self.stats['geo'] = self.geo.stats
+        self.stats['total_relays'] = len(nodes)
+        self.rows = nodes
+        self.stats['sources'] = self.merge.coverage(self.stats['total_nodes'])
+
+        if changed:
+            self.save_csv(nodes)
+        else:
+            logger.info("Stage 4: node details unchanged, CSV not rewritten")
+
+        with self.timed('write'):
+            exit_ips = {row['IP'] for row in nodes if row.get('IsExit') == 'ExitNode'}
+            policies = self.merge.policies(exit_ips)
+            write_exit_policies(policies, self.policy_file)
+        self.stats['exit_policies'] = len(policies)
+        logger.info(f"Stage 4 complete: {self.stats['updated_nodes']} nodes updated")
+
+    def apply_geo(self, nodes):
+        """Fill ASN / ASName / Country from the GeoIP lookups (memoised per IP,
+        so only IPs new since the last scrape hit the databases).
+        Returns the number of rows changed"""
+        results = self.geo.lookup({row['IP'] for row in nodes})
+        changed = 0
+        for row in nodes:
+            asn, as_name, country = results.get(row['IP'], UNKNOWN)
+            asn = str(asn) if asn else ''
+            if row.get('ASN') != asn or row.get('ASName') != as_name or row.get('Country') != country:
+                row.update(ASN=asn, ASName=as_name, Country=country)
+                changed += 1
+        return changed
+
+    def new_row(self, ip, collection_date, **fields):
+        row = dict.fromkeys(self.headers, '')
+        row.update(IP=ip, CollectionDate=collection_date, **fields)
+        return row
+
+    def apply_details(self, nodes, node_details):
+        """Upsert detail lines into the node rows, keyed per relay.
+
+        For every IP with detail lines, each line updates the row of the same
+        relay (same fingerprint when the line has one, otherwise same
+        (IP, ORPort, Name)), fills the IP's stage 1 placeholder, or adds a
+        new row, so IPs running several relays keep all of them and a renamed
+        relay with a known fingerprint keeps its row. Rows of that IP which
+        are no longer listed are dropped. IPs without detail lines keep their
+        rows unchanged.
+        Returns (rows, number of rows inserted/updated/dropped).
+        """
+        today = date.today().isoformat()
+        rows_by_ip = {}
+        for row in nodes:
+            rows_by_ip.setdefault(row.get('IP', ''), []).append(row)
+
+        result = []
+        changed = 0
+        for ip, rows in rows_by_ip.items():
+            details = node_details.get(ip)
+            if not details:
+                self.stats['detail_errors'] += len(rows)
+                result.extend(rows)
+                continue
+
+            # Placeholders (no name/port yet) are replaced by the detail lines
+            keyed = {}
+            for row in rows:
+                if row.get('Name') or row.get('OnionPort'):
+                    keyed[address_key(row)] = row
+                    keyed[relay_key(row)] = row
+            first = rows[0]
+            for detail in details:
+                detail_row = dict(detail, IP=ip)
+                row = keyed.get(relay_key(detail_row)) or keyed.get(address_key(detail_row))
+                if row is not None:
+                    keyed.pop(address_key(row), None)
+                    keyed.pop(relay_key(row), None)
+                else:
+                    row = self.new_row(ip, first.get('CollectionDate') or today, IsExit=first.get('IsExit', ''),
+                                       Sources=first.get('Sources', ''))
+                    changed += 1
+                if any(row.get(field) != value for field, value in detail.items()):
+                    row.update(detail)
+                    changed += 1
+                result.append(row)
+                self.stats['updated_nodes'] += 1
+            # Rows left over are relays that left (each may be keyed twice)
+            changed += len({id(row) for row in keyed.values()})
+        return result, changed
+
+    def parse_details(self, details_text):
+        """Parse the tornodes page into {ip: [detail fields, ...]}, one entry per relay line.
+
+        Fields are normalised into typed columns here (see normalize.normalize_details).
+        """
         start_marker = "<!-- __BEGIN_TOR_NODE_LIST__ //-->"
         start_idx = details_text.find(start_marker)
         if start_idx == -1:
@@ -136,9 +406,10 @@ class TorNodeScraper:
                 continue
             parts = line.strip().split('|')
             if len(parts) >= 7:
-                ip = parts[0].strip()
-                if self.is_valid_ip(ip):
-                    node_details[ip] = {
+                # Canonicalise so IPv6 text forms match the stage 1 keys
+                ip = canonical_ip(parts[0])
+                if ip:
+                    node_details.setdefault(ip, []).append(normalize_details({
                         'Name': parts[1].strip(),
                         'OnionPort': parts[2].strip(),
                         'DirPort': parts[3].strip(),
@@ -146,63 +417,116 @@ class TorNodeScraper:
                         'Uptime': parts[5].strip(),
                         'Version': parts[6].strip(),
                         'Contact': parts[7].strip() if len(parts) > 7 else ''
-                    }
-
-        for node in nodes:
-            ip = node.get('IP', '')
-            if ip in node_details:
-                node.update(node_details[ip])
-                self.stats['updated_nodes'] += 1
-            else:
-                self.stats['detail_errors'] += 1
-
-        self.save_csv(nodes)
-        logger.info(f"Stage 4 complete: {self.stats['updated_nodes']} nodes updated")
+                    }))
+        return node_details
 
     def load_csv(self):
+        with self.timed('read'):
+            return self._load_csv()
+
+    def _load_csv(self):
         if not os.path.exists(self.csv_file):
             return []
         try:
             with open(self.csv_file, 'r', newline='', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
-                if reader.fieldnames != self.headers:
-                    return []
-                return list(reader)
+                if reader.fieldnames == self.headers:
+                    return list(reader)
+                # Older CSVs lack newer columns (e.g. Fingerprint): fill them in
+                if reader.fieldnames and 'IP' in reader.fieldnames and set(reader.fieldnames) <= set(self.headers):
+                    logger.info(f"Migrating {self.csv_file} to columns {self.headers}")
+                    self.schema_migrated = True
+                    return [dict(dict.fromkeys(self.headers, ''), **row) for row in reader]
+                return []
         except:
             return []
 
     def save_csv(self, data):
+        with self.timed('write'):
+            self._save_csv(data)
+
+    def _save_csv(self, data):
         os.makedirs(os.path.dirname(self.csv_file), exist_ok=True)
-        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+        # Write to a temp file and swap it in so API workers never read a partial CSV
+        tmp_file = f'{self.csv_file}.tmp'
+        with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
             writer = csv.DictWriter(f, fieldnames=self.headers)
             writer.writeheader()
             writer.writerows(data)
+        os.replace(tmp_file, self.csv_file)
+        # Binary snapshot for the API workers, written in the same step as the
+        # CSV so it is never older; workers only map it, they never rebuild it
+        try:
+            with self.timed('snapshot'):
+                write_snapshot(data, snapshot_path(self.csv_file))
+        except Exception as e:
+            logger.error(f"Error writing node snapshot: {e}")
 
     def is_valid_ip(self, ip):
-        try:
-            parts = ip.split('.')
-            return len(parts) == 4 and all(0 <= int(part) <= 255 for part in parts)
-        except:
-            return False
+        return ip_version(ip) is not None
+
+    def wait(self, seconds):
+        """Pause between requests to be polite to the upstream site"""
+        with self.timed('wait'):
+            time.sleep(seconds)
+
+    def instrumentation(self):
+        """Stage timings (seconds), bytes fetched and rows processed so far"""
+        return {
+            'timings': {stage: round(seconds, 4) for stage, seconds in self.timings.items()},
+            'bytes_fetched': self.bytes_fetched,
+            'rows_processed': self.rows_processed
+        }
 
-    def run_all_stages(self):
+    def run_all_stages(self, progress=None):
+        start = time.perf_counter()
+        self.collect_sources()
         self.stage1_collect_all_nodes()
-        time.sleep(2)
+        if progress:
+            progress(25, 'Stage 1 complete: all nodes collected')
+        self.wait(2)
         self.stage2_update_exit_nodes()
-        time.sleep(2)
+        if progress:
+            progress(50, 'Stage 2 complete: exit nodes updated')
+        self.wait(2)
         self.stage3_collect_details()
-        time.sleep(2)
+        if progress:
+            progress(75, 'Stage 3 complete: node details fetched')
+        self.wait(2)
         self.stage4_update_from_details()
+        self.anomaly.accept(self.stats['total_nodes'], self.stats['exit_nodes'],
+                            self.stats['new_nodes'], self.stats['removed_nodes'])
+        self.timings['total'] = time.perf_counter() - start
         
+        logger.info(f"Scrape timings: {self.instrumentation()}")
         return {
             'scraped': True,
             'message': 'Successfully scraped all stages',
-            **self.stats
+            **self.stats,
+            **self.instrumentation()
+        }
+
+    def not_before(self):
+        """Result for a scrape refused because the upstream rate limit window is still
+        open, or None if every source may be fetched now"""
+        if self.schedule.wait_seconds(self.sources) <= 0:
+            return None
+        next_allowed = self.schedule.next_slot(self.sources).isoformat(timespec='seconds')
+        logger.info(f"Scrape not started - next fetch allowed at {next_allowed}")
+        return {
+            'scraped': False,
+            'message': f"Skipped - upstream rate limit window, next fetch allowed at {next_allowed}",
+            'next_allowed': next_allowed,
+            **self.stats,
+            **self.instrumentation()
         }
 
     def run(self):
         """Run scraping on schedule"""
         logger.info("Scheduled scraping initiated")
+        refused = self.not_before()
+        if refused:
+            return refused
         try:
             return self.run_all_stages()
         except Exception as e:
@@ -210,18 +534,74 @@ class TorNodeScraper:
             return {
                 'scraped': False,
                 'message': f"Scraping failed: {e}",
-                **self.stats
+                **self.stats,
+                **self.instrumentation()
             }
 
-    def force_scrape(self):
-        """Force scraping regardless of update status (for testing)"""
-        logger.info("Force scraping initiated")
+    def force_scrape(self, progress=None, profile=False):
+        """Force scraping regardless of update status (for testing).
+
+        With profile=True the scrape runs under cProfile and tracemalloc; the
+        .prof file is saved under /app/data/profiles and a summary of the top
+        functions and allocations is returned in result['profile'].
+        """
+        logger.info("Force scraping initiated" + (" (profiling enabled)" if profile else ""))
+        # Forced scrapes still never fetch inside the upstream rate limit window
+        refused = self.not_before()
+        if refused:
+            return refused
+        if profile:
+            return self.profile_scrape(progress=progress)
         try:
-            return self.run_all_stages()
+            return self.run_all_stages(progress=progress)
         except Exception as e:
             logger.error(f"Force scraping failed: {e}")
             return {
                 'scraped': False,
                 'message': f"Force scraping failed: {e}",
-                **self.stats
-            }
\ No newline at end of file
+                **self.stats,
+                **self.instrumentation()
+            }
+
+    def profile_scrape(self, progress=None, profile_dir='/app/data/profiles', top=20):
+        """Run a single forced scrape under cProfile and tracemalloc"""
+        import cProfile
+        import io
+        import pstats
+        import tracemalloc
+
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            result = self.run_all_stages(progress=progress)
+        except Exception as e:
+            logger.error(f"Force scraping failed: {e}")
+            result = {
+                'scraped': False,
+                'message': f"Force scraping failed: {e}",
+                **self.stats,
+                **self.instrumentation()
+            }
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_file = os.path.join(profile_dir, f"scrape-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof")
+        profiler.dump_stats(profile_file)
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+
+        result['profile'] = {
+            'file': profile_file,
+            'peak_memory_bytes': peak_bytes,
+            'current_memory_bytes': current_bytes,
+            'top_functions': report.getvalue(),
+            'top_allocations': [str(stat) for stat in snapshot.statistics('lineno')[:top]]
+        }
+        logger.info(f"Scrape profile saved to {profile_file} (peak traced memory {peak_bytes} bytes)")
+        return result
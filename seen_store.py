@@ -0,0 +1,78 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SeenStore:
+    """Per-IP first_seen / last_seen / seen_count, kept in SQLite.
+
+    Each scrape upserts the IPs it saw: new IPs are inserted, known IPs
+    only get last_seen and seen_count bumped, so first_seen is never lost
+    and nothing is rewritten for IPs that were not in the scrape.
+    """
+
+    def __init__(self, db_file='/app/data/seen.db'):
+        self.db_file = db_file
+        self.local = threading.local()
+
+    def connect(self):
+        """One connection per thread (SQLite connections are not shared across threads)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS seen ('
+                'ip TEXT PRIMARY KEY, first_seen TEXT NOT NULL, last_seen TEXT NOT NULL, '
+                'seen_count INTEGER NOT NULL DEFAULT 1)'
+            )
+            self.local.conn = conn
+        return conn
+
+    def record(self, ips, seen_at, first_seen=None):
+        """Mark every IP as seen at seen_at (ISO timestamp).
+
+        first_seen optionally maps IP -> an earlier first-seen value to use
+        when the IP is not in the store yet (e.g. the CSV CollectionDate of
+        nodes scraped before the store existed).
+        """
+        first_seen = first_seen or {}
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                'INSERT INTO seen (ip, first_seen, last_seen, seen_count) VALUES (?, ?, ?, 1) '
+                'ON CONFLICT(ip) DO UPDATE SET last_seen = excluded.last_seen, seen_count = seen_count + 1',
+                ((ip, first_seen.get(ip) or seen_at, seen_at) for ip in ips)
+            )
+        logger.info(f"Seen store updated: {len(ips)} IPs at {seen_at}")
+
+    def get(self, ip):
+        """{'first_seen', 'last_seen', 'seen_count'} for an IP, or None"""
+        return self.get_many([ip]).get(ip)
+
+    def get_many(self, ips):
+        """{ip: {'first_seen', 'last_seen', 'seen_count'}} for the IPs that are known"""
+        if not os.path.exists(self.db_file):
+            return {}
+        ips = list(ips)
+        conn = self.connect()
+        results = {}
+        # Stay below SQLite's bound-parameter limit
+        for start in range(0, len(ips), 500):
+            chunk = ips[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for ip, first, last, count in conn.execute(
+                f'SELECT ip, first_seen, last_seen, seen_count FROM seen WHERE ip IN ({placeholders})', chunk
+            ):
+                results[ip] = {'first_seen': first, 'last_seen': last, 'seen_count': count}
+        return results
+
+    def all(self):
+        """All rows as (ip, first_seen, last_seen, seen_count)"""
+        if not os.path.exists(self.db_file):
+            return []
+        return self.connect().execute('SELECT ip, first_seen, last_seen, seen_count FROM seen').fetchall()
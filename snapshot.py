@@ -0,0 +1,293 @@
+import csv
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from ip_list import pack_ip, unpack_ip
+from normalize import flags_mask, parse_uptime, version_code
+
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian):
+#   header   MAGIC, format version, record size, record count, distinct IP
+#            count, records offset, hash table offset, hash table slots,
+#            strings offset, strings size
+#   records  fixed-width, sorted by 16-byte IP key (IPv4 stored as ::ffff:a.b.c.d)
+#   table    open-addressing hash table (power-of-two slots, linear probing,
+#            crc32 of the key); each u32 slot is 1 + the index of the first
+#            record for an IP, 0 if empty
+#   strings  u32 length + UTF-8 bytes; records point at them by offset,
+#            offset 0 is the empty string and identical strings are stored once
+MAGIC = b'TORSNAP\0'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('<8sHHIIIIIII')
+SLOT = struct.Struct('<I')
+NUMERIC_FIELDS = ['OnionPort', 'DirPort', 'Uptime', 'FlagsMask', 'VersionCode', 'ASN']
+STRING_FIELDS = ['Name', 'Flags', 'Version', 'Contact', 'CollectionDate', 'Fingerprint',
+                 'ContactEmail', 'ContactUrl', 'ContactAbuse', 'Sources', 'Provenance', 'ASName', 'Country']
+RECORD = struct.Struct('<16sBxxx' + 'I' * (len(NUMERIC_FIELDS) + len(STRING_FIELDS)))
+# Index of the first string offset in an unpacked record
+STRINGS_START = 2 + len(NUMERIC_FIELDS)
+# Numeric field value for '' (unknown)
+MISSING = 0xFFFFFFFF
+IS_EXIT = 1
+V4_PREFIX = b'\0' * 10 + b'\xff\xff'
+
+def snapshot_path(csv_file):
+    """Snapshot file that sits next to a node CSV"""
+    return os.path.splitext(csv_file)[0] + '.snap'
+
+def ip_key(ip):
+    """16-byte sort/search key for an IP (IPv4-mapped for IPv4), or None"""
+    packed = pack_ip(ip)
+    if packed is None:
+        return None
+    return V4_PREFIX + packed if len(packed) == 4 else packed
+
+def _number(value):
+    # Values are CSV text; isdigit() avoids raising for the common '' case
+    if isinstance(value, str):
+        if not value.isdigit():
+            return MISSING
+        value = int(value)
+    elif not isinstance(value, int):
+        return MISSING
+    return value if 0 <= value < MISSING else MISSING
+
+def _numbers(row):
+    numbers = [_number(row.get(field)) for field in NUMERIC_FIELDS]
+    if row.get('FlagsMask') is None:
+        # CSV written before the typed columns existed
+        numbers[NUMERIC_FIELDS.index('Uptime')] = _number(parse_uptime(row.get('Uptime')))
+        numbers[NUMERIC_FIELDS.index('FlagsMask')] = flags_mask(row.get('Flags') or '')
+        numbers[NUMERIC_FIELDS.index('VersionCode')] = _number(version_code(row.get('Version') or ''))
+    return numbers
+
+def typed_number(number):
+    """A stored number as rows carry it: an int, or '' when missing"""
+    return '' if number == MISSING else number
+
+def typed_row(row):
+    """A CSV row with its numeric fields typed the way the snapshot decodes them"""
+    row = dict(row)
+    for field, number in zip(NUMERIC_FIELDS, _numbers(row)):
+        row[field] = typed_number(number)
+    return row
+
+def write_snapshot(rows, path):
+    """Write node rows (CSV dicts) as a binary snapshot, atomically"""
+    strings = {'': 0}
+    table = [struct.pack('<I', 0)]
+    table_size = 4
+
+    def intern(value):
+        nonlocal table_size
+        offset = strings.get(value)
+        if offset is None:
+            data = value.encode('utf-8')
+            offset = strings[value] = table_size
+            table.append(struct.pack('<I', len(data)) + data)
+            table_size += 4 + len(data)
+        return offset
+
+    keyed = []
+    for row in rows:
+        key = ip_key(row.get('IP', ''))
+        if key is not None:
+            keyed.append((key, row))
+    keyed.sort(key=lambda item: item[0])
+
+    records = bytearray(RECORD.size * len(keyed))
+    for i, (key, row) in enumerate(keyed):
+        RECORD.pack_into(
+            records, i * RECORD.size, key,
+            IS_EXIT if row.get('IsExit') == 'ExitNode' else 0,
+            *_numbers(row),
+            *[intern(row.get(field) or '') for field in STRING_FIELDS]
+        )
+
+    # Hash table at most half full, pointing at the first record of each IP
+    first_records = [i for i, (key, _) in enumerate(keyed) if i == 0 or keyed[i - 1][0] != key]
+    ip_count = len(first_records)
+    slots = 1
+    while slots < ip_count * 2:
+        slots *= 2
+    mask = slots - 1
+    table_values = [0] * slots
+    for i in first_records:
+        slot = zlib.crc32(keyed[i][0]) & mask
+        while table_values[slot]:
+            slot = (slot + 1) & mask
+        table_values[slot] = i + 1
+    hash_table = struct.pack(f'<{slots}I', *table_values)
+
+    records_offset = HEADER.size
+    table_offset = records_offset + len(records)
+    strings_offset = table_offset + len(hash_table)
+    # Per-process temp name: API workers may rebuild a missing snapshot concurrently
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, len(keyed), ip_count,
+                            records_offset, table_offset, slots, strings_offset, table_size))
+        f.write(records)
+        f.write(hash_table)
+        f.writelines(table)
+    os.replace(tmp_file, path)
+    logger.info(f"Snapshot written: {len(keyed)} records, {len(strings)} distinct strings, {strings_offset + table_size} bytes")
+
+def ensure_snapshot(csv_file):
+    """Rebuild the snapshot of csv_file if it is missing, older than the CSV or
+    in another format. Runs in the scheduler process at startup (API workers
+    only map the snapshot); returns True if a usable snapshot exists"""
+    path = snapshot_path(csv_file)
+    try:
+        csv_mtime = os.path.getmtime(csv_file)
+    except OSError:
+        return os.path.exists(path)
+    try:
+        with open(path, 'rb') as f:
+            magic, version, record_size = HEADER.unpack(f.read(HEADER.size))[:3]
+        if magic == MAGIC and version == FORMAT_VERSION and record_size == RECORD.size \
+                and os.path.getmtime(path) >= csv_mtime:
+            return True
+    except (OSError, struct.error):
+        pass
+    try:
+        with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+            write_snapshot(csv.DictReader(f), path)
+        return True
+    except Exception as e:
+        logger.warning(f"Could not build node snapshot {path}: {e}")
+        return False
+
+class NodeSnapshot:
+    """Read-only, memory-mapped view of a snapshot file.
+
+    The file is replaced atomically by the scraper; refresh() maps the new
+    file when its inode changes. All processes share the mapped pages
+    through the page cache, and lookups probe the hash table in the mapping
+    directly instead of building a per-process index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (mmap, record count, IP count, records offset, table offset, table slots,
+        #  strings offset), swapped as one
+        self.state = None
+        self.identity = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Map the snapshot if it is new or was replaced. Returns False if none is available"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return self.state is not None
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self.identity:
+            return True
+
+        with self.lock:
+            if identity == self.identity:
+                return True
+            try:
+                with open(self.path, 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                (magic, version, record_size, count, ip_count, records_offset,
+                 table_offset, slots, strings_offset, _) = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+                    mm.close()
+                    logger.warning(f"Ignoring snapshot {self.path}: unsupported format")
+                    return self.state is not None
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f"Failed to map snapshot {self.path}: {e}")
+                return self.state is not None
+            # The previous mapping is left for the garbage collector, since
+            # other threads may still be reading from it
+            self.state = (mm, count, ip_count, records_offset, table_offset, slots, strings_offset)
+            self.identity = identity
+            logger.info(f"Snapshot mapped: {count} records, {ip_count} IPs")
+            return True
+
+    def _decode(self, mm, strings_base, values):
+        """Row for one record; numeric fields are ints ('' when missing), see typed_row"""
+        key = values[0]
+        row = {
+            'IP': unpack_ip(key[12:] if key[:12] == V4_PREFIX else key),
+            'IsExit': 'ExitNode' if values[1] & IS_EXIT else ''
+        }
+        for field, number in zip(NUMERIC_FIELDS, values[2:STRINGS_START]):
+            row[field] = typed_number(number)
+        unpack_length = SLOT.unpack_from
+        for field, offset in zip(STRING_FIELDS, values[STRINGS_START:]):
+            if offset:
+                start = strings_base + offset + 4
+                row[field] = str(mm[start:start + unpack_length(mm, start - 4)[0]], 'utf-8')
+            else:
+                row[field] = ''
+        return row
+
+    def lookup(self, ip):
+        """Rows for an IP (one per relay), or [] if it is not in the snapshot"""
+        key = ip_key(ip)
+        state = self.state
+        if key is None or state is None:
+            return []
+        mm, count, _, records_offset, table_offset, slots, strings_offset = state
+        size = RECORD.size
+        mask = slots - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            index = SLOT.unpack_from(mm, table_offset + slot * 4)[0]
+            if not index:
+                return []
+            index -= 1
+            start = records_offset + index * size
+            if mm[start:start + 16] == key:
+                break
+            slot = (slot + 1) & mask
+        # Records are sorted by key, so the other relays on this IP follow
+        rows = []
+        while index < count:
+            start = records_offset + index * size
+            if mm[start:start + 16] != key:
+                break
+            rows.append(self._decode(mm, strings_offset, RECORD.unpack_from(mm, start)))
+            index += 1
+        return rows
+
+    def select(self, exit=None, flags_mask=0, version_lt=None, version_gte=None, min_uptime=None):
+        """Yield rows matching the filters; filters run on the fixed-width fields
+        before any strings are decoded"""
+        state = self.state
+        if state is None:
+            return
+        mm, count, _, records_offset, _, _, strings_offset = state
+        flags_index = 2 + NUMERIC_FIELDS.index('FlagsMask')
+        version_index = 2 + NUMERIC_FIELDS.index('VersionCode')
+        uptime_index = 2 + NUMERIC_FIELDS.index('Uptime')
+        # memoryview slice: iterate the mapped records without copying them
+        records = memoryview(mm)[records_offset:records_offset + count * RECORD.size]
+        for values in RECORD.iter_unpack(records):
+            if exit is not None and bool(values[1] & IS_EXIT) != exit:
+                continue
+            if flags_mask and (values[flags_index] == MISSING or values[flags_index] & flags_mask != flags_mask):
+                continue
+            version = values[version_index]
+            if version_lt is not None and (version == MISSING or version >= version_lt):
+                continue
+            if version_gte is not None and (version == MISSING or version < version_gte):
+                continue
+            if min_uptime is not None and (values[uptime_index] == MISSING or values[uptime_index] < min_uptime):
+                continue
+            yield self._decode(mm, strings_offset, values)
+
+    def ips(self):
+        """Number of distinct IPs"""
+        return self.state[2] if self.state else 0
+
+    def __len__(self):
+        return self.state[1] if self.state else 0
@@ -0,0 +1,467 @@
+"""
+Additional node sources and the field-level merge across sources.
+
+Besides dan.me.uk the scraper can read:
+    exitlist  - TorDNSEL exit list (check.torproject.org/exit-addresses format)
+    onionoo   - Onionoo details document (JSON)
+    consensus - a network-status consensus file (cached-consensus)
+    descriptors - server descriptors (cached-descriptors), for exit policies only
+
+Each is configured as a URL or a local path, so a scrape can be replayed from
+fixtures. Every source is parsed into a SourceData keyed by IP; the merge
+walks those dicts once per source, so it is linear in the number of entries.
+Conflicts are resolved per field: the freshest source with a value wins
+(ties go to the source listed first, dan.me.uk before the extra sources),
+and the winning source is recorded as the field's provenance.
+"""
+import base64
+import binascii
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+from exit_policy import summarize_rules, summary_intervals
+from ip_list import canonical_ip
+from normalize import FLAG_BITS, FLAG_NAMES, normalize_details
+
+logger = logging.getLogger(__name__)
+
+# Detail fields merged per relay; derived columns follow the field they come from
+DETAIL_FIELDS = ['Name', 'OnionPort', 'DirPort', 'Flags', 'Uptime', 'Version', 'Contact', 'Fingerprint']
+DERIVED_FIELDS = {
+    'Flags': ['FlagsMask'],
+    'Version': ['VersionCode'],
+    'Contact': ['ContactEmail', 'ContactUrl', 'ContactAbuse']
+}
+FLAG_LETTERS = {name: letter for letter, name in FLAG_NAMES.items()}
+
+def utcnow():
+    """Naive UTC now - source timestamps are naive UTC"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_time(value):
+    """Naive UTC datetime from 'YYYY-MM-DD HH:MM:SS' (or ISO), or None"""
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace(' ', 'T', 1))
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def flag_letters(names):
+    """'Exit Fast Guard' / ['Exit', 'Fast'] -> 'EFG' (dan.me.uk letters, in FLAG_BITS order)"""
+    if isinstance(names, str):
+        names = names.split()
+    present = {FLAG_LETTERS[name] for name in names if name in FLAG_LETTERS}
+    return ''.join(letter for letter in FLAG_BITS if letter in present)
+
+def split_address(address):
+    """'1.2.3.4:9001' / '[2001:db8::1]:9001' -> (canonical IP, port) or (None, '')"""
+    host, _, port = address.strip().rpartition(':')
+    if not host:
+        host, port = port, ''
+    return canonical_ip(host.strip('[]')), port
+
+def format_provenance(field_sources):
+    """{'Flags': 'onionoo', 'Name': 'dan', ...} -> 'dan;Flags=onionoo' (CSV column).
+
+    The source most fields came from is written once, followed by the fields
+    that came from elsewhere, so the usual single-source row is just 'dan'.
+    """
+    if not field_sources:
+        return ''
+    counts = {}
+    for source in field_sources.values():
+        counts[source] = counts.get(source, 0) + 1
+    primary = min(counts, key=lambda source: (-counts[source], source))
+    return ';'.join([primary] + [f'{field}={source}' for field, source in sorted(field_sources.items())
+                                 if source != primary])
+
+def parse_provenance(text):
+    """Inverse of format_provenance: {field: source} for IsExit and DETAIL_FIELDS"""
+    items = [item for item in (text or '').split(';') if item]
+    if not items:
+        return {}
+    field_sources = {}
+    if '=' not in items[0]:
+        field_sources = dict.fromkeys(['IsExit'] + DETAIL_FIELDS, items.pop(0))
+    for item in items:
+        field, _, source = item.partition('=')
+        field_sources[field] = source
+    return field_sources
+
+class SourceData:
+    """What one source says about the network, keyed by canonical IP.
+
+    listed   {ip: timestamp} - IPs the source saw as Tor nodes, and when
+    exits    {ip: (is_exit, timestamp)} - exit opinions
+    relays   {ip: [detail dicts]} - relay details (normalised CSV fields)
+    policies {ip: [(lo, hi), ...]} - accepted exit port ranges
+    """
+
+    def __init__(self, name, kind, location='', published=None):
+        self.name = name
+        self.kind = kind
+        self.location = location
+        self.published = published
+        self.listed = {}
+        self.exits = {}
+        self.relays = {}
+        self.policies = {}
+        self.error = None
+        self.bytes = 0
+
+    def add_relay(self, ip, details, is_exit, timestamp):
+        self.listed[ip] = timestamp
+        self.exits[ip] = (is_exit, timestamp)
+        self.relays.setdefault(ip, []).append(normalize_details(details))
+
+def parse_exit_list(text, data):
+    """TorDNSEL exit list: ExitNode / Published / LastStatus / ExitAddress blocks"""
+    newest = None
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 4 and parts[0] == 'ExitAddress':
+            ip = canonical_ip(parts[1])
+            seen = parse_time(f'{parts[2]} {parts[3]}')
+            if ip and seen:
+                if ip not in data.listed or data.listed[ip] < seen:
+                    data.listed[ip] = seen
+                    data.exits[ip] = (True, seen)
+                newest = max(newest or seen, seen)
+    data.published = newest
+    return data
+
+def parse_onionoo(text, data):
+    """Onionoo details document (relays with or_addresses, flags, platform, contact)"""
+    document = json.loads(text)
+    published = parse_time(document.get('relays_published', ''))
+    data.published = published
+    for relay in document.get('relays', []):
+        if not relay.get('running', True):
+            continue
+        flags = relay.get('flags', [])
+        restarted = parse_time(relay.get('last_restarted', ''))
+        version = relay.get('version') or ''
+        dir_port = (relay.get('dir_address') or '').rpartition(':')[2]
+        is_exit = 'Exit' in flags and 'BadExit' not in flags
+        policy_v4 = summary_intervals(relay.get('exit_policy_summary'))
+        policy_v6 = summary_intervals(relay.get('exit_policy_v6_summary'))
+        for address in relay.get('or_addresses', []):
+            ip, port = split_address(address)
+            if not ip:
+                continue
+            if relay.get('exit_policy_summary') is not None:
+                data.policies[ip] = policy_v6 if ':' in ip else policy_v4
+            data.add_relay(ip, {
+                'Name': relay.get('nickname', ''),
+                'OnionPort': port,
+                'DirPort': dir_port or '0',
+                'Flags': flag_letters(flags),
+                'Uptime': str(int((published - restarted).total_seconds())) if published and restarted else '',
+                'Version': f'Tor {version}' if version else (relay.get('platform') or '').split(' on ')[0],
+                'Contact': relay.get('contact') or '',
+                'Fingerprint': relay.get('fingerprint', '')
+            }, is_exit, published)
+        # Addresses traffic was seen leaving from, when they differ from the OR address
+        for address in relay.get('exit_addresses', []):
+            ip = canonical_ip(address)
+            if ip and ip not in data.listed:
+                data.listed[ip] = published
+                data.exits[ip] = (True, published)
+            if ip and relay.get('exit_policy_summary') is not None:
+                data.policies.setdefault(ip, policy_v6 if ':' in ip else policy_v4)
+    return data
+
+def parse_consensus(text, data):
+    """Network-status consensus: r / a / s / v lines per relay"""
+    published = None
+    relay = None
+
+    def finish():
+        if relay is None:
+            return
+        is_exit = 'E' in relay['Flags'] and 'B' not in relay['Flags']
+        for ip, port in relay.pop('addresses'):
+            data.add_relay(ip, dict(relay, OnionPort=port), is_exit, published)
+
+    for line in text.splitlines():
+        keyword, _, rest = line.partition(' ')
+        if keyword == 'valid-after':
+            published = parse_time(rest)
+        elif keyword == 'r':
+            finish()
+            parts = rest.split()
+            relay = None
+            if len(parts) >= 8:
+                try:
+                    fingerprint = base64.b64decode(parts[1] + '=' * (-len(parts[1]) % 4)).hex().upper()
+                except (binascii.Error, ValueError):
+                    fingerprint = ''
+                ip = canonical_ip(parts[5])
+                relay = {
+                    'Name': parts[0],
+                    'DirPort': parts[7],
+                    'Flags': '',
+                    'Uptime': '',
+                    'Version': '',
+                    'Contact': '',
+                    'Fingerprint': fingerprint,
+                    'addresses': [(ip, parts[6])] if ip else []
+                }
+        elif relay is not None and keyword == 'a':
+            ip, port = split_address(rest)
+            if ip:
+                relay['addresses'].append((ip, port))
+        elif relay is not None and keyword == 's':
+            relay['Flags'] = flag_letters(rest)
+        elif relay is not None and keyword == 'v':
+            relay['Version'] = rest.strip()
+        elif keyword == 'directory-footer':
+            finish()
+            relay = None
+    finish()
+    data.published = published
+    return data
+
+def parse_descriptors(text, data):
+    """Server descriptors: exit policies per router / or-address (the relays
+    themselves come from the other sources, descriptors outlive them)"""
+    published = None
+    addresses, rules, policy_v6 = [], [], None
+
+    def finish():
+        policy_v4 = summarize_rules(rules)
+        for ip in addresses:
+            data.policies[ip] = summary_intervals(policy_v6) if ':' in ip else policy_v4
+
+    for line in text.splitlines():
+        keyword, _, rest = line.partition(' ')
+        if keyword == 'router':
+            finish()
+            parts = rest.split()
+            ip = canonical_ip(parts[1]) if len(parts) > 1 else None
+            addresses, rules, policy_v6 = [ip] if ip else [], [], None
+        elif keyword == 'or-address':
+            ip, _ = split_address(rest)
+            if ip:
+                addresses.append(ip)
+        elif keyword in ('accept', 'reject'):
+            rules.append(line)
+        elif keyword == 'ipv6-policy':
+            policy_v6 = rest
+        elif keyword == 'published':
+            seen = parse_time(rest)
+            if seen and (published is None or seen > published):
+                published = seen
+    finish()
+    data.published = published
+    return data
+
+PARSERS = {
+    'exitlist': parse_exit_list,
+    'onionoo': parse_onionoo,
+    'consensus': parse_consensus,
+    'descriptors': parse_descriptors
+}
+
+def configured_sources():
+    """[(name, kind, location)] from TOR_EXTRA_SOURCES ('kind=location,...')"""
+    sources = []
+    for item in os.getenv('TOR_EXTRA_SOURCES', '').split(','):
+        kind, _, location = item.strip().partition('=')
+        kind = kind.strip().lower()
+        if not location:
+            continue
+        if kind not in PARSERS:
+            logger.warning(f"Ignoring unknown node source type '{kind}' (known: {', '.join(PARSERS)})")
+            continue
+        count = sum(1 for _, other, _ in sources if other == kind)
+        sources.append((f'{kind}{count + 1}' if count else kind, kind, location.strip()))
+    return sources
+
+def read_source(location, session=None, timeout=30):
+    """Text of a source: http(s) URL, file:// URL or local path"""
+    if location.startswith(('http://', 'https://')):
+        response = session.get(location, timeout=timeout)
+        response.raise_for_status()
+        return response.text
+    path = urlsplit(location).path if location.startswith('file://') else location
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def load_source(name, kind, location, session=None):
+    """Fetch and parse one extra source; errors are kept on the result, not raised"""
+    data = SourceData(name, kind, location)
+    try:
+        text = read_source(location, session)
+        data.bytes = len(text.encode('utf-8'))
+        PARSERS[kind](text, data)
+        if data.published is None:
+            data.error = 'no publication time in the document'
+    except Exception as e:
+        data.error = str(e)
+        logger.warning(f"Node source {name} ({location}) unavailable: {e}")
+    return data
+
+class SourceMerge:
+    """Field-level merge of several SourceData, freshest value first.
+
+    sources are in priority order (used to break timestamp ties). Sources
+    with an error, or published more than max_age ago, are reported but not
+    used.
+    """
+
+    def __init__(self, sources, max_age=timedelta(hours=6), now=None):
+        self.now = now or utcnow()
+        self.all = sources
+        self.max_age = max_age
+        self.sources = [source for source in sources if self.usable(source)]
+        self.priority = {source.name: index for index, source in enumerate(self.sources)}
+        self.won = {source.name: 0 for source in sources}
+
+    def usable(self, source):
+        return source.error is None and source.published is not None and self.now - source.published <= self.max_age
+
+    def _rank(self, timestamp, source):
+        # Newest first, then priority
+        return (-timestamp.timestamp() if timestamp else float('inf'), self.priority[source.name])
+
+    def membership(self):
+        """{ip: [names of the sources listing it]} for IPs listed within max_age"""
+        if len(self.sources) == 1:
+            # dan.me.uk only (no extra sources): the lists are shared, not copied
+            return dict.fromkeys(self.sources[0].listed, [self.sources[0].name])
+        cutoff = self.now - self.max_age
+        listed = {}
+        for source in self.sources:
+            for ip, seen in source.listed.items():
+                if seen is None or seen >= cutoff:
+                    listed.setdefault(ip, []).append(source.name)
+        return listed
+
+    def exits(self):
+        """{ip: (is_exit, source name)} from the freshest opinion per IP (dan.me.uk
+        has an opinion on every IP it lists; the exit list only on exits)"""
+        if len(self.sources) == 1:
+            source = self.sources[0]
+            self.won[source.name] += len(source.exits)
+            return {ip: (is_exit, source.name) for ip, (is_exit, _) in source.exits.items()}
+        best = {}
+        for source in self.sources:
+            for ip, (is_exit, seen) in source.exits.items():
+                rank = self._rank(seen, source)
+                current = best.get(ip)
+                if current is None or rank < current[0]:
+                    best[ip] = (rank, is_exit, source.name)
+        result = {}
+        for ip, (_, is_exit, name) in best.items():
+            result[ip] = (is_exit, name)
+            self.won[name] += 1
+        return result
+
+    def relays(self, exit_sources=None):
+        """{ip: [merged detail dicts]}, each with a 'Provenance' column.
+
+        The relay set of an IP comes from the freshest source with details
+        for it; each field is then taken from the freshest source that has
+        a value for the same relay (ORPort, Name). exit_sources ({ip: source
+        name}, see exits()) adds the IsExit provenance.
+        """
+        exit_sources = exit_sources or {}
+        # (source, exit source, fields present) -> Provenance, for single-source IPs
+        formatted = {}
+        with_relays = [source for source in self.sources if source.relays]
+        if len(with_relays) == 1:
+            # One source has details (e.g. dan.me.uk only): no per-IP candidate lists
+            source = with_relays[0]
+            for ip, details in source.relays.items():
+                self._single_source(source.name, details, exit_sources.get(ip), formatted)
+            return source.relays
+
+        by_ip = {}
+        for source in with_relays:
+            rank = self._rank(source.published, source)
+            for ip, details in source.relays.items():
+                by_ip.setdefault(ip, []).append((rank, source.name, details))
+
+        merged = {}
+        for ip, candidates in by_ip.items():
+            if len(candidates) == 1:
+                _, name, details = candidates[0]
+                merged[ip] = self._single_source(name, details, exit_sources.get(ip), formatted)
+                continue
+            candidates.sort(key=lambda candidate: candidate[0])
+            keyed = [(name, {(detail.get('OnionPort'), detail.get('Name')): detail for detail in details})
+                     for _, name, details in candidates]
+            relays = []
+            for primary in candidates[0][2]:
+                key = (primary.get('OnionPort'), primary.get('Name'))
+                relay, field_sources = {}, {}
+                for field in DETAIL_FIELDS:
+                    for name, details in keyed:
+                        detail = details.get(key)
+                        if detail is not None and detail.get(field):
+                            relay[field] = detail[field]
+                            for derived in DERIVED_FIELDS.get(field, []):
+                                relay[derived] = detail.get(derived, '')
+                            field_sources[field] = name
+                            self.won[name] += 1
+                            break
+                if ip in exit_sources:
+                    field_sources['IsExit'] = exit_sources[ip]
+                relay['Provenance'] = format_provenance(field_sources)
+                relays.append(relay)
+            merged[ip] = relays
+        return merged
+
+    def policies(self, ips):
+        """{ip: accepted port ranges} for ips, from the freshest source with a policy"""
+        ranked = sorted((source for source in self.sources if source.policies),
+                        key=lambda source: self._rank(source.published, source))
+        result = {}
+        for ip in ips:
+            for source in ranked:
+                policy = source.policies.get(ip)
+                if policy is not None:
+                    result[ip] = policy
+                    break
+        return result
+
+    def _single_source(self, name, details, exit_source, formatted):
+        """Provenance for an IP only one source has details for: every field comes
+        from it. The parsed details belong to this scrape, so they are updated in place"""
+        for detail in details:
+            present = tuple(filter(detail.get, DETAIL_FIELDS))
+            key = (name, exit_source, present)
+            provenance = formatted.get(key)
+            if provenance is None:
+                field_sources = dict.fromkeys(present, name)
+                if exit_source:
+                    field_sources['IsExit'] = exit_source
+                provenance = formatted[key] = format_provenance(field_sources)
+            self.won[name] += len(present)
+            detail['Provenance'] = provenance
+        return details
+
+    def coverage(self, node_count):
+        """Per-source coverage for the scrape stats"""
+        report = {}
+        for source in self.all:
+            used = source in self.sources
+            report[source.name] = {
+                'type': source.kind,
+                'status': 'used' if used else (f'error: {source.error}' if source.error else 'stale'),
+                'published': source.published.isoformat(timespec='seconds') if source.published else None,
+                'age_minutes': round((self.now - source.published).total_seconds() / 60) if source.published else None,
+                'listed': len(source.listed),
+                'coverage_percent': round(len(source.listed) * 100.0 / node_count, 1) if node_count and used else 0.0,
+                'exits': sum(1 for is_exit, _ in source.exits.values() if is_exit),
+                'relays': sum(len(details) for details in source.relays.values()),
+                'policies': len(source.policies),
+                'fields_won': self.won.get(source.name, 0)
+            }
+        return report
@@ -22,11 +22,15 @@ $(document).ready(function() {
     
     setInterval(loadStats, 30000); // Refresh every 30 seconds
     
-    // Setup force scrape button
+    // Setup force scrape buttons
     $('#forceScrapeBtn').click(function() {
         forceScrape();
     });
     
+    $('#profileScrapeBtn').click(function() {
+        forceScrape(true);
+    });
+    
     // Setup force upload button
     $('#forceUploadBtn').click(function() {
         forceGitHubUpload();
@@ -57,6 +61,55 @@ function loadStats() {
         updateDashboard();
         updateHistories();
     });
+    loadAnalytics();
+    loadAggregates();
+}
+
+function loadAggregates() {
+    $.get('/api/aggregates', function(data) {
+        if (!data.relays) {
+            return;
+        }
+        const item = (label, value) => $('<li>').append($('<span>').text(label + ': '), $('<strong>').text(value));
+        
+        $('#flagBreakdown').empty().append(
+            Object.entries(data.flags || {})
+                .sort((a, b) => b[1].relays - a[1].relays)
+                .map(([flag, counts]) => item(flag, counts.relays))
+        );
+        $('#versionBreakdown').empty().append(
+            (data.versions || []).slice(0, 8)
+                .map(counts => item(counts.version, `${counts.relays} / ${counts.guards} / ${counts.exits}`))
+        );
+        $('#operatorBreakdown').empty().append(
+            ((data.operators && data.operators.by_exits) || []).slice(0, 8)
+                .map(operator => item(operator.operator, `${operator.exits} exits`))
+        );
+        const countries = (data.countries && data.countries.by_exits) || [];
+        const asns = (data.asns && data.asns.by_exits) || [];
+        $('#geoAggregatesRow').toggleClass('d-none', !countries.length && !asns.length);
+        $('#countryBreakdown').empty().append(
+            countries.slice(0, 8).map(country => item(country.country, `${country.exits} exits`))
+        );
+        $('#asnBreakdown').empty().append(
+            asns.slice(0, 8).map(asn => item(`AS${asn.asn}${asn.as_name ? ' ' + asn.as_name : ''}`, `${asn.exits} exits`))
+        );
+    });
+}
+
+function loadAnalytics() {
+    $.get('/api/analytics', function(data) {
+        if (!data.latest) {
+            return;
+        }
+        const rollup = (data.rollups && data.rollups['7d']) || {};
+        // Keys come back sorted by name, so pick the most common version here
+        const versions = Object.entries(data.versions || {}).sort((a, b) => b[1] - a[1]).map(entry => entry[0]);
+        $('#flappingNodes').text((data.flapping && data.flapping.count) || 0);
+        $('#exitChanges').text(`${data.latest.exit_promotions || 0} / ${data.latest.exit_demotions || 0}`);
+        $('#churn7d').text(`${rollup.added || 0} / ${rollup.removed || 0}`);
+        $('#topVersion').text(versions.length ? versions[0] : '-');
+    });
 }
 
 function loadNodes() {
@@ -98,6 +151,17 @@ function loadNodes() {
                         { data: 'Flags', defaultContent: '' },
                         { data: 'Uptime', defaultContent: '' },
                         { data: 'Version', defaultContent: '' },
+                        { data: 'Country', defaultContent: '' },
+                        {
+                            data: 'ASN',
+                            defaultContent: '',
+                            render: function(data, type, row) {
+                                if (!data) {
+                                    return '';
+                                }
+                                return $('<span>').attr('title', row.ASName || '').text('AS' + data).prop('outerHTML');
+                            }
+                        },
                         { data: 'CollectionDate', defaultContent: '' }
                     ],
                     pageLength: 50,
@@ -228,39 +292,69 @@ function updateHistorySection(elementId, history, formatter) {
     });
 }
 
-function forceScrape() {
-    const btn = $('#forceScrapeBtn');
+function pollJob(jobId, onProgress, onDone) {
+    $.get(`/api/jobs/${jobId}`, function(job) {
+        if (job.status === 'scheduled' || job.status === 'queued' || job.status === 'running') {
+            onProgress(job);
+            setTimeout(function() {
+                pollJob(jobId, onProgress, onDone);
+            }, 2000);
+        } else {
+            onDone(job);
+        }
+    }).fail(function(xhr) {
+        const response = JSON.parse(xhr.responseText || '{}');
+        onDone({ status: 'error', message: response.message || 'Lost track of background job', result: null });
+    });
+}
+
+function forceScrape(profile = false) {
+    const btn = profile ? $('#profileScrapeBtn') : $('#forceScrapeBtn');
     const originalText = btn.html();
     
     // Disable button and show loading
     btn.prop('disabled', true);
     btn.html('<i class="fas fa-spinner fa-spin"></i> Scraping...');
     
+    function finish() {
+        // Re-enable button
+        btn.prop('disabled', false);
+        btn.html(originalText);
+    }
+    
     $.ajax({
-        url: '/api/force-scrape',
+        url: '/api/force-scrape' + (profile ? '?profile=1' : ''),
         method: 'POST',
         success: function(response) {
-            if (response.success) {
-                showAlert('Force scrape completed successfully!', 'success');
-                loadStats(); // Refresh stats
-                loadNodes(); // Refresh node table
-            } else {
-                // Check if it's a rate limit error
-                if (response.message && response.message.includes('RATE_LIMITED')) {
-                    showAlert('Rate Limited: ' + response.message.replace('RATE_LIMITED: ', ''), 'warning');
+            pollJob(response.job_id, function(job) {
+                btn.html(`<i class="fas fa-spinner fa-spin"></i> Scraping... ${job.progress}%`);
+            }, function(job) {
+                const result = job.result || {};
+                if (job.status === 'success') {
+                    let message = 'Force scrape completed successfully!';
+                    if (result.stats && result.stats.profile) {
+                        message += ` Profile saved to ${result.stats.profile.file} (peak memory ${formatBytes(result.stats.profile.peak_memory_bytes)}).`;
+                    }
+                    showAlert(message, 'success');
+                    loadStats(); // Refresh stats
+                    loadNodes(); // Refresh node table
                 } else {
-                    showAlert('Force scrape failed: ' + response.message, 'danger');
+                    const message = result.message || job.message;
+                    // Check if it's a rate limit error
+                    if (message && message.includes('RATE_LIMITED')) {
+                        showAlert('Rate Limited: ' + message.replace('RATE_LIMITED: ', ''), 'warning');
+                    } else {
+                        showAlert('Force scrape failed: ' + message, 'danger');
+                    }
+                    loadStats();
                 }
-            }
+                finish();
+            });
         },
         error: function(xhr) {
             const response = JSON.parse(xhr.responseText || '{}');
             showAlert('Force scrape error: ' + (response.message || 'Unknown error'), 'danger');
-        },
-        complete: function() {
-            // Re-enable button
-            btn.prop('disabled', false);
-            btn.html(originalText);
+            finish();
         }
     });
 }
@@ -290,25 +384,33 @@ function forceGitHubUpload() {
     btn.prop('disabled', true);
     btn.html('<i class="fas fa-spinner fa-spin"></i> Uploading...');
     
+    function finish() {
+        // Re-enable button
+        btn.prop('disabled', false);
+        btn.html(originalText);
+    }
+    
     $.ajax({
         url: '/api/force-upload-github',
         method: 'POST',
         success: function(response) {
-            if (response.success) {
-                showAlert('GitHub upload completed successfully! ' + response.message, 'success', 'github');
+            pollJob(response.job_id, function(job) {
+                btn.html(`<i class="fas fa-spinner fa-spin"></i> Uploading... ${job.progress}%`);
+            }, function(job) {
+                const result = job.result || {};
+                if (job.status === 'success') {
+                    showAlert('GitHub upload completed successfully! ' + (result.message || ''), 'success', 'github');
+                } else {
+                    showAlert('GitHub upload failed: ' + (result.message || job.message), 'danger', 'github');
+                }
                 loadStats(); // Refresh stats to show new upload in history
-            } else {
-                showAlert('GitHub upload failed: ' + response.message, 'danger', 'github');
-            }
+                finish();
+            });
         },
         error: function(xhr) {
             const response = JSON.parse(xhr.responseText || '{}');
             showAlert('GitHub upload error: ' + (response.message || 'Unknown error'), 'danger', 'github');
-        },
-        complete: function() {
-            // Re-enable button
-            btn.prop('disabled', false);
-            btn.html(originalText);
+            finish();
         }
     });
 }
@@ -339,10 +441,31 @@ function formatScrapeItem(item) {
         </div>`;
     }
     
+    if (item.timings && Object.keys(item.timings).length > 0) {
+        const stages = Object.entries(item.timings)
+            .map(([stage, seconds]) => `${stage}: ${Number(seconds).toFixed(2)}s`)
+            .join(' | ');
+        html += `<div class="stats">
+            Timings: ${stages}<br>
+            Fetched: ${formatBytes(item.bytes_fetched || 0)} | Rows: ${item.rows_processed || 0}
+            ${item.profile_file ? ' | Profile: ' + item.profile_file : ''}
+        </div>`;
+    }
+    
     html += '</div>';
     return html;
 }
 
+function formatBytes(bytes) {
+    if (bytes >= 1048576) {
+        return (bytes / 1048576).toFixed(1) + ' MB';
+    }
+    if (bytes >= 1024) {
+        return (bytes / 1024).toFixed(1) + ' KB';
+    }
+    return bytes + ' B';
+}
+
 function formatSimpleItem(item) {
     const timestamp = new Date(item.timestamp).toLocaleString();
     const isForced = item.forced || item.message?.includes('[FORCED]');
@@ -395,16 +518,20 @@ function forceOpenCTIImport() {
                 }
                 loadStats(); // Refresh stats to show import status
                 
-                // Set up periodic refresh to show progress
-                let refreshCount = 0;
-                const maxRefreshes = 30; // Stop after 15 minutes
-                const refreshInterval = setInterval(function() {
-                    loadStats();
-                    refreshCount++;
-                    if (refreshCount >= maxRefreshes) {
-                        clearInterval(refreshInterval);
+                // Follow the import job until it finishes
+                pollJob(response.job_id, function(job) {
+                    btn.html(`<i class="fas fa-spinner fa-spin"></i> Importing... ${job.progress}%`);
+                }, function(job) {
+                    const result = job.result || {};
+                    if (job.status === 'success') {
+                        showAlert('OpenCTI import completed: ' + (result.message || ''), 'success', 'opencti');
+                    } else {
+                        showAlert('OpenCTI import failed: ' + (result.message || job.message), 'danger', 'opencti');
                     }
-                }, 30000); // Refresh every 30 seconds
+                    loadStats();
+                    btn.prop('disabled', false);
+                    btn.html(originalText);
+                });
                 
             } else {
                 showAlert('OpenCTI import failed: ' + response.message, 'danger', 'opencti');
@@ -418,8 +545,11 @@ function forceOpenCTIImport() {
                 showAlert('OpenCTI import error: ' + (response.message || 'Unknown error'), 'danger', 'opencti');
             }
         },
-        complete: function() {
-            // Re-enable button after a delay
+        complete: function(xhr) {
+            // Leave the button disabled while the import job is running
+            if (xhr.responseJSON && xhr.responseJSON.job_id) {
+                return;
+            }
             setTimeout(function() {
                 btn.prop('disabled', false);
                 btn.html(originalText);
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test that the incrementally maintained aggregates stay stable across scrapes
+
+A dual-stack relay (IPv4 and IPv6 rows sharing one fingerprint, as the
+onionoo and consensus sources emit them) must count once per row, and
+applying the same rows again must not change any counter.
+"""
+import copy
+import json
+import os
+import tempfile
+
+from aggregates import NodeAggregates
+
+FINGERPRINT = 'A' * 40
+
+def node_row(ip, name, or_port, is_exit=False, fingerprint='', flags='FGRSVE'):
+    return {
+        'IP': ip, 'IsExit': 'ExitNode' if is_exit else '', 'Name': name, 'OnionPort': or_port, 'DirPort': '0',
+        'Flags': flags, 'Uptime': '86400', 'Version': 'Tor 0.4.8.13', 'Contact': 'ops@example.org',
+        'CollectionDate': '2026-01-01', 'Fingerprint': fingerprint, 'ContactEmail': 'ops@example.org',
+        'ContactUrl': '', 'Country': 'DE', 'ASN': '64500', 'ASName': 'ExampleNet'
+    }
+
+ROWS = [
+    node_row('192.0.2.10', 'dualstack', '9001', is_exit=True, fingerprint=FINGERPRINT),
+    node_row('2001:db8::10', 'dualstack', '9001', is_exit=True, fingerprint=FINGERPRINT),
+    node_row('192.0.2.20', 'plain', '443'),
+    node_row('192.0.2.21', 'twin', '443'),
+    # dan.me.uk can list the same line twice
+    node_row('192.0.2.21', 'twin', '443')
+]
+
+def check(label, condition):
+    print(f"   {'✅' if condition else '❌'} {label}")
+    return condition
+
+def without_timestamp(aggregates):
+    aggregates = dict(aggregates)
+    aggregates.pop('updated_at', None)
+    return aggregates
+
+def test_aggregates():
+    print("🧪 Testing Incremental Aggregates")
+    print("=" * 50)
+    ok = True
+    with tempfile.TemporaryDirectory() as data_dir:
+        aggregates = NodeAggregates(data_dir)
+
+        print("1️⃣ First scrape with a dual-stack relay...")
+        first = aggregates.update(None, copy.deepcopy(ROWS))
+        ok &= check(f"5 relays ({first['relays']})", first['relays'] == 5)
+        ok &= check(f"2 exits ({first['exits']})", first['exits'] == 2)
+        with open(aggregates.state_file, 'r') as f:
+            state = json.load(f)
+
+        print("2️⃣ The same rows twice more (counters must not change)...")
+        for _ in range(2):
+            again = aggregates.update(None, copy.deepcopy(ROWS))
+        ok &= check(f"relays still 5 ({again['relays']})", again['relays'] == 5)
+        ok &= check(f"exits still 2 ({again['exits']})", again['exits'] == 2)
+        with open(aggregates.state_file, 'r') as f:
+            ok &= check("counters unchanged", json.load(f)['counters'] == state['counters'])
+        ok &= check("aggregates unchanged", without_timestamp(again) == without_timestamp(first))
+
+        print("3️⃣ IPv6 address leaves, a relay is renamed (matches a fresh build)...")
+        changed = copy.deepcopy(ROWS[:1] + ROWS[2:])
+        changed[1]['Name'] = 'renamed'
+        incremental = aggregates.update(None, copy.deepcopy(changed))
+        with tempfile.TemporaryDirectory() as fresh_dir:
+            fresh = NodeAggregates(fresh_dir).update(None, copy.deepcopy(changed))
+        ok &= check(f"relays {incremental['relays']} == {fresh['relays']}", incremental['relays'] == fresh['relays'] == 4)
+        ok &= check("same as a fresh build", without_timestamp(incremental) == without_timestamp(fresh))
+
+    print()
+    print("🎉 All checks passed" if ok else "❌ Some checks failed")
+    assert ok
+
+if __name__ == "__main__":
+    test_aggregates()
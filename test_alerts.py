@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Test alert delivery against a local SMTP debug server on port 1025
+
+Start a debug server first (port 1025 skips STARTTLS), e.g.:
+    python -m aiosmtpd -n -l localhost:1025
+    python -m smtpd -n -c DebuggingServer localhost:1025   # Python <= 3.11
+"""
+import os
+import time
+
+os.environ.update({
+    'EMAIL_ENABLED': 'true',
+    'ALERTS_ENABLED': 'true',
+    'EMAIL_SMTP_SERVER': os.getenv('EMAIL_SMTP_SERVER', 'localhost'),
+    'EMAIL_SMTP_PORT': '1025',
+    'EMAIL_FROM': os.getenv('EMAIL_FROM', 'monitor@localhost'),
+    'EMAIL_TO': os.getenv('EMAIL_TO', 'soc@localhost'),
+    'ALERT_BATCH_SECONDS': '2',
+    'SMTP_IDLE_TIMEOUT': '3'
+})
+
+from alerts import AlertManager
+
+def check(label, condition):
+    print(f"   {'✅' if condition else '❌'} {label}")
+    return condition
+
+def test_alerts():
+    print("🧪 Testing Alert Delivery (SMTP localhost:1025)")
+    print("=" * 50)
+    manager = AlertManager(os.getenv('DATA_DIR', '/tmp'))
+    ok = True
+
+    print("1️⃣ Burst of 5 alerts (should arrive as one digest email)...")
+    manager.check('scrape', {'status': 'error', 'message': 'Scraping failed: connection reset'})
+    manager.check('scrape', {'status': 'skipped', 'message': 'RATE_LIMITED: Server returned 403 Forbidden.'})
+    manager.check('scrape', {'status': 'success', 'nodes_added': 900, 'nodes_removed': 20, 'nodes_total': 7000})
+    manager.check('github', {'status': 'error', 'message': 'GitHub API returned 502'})
+    manager.check('opencti', {'status': 'error', 'message': '[FORCED] ❌ API Test Failed - Connection timeout'})
+    manager.flush()
+    session = manager.notifier.session()
+    ok &= check(f"1 email sent ({session.sent})", session.sent == 1)
+    ok &= check(f"1 SMTP connection opened ({session.connects})", session.connects == 1)
+
+    print("2️⃣ Second alert after the batch window (should reuse the open session)...")
+    manager.alert('failure', 'test alert', 'Second message on the same connection', 'scrape')
+    manager.flush()
+    ok &= check(f"2 emails sent ({session.sent})", session.sent == 2)
+    ok &= check(f"still 1 SMTP connection ({session.connects})", session.connects == 1)
+
+    print(f"3️⃣ Waiting past the {session.idle_timeout}s idle timeout (should reconnect)...")
+    time.sleep(session.idle_timeout + 1)
+    session.close_if_idle()
+    ok &= check("idle session closed", session.conn is None)
+    manager.alert('failure', 'test alert', 'Message after the idle timeout', 'scrape')
+    manager.flush()
+    ok &= check(f"3 emails sent ({session.sent})", session.sent == 3)
+    ok &= check(f"2 SMTP connections opened ({session.connects})", session.connects == 2)
+
+    print("4️⃣ Baseline scrape (every node added) should not raise a churn alert...")
+    manager.check('scrape', {'status': 'success', 'nodes_added': 7000, 'nodes_removed': 0, 'nodes_total': 7000})
+    manager.flush()
+    ok &= check(f"no new email ({session.sent})", session.sent == 3)
+
+    session.close()
+    print()
+    print("🎉 All checks passed - see the debug server output for the messages" if ok else "❌ Some checks failed")
+
+if __name__ == "__main__":
+    try:
+        test_alerts()
+    except ConnectionRefusedError:
+        print("❌ Could not connect to localhost:1025")
+        print("   Start a debug server with: python -m aiosmtpd -n -l localhost:1025")
@@ -48,6 +48,14 @@ def test_github_upload():
         response = requests.post("http://localhost:5002/api/force-upload-github")
         result = response.json()
         
+        # The upload runs as a background job - wait for it to finish
+        while result.get('job_id'):
+            job = requests.get(f"http://localhost:5002/api/jobs/{result['job_id']}").json()
+            if job['status'] not in ('scheduled', 'queued', 'running'):
+                result = job.get('result') or {'success': False, 'message': job.get('message')}
+                break
+            time.sleep(2)
+        
         print(f"\n📤 Upload Result:")
         print(f"   Status: {'✅ SUCCESS' if result.get('success') else '❌ FAILED'}")
         print(f"   Message: {result.get('message', 'No message')}")
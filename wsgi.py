@@ -0,0 +1,14 @@
+"""
+WSGI entry point for production API workers.
+
+Run with gunicorn (see gunicorn.conf.py):
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+API workers are stateless: they never start the scheduler and read the node
+index and stats from /app/data, which the scheduler process (see
+scheduler_service.py) keeps up to date.
+"""
+from app import app, refresh_stats
+
+# Serve the last persisted stats straight away
+refresh_stats()